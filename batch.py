@@ -0,0 +1,240 @@
+import json
+import os
+import shutil
+import time
+import cv2
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from deploy import load_artemis, share_model
+from interpolate import interpolate_window, open_cache, open_output
+from parallel import init_worker, worker_state
+from utils import read_video, read_frame, frame_to_tensor, list_image_sequence
+
+
+VIDEO_EXTENSIONS = (".mp4", ".mov", ".avi", ".mkv", ".webm", ".m4v")
+REPORT_NAME = "batch_report.json"
+
+
+def list_clips(input_dir):
+    """
+    List the clips of a batch: the video files and frame directories inside of the input directory, in order
+    """
+    clips = []
+    for name in sorted(os.listdir(input_dir)):
+        path = os.path.join(input_dir, name)
+        if os.path.isdir(path) or name.lower().endswith(VIDEO_EXTENSIONS):
+            clips.append(path)
+
+    if not clips:
+        raise Exception(f"No videos or frame directories found in: {input_dir}")
+
+    return clips
+
+
+def count_frames(clip_path):
+    """
+    Count the frames of a video file or frame directory without decoding them
+    """
+    if os.path.isdir(clip_path):
+        return len(list_image_sequence(clip_path))
+
+    capture = cv2.VideoCapture(clip_path)
+    num_frames = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+    capture.release()
+    return num_frames
+
+
+class WindowJournal:
+    """
+    A journal of the windows of a clip which have been interpolated so far.
+
+    Each interpolated frame is written to the work directory before its window index is appended to the journal,
+    so that an interrupted job can resume from every window in the journal. Frames are kept as float32 arrays,
+    so that they reach the output (e.g. EXR or 16-bit TIFF frames) without being quantized.
+    """
+    def __init__(self, work_dir):
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, "journal.txt")
+        os.makedirs(work_dir, exist_ok=True)
+
+        self.done = set()
+        if os.path.exists(self.path):
+            with open(self.path, "r") as f:
+                self.done = {int(line) for line in f.read().split()}
+
+        self.file = open(self.path, "a")
+
+    def frame_path(self, window_index):
+        return os.path.join(self.work_dir, f"window_{window_index:06d}.npy")
+
+    def load(self, window_index):
+        return torch.from_numpy(np.load(self.frame_path(window_index)))
+
+    def record(self, window_index, frame):
+        # np.save raises if the frame cannot be written (e.g. a full disk), before the window is journaled as done
+        np.save(self.frame_path(window_index), frame.detach().cpu().float().numpy())
+        self.file.write(f"{window_index}\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.done.add(window_index)
+
+    def close(self):
+        self.file.close()
+
+
+def get_output_path(clip_path, save_dir):
+    """
+    Video files are interpolated to mp4 files, and frame directories to frame directories
+    """
+    name = os.path.basename(os.path.normpath(clip_path))
+    if os.path.isdir(clip_path):
+        return os.path.join(save_dir, name)
+    return os.path.join(save_dir, os.path.splitext(name)[0] + ".mp4")
+
+
+def run_job(model, device, cache, clip_path, args):
+    """
+    Interpolate a single clip of the batch, resuming from its journal if it was interrupted before
+    """
+    start_time = time.perf_counter()
+    name = os.path.basename(os.path.normpath(clip_path))
+    output_path = get_output_path(clip_path, args.save_path)
+    journal = WindowJournal(os.path.join(args.save_path, ".work", name))
+
+    # Read the clip
+    if os.path.isdir(clip_path):
+        input_frames = [frame_to_tensor(read_frame(path)) for path in list_image_sequence(clip_path)]
+        input_frame_rate = args.input_fps
+    else:
+        input_frames, input_frame_rate = read_video(clip_path)
+
+    # Duplicate the first and last input frames
+    padded_frames = [input_frames[0]] + input_frames + [input_frames[-1]]
+    num_windows = len(padded_frames) - 3
+    frame_digests = [cache.frame_digest(frame) for frame in padded_frames] if cache is not None else None
+    resumed_windows = len(journal.done)
+
+    # Interpolate every window which is not in the journal yet
+    for i in range(num_windows):
+        if i in journal.done:
+            continue
+
+        context_frames = [frame.to(device) for frame in padded_frames[i:i+4]]
+        window_digests = frame_digests[i:i+4] if cache is not None else None
+        interpolated_frame = interpolate_window(model, context_frames, device, cache, window_digests)
+        journal.record(i, interpolated_frame)
+
+    journal.close()
+
+    # Alternate between the input frames and the journaled output frames
+    writer = open_output(output_path, input_frame_rate * 2, args)
+    for i in range(num_windows):
+        writer.write(input_frames[i])
+        writer.write(journal.load(i))
+    writer.write(input_frames[-1])
+    writer.close()
+
+    # The journal is no longer needed once the output is complete
+    shutil.rmtree(journal.work_dir)
+
+    seconds = time.perf_counter() - start_time
+    return {
+        "clip": clip_path,
+        "output": output_path,
+        "status": "done",
+        "windows": num_windows,
+        "resumed_windows": resumed_windows,
+        "seconds": seconds,
+        "windows_per_second": (num_windows - resumed_windows) / seconds,
+    }
+
+
+def run_job_in_worker(clip_path, args):
+    """
+    Interpolate a single clip of the batch inside of a worker process
+    """
+    return run_job(worker_state["model"], worker_state["device"], worker_state["cache"], clip_path, args)
+
+
+def write_report(report, save_dir):
+    with open(os.path.join(save_dir, REPORT_NAME), "w") as f:
+        json.dump(report, f, indent=4)
+
+
+def interpolate_batch(args):
+    """
+    Interpolate every video file and frame directory inside of args.input_path into args.save_path.
+
+    The model is loaded once for the whole batch, and clips are scheduled across args.num_procs worker processes.
+    Completed clips are recorded in a report, and completed windows of each clip in a journal,
+    so that rerunning an interrupted batch resumes where it stopped.
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    os.makedirs(args.save_path, exist_ok=True)
+
+    # Skip the clips which were completed by a previous run
+    report_path = os.path.join(args.save_path, REPORT_NAME)
+    report = {}
+    if os.path.exists(report_path):
+        with open(report_path, "r") as f:
+            report = json.load(f)
+
+    all_clips = list_clips(args.input_path)
+    clips = [clip for clip in all_clips if report.get(clip, {}).get("status") != "done"]
+    clip_windows = {clip: count_frames(clip) - 1 for clip in clips}
+    total_windows = sum(clip_windows.values())
+    print(f"Interpolating {len(clips)} clips ({total_windows} windows), skipping {len(all_clips) - len(clips)} completed clips")
+
+    batch_start = time.perf_counter()
+    finished_clips = 0
+    finished_windows = 0
+
+    def finish(stats):
+        nonlocal finished_clips, finished_windows
+        report[stats["clip"]] = stats
+        write_report(report, args.save_path)
+
+        # Estimate the time left from the throughput of the batch so far
+        finished_clips += 1
+        finished_windows += clip_windows[stats["clip"]]
+        elapsed = time.perf_counter() - batch_start
+        eta = elapsed / finished_windows * (total_windows - finished_windows) if finished_windows else 0.0
+        print(f"[{finished_clips}/{len(clips)}] {stats['output']}: {stats['windows']} windows in {stats['seconds']:.1f}s "
+              f"({stats['windows_per_second']:.2f} windows/s), ETA {eta:.0f}s")
+
+    if args.num_procs > 1:
+        context = mp.get_context("spawn")
+        counter = context.Value("i", 0)
+        cache = open_cache(args)
+
+        if args.share_weights:
+            model, masks = share_model(load_artemis(args.model_path, torch.device("cpu"), args))
+            initargs = (args, model, device, args.num_procs, counter, cache, masks)
+        else:
+            initargs = (args, args.model_path, device, args.num_procs, counter, cache)
+
+        with ProcessPoolExecutor(max_workers=args.num_procs, mp_context=context, initializer=init_worker, initargs=initargs) as pool:
+            futures = {pool.submit(run_job_in_worker, clip, args): clip for clip in clips}
+            for future in as_completed(futures):
+                try:
+                    finish(future.result())
+                except Exception as error:
+                    # A failed clip keeps its journal, so that the next run resumes it
+                    report[futures[future]] = {"clip": futures[future], "status": "failed", "error": str(error)}
+                    write_report(report, args.save_path)
+                    print(f"Failed to interpolate {futures[future]}: {error}")
+    else:
+        model = load_artemis(args.model_path, device, args)
+        cache = open_cache(args)
+
+        for clip in clips:
+            try:
+                finish(run_job(model, device, cache, clip, args))
+            except Exception as error:
+                report[clip] = {"clip": clip, "status": "failed", "error": str(error)}
+                write_report(report, args.save_path)
+                print(f"Failed to interpolate {clip}: {error}")
+
+    print("Saved batch report to: ", report_path)
@@ -0,0 +1,364 @@
+import os
+import time
+import torch
+from deploy import load_artemis, init_artemis, set_token_merge_ratios, set_branch_threads
+from metrics import eval_metrics, calc_psnr
+from profiler import ModuleProfiler
+from utils import read_video, read_frame, frame_to_tensor, list_image_sequence
+
+
+# Values compared by each benchmark, unless --bench_values is given
+DEFAULT_VALUES = {
+    "proxy": "1.0, 0.5, 0.25",
+    "timesteps": "4, 8",
+    "token_merging": "0, 0.25, 0.5",
+    "sparse_synthesis": "0, 16, 8, 4, 0.01",
+    "branches": "1, 2, 4",
+}
+
+
+def load_samples(args):
+    """
+    Load the samples to benchmark on as (context_frames, ground_truth, timestep):
+    septuplets of consecutive frames of --input_path if given, or else the Vimeo-90K Septuplet test split in --data_dir
+    """
+    samples = []
+
+    if args.input_path:
+        if os.path.isdir(args.input_path):
+            frames = [frame_to_tensor(read_frame(path)) for path in list_image_sequence(args.input_path)]
+        else:
+            frames, _ = read_video(args.input_path)
+
+        # Like in the Vimeo-90K Septuplet dataset, frames 1, 2, 6 and 7 of each septuplet are the context
+        for i in range(0, len(frames) - 6, 7):
+            samples.append(([frames[i], frames[i + 1], frames[i + 5], frames[i + 6]], frames[i + 3], 0.5))
+    else:
+        from data.preprocessing.vimeo90k_septuplet_process import VimeoSeptuplet
+        dataset = VimeoSeptuplet(args.data_dir, is_training=False)
+
+        for i in range(min(len(dataset), args.bench_samples)):
+            context, ground_truth, timestep = dataset[i]
+            samples.append(([frame.unsqueeze(0) for frame in context], ground_truth.unsqueeze(0), timestep))
+
+    return samples[:args.bench_samples]
+
+
+def parse_values(args):
+    """
+    Get the values of the option compared by the benchmark, as strings
+    """
+    values = args.bench_values or DEFAULT_VALUES[args.benchmark]
+    return "".join(values.split()).split(",")
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def evaluate(model, samples, device, reference=None):
+    """
+    Run the model on every sample:
+    returns the mean latency, the PSNR and SSIM against the ground truth and the PSNR against the reference outputs
+    (if given), along with the outputs themselves
+    """
+    def run(context_frames, timestep):
+        context_frames = [frame.to(device) for frame in context_frames]
+        output_frame_time = torch.tensor([timestep], dtype=torch.float32).to(device)
+        with torch.no_grad():
+            return model(context_frames, output_frame_time)
+
+    # Warm up caches (cudnn algorithms, attention masks, ...) before timing anything
+    run(samples[0][0], samples[0][2])
+
+    total_latency, total_psnr, total_ssim, total_fidelity = 0.0, 0.0, 0.0, 0.0
+    outputs = []
+
+    for i, (context_frames, ground_truth, timestep) in enumerate(samples):
+        synchronize(device)
+        start = time.perf_counter()
+        output = run(context_frames, timestep)
+        synchronize(device)
+        total_latency += time.perf_counter() - start
+
+        psnr, ssim = eval_metrics(output, ground_truth.to(device))
+        total_psnr += float(psnr)
+        total_ssim += float(ssim)
+
+        output_frame = output[2].cpu()
+        outputs.append(output_frame)
+        if reference is not None:
+            total_fidelity += calc_psnr(output_frame, reference[i])
+
+    result = {
+        "latency_ms": 1e3 * total_latency / len(samples),
+        "psnr": total_psnr / len(samples),
+        "ssim": total_ssim / len(samples),
+        "psnr_vs_reference": total_fidelity / len(samples) if reference is not None else float("inf"),
+    }
+    return result, outputs
+
+
+def compare_variants(model, samples, device, variants):
+    """
+    Evaluate each variant of the model on the samples, and print a comparison table.
+    variants: a list of (name, configure), where configure(model) applies the variant. The first one is the reference.
+    """
+    results = []
+    reference = None
+
+    for name, configure in variants:
+        configure(model)
+        result, outputs = evaluate(model, samples, device, reference)
+
+        if reference is None:
+            reference = outputs
+
+        results.append((name, result))
+        print(f"Evaluated {name}: {result['latency_ms']:.1f} ms, {result['psnr']:.2f} dB")
+
+    print_results(results)
+    return results
+
+
+def print_results(results):
+    reference_latency = results[0][1]["latency_ms"]
+
+    print(f"{'variant':<28}{'latency ms':>12}{'speedup':>10}{'PSNR':>8}{'SSIM':>8}{'PSNR vs ref':>13}")
+    for name, result in results:
+        speedup = reference_latency / result["latency_ms"]
+        print(f"{name:<28}{result['latency_ms']:>12.1f}{speedup:>9.2f}x{result['psnr']:>8.2f}{result['ssim']:>8.4f}{result['psnr_vs_reference']:>13.2f}")
+
+
+def benchmark_proxy(args, model, samples, device):
+    """
+    Compare proxy inference at several proxy scales
+    """
+    variants = []
+    for value in parse_values(args):
+        variants.append((f"proxy_scale={value}", lambda model, scale=float(value): setattr(model, "proxy_scale", scale)))
+    return compare_variants(model, samples, device, variants)
+
+
+def benchmark_token_merging(args, model, samples, device):
+    """
+    Compare merge ratios of the tokens in the attention windows of every encoder stage
+    """
+    variants = []
+    for value in parse_values(args):
+        variants.append((f"token_merge_ratio={value}", lambda model, ratio=float(value): set_token_merge_ratios(model, [ratio])))
+    return compare_variants(model, samples, device, variants)
+
+
+def benchmark_branches(args, model, samples, device):
+    """
+    Compare running the independent branches of the forward pass one after the other (1 thread) or concurrently
+    on pools of threads. The samples have a batch size of 1, where the convolutions of a branch use the cores the least.
+    """
+    print(f"{torch.get_num_threads()} intra-op threads")
+    variants = []
+    for value in parse_values(args):
+        variants.append((f"branch_threads={value}", lambda model, num_threads=int(value): set_branch_threads(model, num_threads)))
+    return compare_variants(model, samples, device, variants)
+
+
+def benchmark_compile(args, model, samples, device):
+    """
+    Compare eager and compiled inference: the latency of the first forward pass (cold, which compiles the model
+    or loads its compile cache) and the mean latency of the following ones (warm)
+    """
+    from compilation import compile_artemis, decompile_artemis
+
+    results = []
+    reference = None
+
+    for name in ("eager", "compiled"):
+        if name == "compiled":
+            compile_artemis(model, args.compile_mode)
+        else:
+            decompile_artemis(model)
+
+        latencies, outputs = [], []
+        for context_frames, _, timestep in samples:
+            context_frames = [frame.to(device) for frame in context_frames]
+            output_frame_time = torch.tensor([timestep], dtype=torch.float32).to(device)
+
+            synchronize(device)
+            start = time.perf_counter()
+            with torch.no_grad():
+                output = model(context_frames, output_frame_time)
+            synchronize(device)
+            latencies.append(time.perf_counter() - start)
+            outputs.append(output[2].cpu())
+
+        if reference is None:
+            reference = outputs
+        fidelity = sum(calc_psnr(output, reference_output) for output, reference_output in zip(outputs, reference)) / len(outputs)
+
+        cold_ms = 1e3 * latencies[0]
+        warm_ms = 1e3 * sum(latencies[1:]) / max(1, len(latencies) - 1)
+        results.append((name, cold_ms, warm_ms, fidelity))
+        print(f"Evaluated {name}: {cold_ms:.1f} ms cold, {warm_ms:.1f} ms warm")
+
+    print(f"{'variant':<28}{'cold ms':>10}{'warm ms':>10}{'speedup':>10}{'PSNR vs eager':>15}")
+    for name, cold_ms, warm_ms, fidelity in results:
+        print(f"{name:<28}{cold_ms:>10.1f}{warm_ms:>10.1f}{results[0][2] / warm_ms:>9.2f}x{fidelity:>15.2f}")
+    return results
+
+
+def profile_pass(model, sample, device):
+    """
+    Profile a forward pass on a sample: returns the summary of a ModuleProfiler
+    """
+    profiler = ModuleProfiler(model)
+    context_frames, _, timestep = sample
+    with torch.no_grad():
+        model([frame.to(device) for frame in context_frames], torch.tensor([timestep], dtype=torch.float32).to(device))
+    summary = profiler.summary()
+    profiler.remove()
+    return summary
+
+
+def count_gflops(model, sample, device, exclude=("predict",)):
+    """
+    Estimate the GFLOPs of the convolutions and linear layers of a forward pass on a sample,
+    leaving out the profiled modules whose names start with one of exclude
+    """
+    summary = profile_pass(model, sample, device)
+    return sum(total["gflops"] for name, total in summary.items() if not name.startswith(exclude))
+
+
+def benchmark_factorized(args, model, samples, device):
+    """
+    Compare the model with its variant with (2+1)D convolutions, initialized from its weights by truncated SVD (without fine-tuning)
+    """
+    variants = [("full 3D convs", model), ("(2+1)D convs", load_artemis(args.model_path, device, args, factorize=True))]
+    results, gflops = [], []
+    reference = None
+
+    for name, variant in variants:
+        gflops.append(count_gflops(variant, samples[0], device))
+        result, outputs = evaluate(variant, samples, device, reference)
+
+        if reference is None:
+            reference = outputs
+
+        results.append((name, result))
+        print(f"Evaluated {name}: {result['latency_ms']:.1f} ms, {result['psnr']:.2f} dB")
+
+    print_results(results)
+    print(f"{'variant':<28}{'GFLOPs of the encoder, decoder and SmoothNets':>46}")
+    for (name, _), variant_gflops in zip(results, gflops):
+        print(f"{name:<28}{variant_gflops:>46.1f}")
+    return results
+
+
+def benchmark_sparse_synthesis(args, model, samples, device):
+    """
+    Compare sparse synthesis with the dense synthesis (value 0): integer values keep the top k elements of each kernel,
+    and decimal values keep the elements above a threshold. Also reports the time spent in the synthesis alone.
+    """
+    def configure(topk, threshold):
+        def apply(model):
+            for head in (model.predict1, model.predict2, model.predict3):
+                head.synth_topk, head.synth_threshold = topk, threshold
+        return apply
+
+    variants = []
+    for value in parse_values(args):
+        if value == "0":
+            variants.append(("dense", configure(None, None)))
+        elif "." in value:
+            variants.append((f"synth_threshold={value}", configure(None, float(value))))
+        else:
+            variants.append((f"synth_topk={value}", configure(int(value), None)))
+
+    results = compare_variants(model, samples, device, variants)
+
+    # Time the synthesis on its own, since the rest of the forward pass is the same for every variant
+    print(f"{'variant':<28}{'synthesis ms':>14}")
+    for name, configure_variant in variants:
+        configure_variant(model)
+        summary = profile_pass(model, samples[0], device)
+        synthesis_ms = sum(total["total_ms"] for module, total in summary.items() if module.endswith("FunctionSynth"))
+        print(f"{name:<28}{synthesis_ms:>14.1f}")
+    return results
+
+
+def benchmark_timesteps(args, model, samples, device):
+    """
+    Compare two ways of interpolating all the timesteps of a frame rate factor (e.g. 0.25, 0.5 and 0.75 for 4x)
+    between the same context frames: one forward pass per timestep, or a single forward pass for all of them.
+    """
+    def run_separately(context_frames, timesteps):
+        return [model(context_frames, timestep)[2] for timestep in timesteps]
+
+    def run_together(context_frames, timesteps):
+        return [output for _, _, output in model(context_frames, timesteps)]
+
+    results = []
+    for value in parse_values(args):
+        factor = int(value)
+        timesteps = [torch.tensor([i / factor], dtype=torch.float32).to(device) for i in range(1, factor)]
+        latencies = {run_separately: 0.0, run_together: 0.0}
+        max_difference = 0.0
+
+        # Warm up caches (cudnn algorithms, attention masks, ...) before timing anything
+        with torch.no_grad():
+            run_together([frame.to(device) for frame in samples[0][0]], timesteps)
+
+        for context_frames, _, _ in samples:
+            context_frames = [frame.to(device) for frame in context_frames]
+            outputs = {}
+
+            for run in latencies:
+                synchronize(device)
+                start = time.perf_counter()
+                with torch.no_grad():
+                    outputs[run] = run(context_frames, timesteps)
+                synchronize(device)
+                latencies[run] += time.perf_counter() - start
+
+            for separate, together in zip(outputs[run_separately], outputs[run_together]):
+                max_difference = max(max_difference, (separate - together).abs().max().item())
+
+        separate_ms = 1e3 * latencies[run_separately] / len(samples)
+        together_ms = 1e3 * latencies[run_together] / len(samples)
+        results.append((factor, separate_ms, together_ms, max_difference))
+        print(f"Evaluated {factor}x: {separate_ms:.1f} ms separately, {together_ms:.1f} ms together")
+
+    print(f"{'frame rate':<12}{'timesteps':>10}{'separate ms':>13}{'together ms':>13}{'speedup':>10}{'max diff':>10}")
+    for factor, separate_ms, together_ms, max_difference in results:
+        print(f"{str(factor) + 'x':<12}{factor - 1:>10}{separate_ms:>13.1f}{together_ms:>13.1f}{separate_ms / together_ms:>9.2f}x{max_difference:>10.1e}")
+    return results
+
+
+BENCHMARKS = {
+    "proxy": benchmark_proxy,
+    "timesteps": benchmark_timesteps,
+    "token_merging": benchmark_token_merging,
+    "factorized": benchmark_factorized,
+    "sparse_synthesis": benchmark_sparse_synthesis,
+    "branches": benchmark_branches,
+    "compile": benchmark_compile,
+}
+
+
+def run_benchmark(args):
+    """
+    Run one of the speed/quality comparisons of BENCHMARKS, selected with --benchmark.
+    Without --model_path, an untrained model is built from the command line arguments instead: its speed is meaningful,
+    but not its quality.
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    if args.model_path:
+        model = load_artemis(args.model_path, device, args)
+    elif args.benchmark == "factorized":
+        raise ValueError("The factorized benchmark factorizes trained weights, so it needs --model_path")
+    else:
+        model = init_artemis(device, args)
+        print(f"Benchmarking an untrained model (time conditioning: {args.time_conditioning}), since no --model_path was given")
+    samples = load_samples(args)
+    print(f"Benchmarking {args.benchmark} on {len(samples)} samples")
+    return BENCHMARKS[args.benchmark](args, model, samples, device)
@@ -0,0 +1,160 @@
+import os
+import time
+import torch
+import torch._dynamo
+from model.artemis import luma
+from paths import CACHE_DIR
+
+
+# Where the compiled code of each shape bucket is kept across runs, for the version of PyTorch in use
+COMPILE_DIR = os.path.join(CACHE_DIR, "compile", torch.__version__)
+
+
+def compiled_modules(model):
+    """
+    List the modules of ArTEMIS which are compiled: the stages of the encoder, the decoder, the SmoothNets,
+    and the subnets of every ChronoSynth head. The synthesis is left out, and stays eager between them.
+    """
+    modules = list(model.encoder.children()) + list(model.decoder) + [model.smooth1, model.smooth2, model.smooth3]
+
+    for head in (model.predict1, model.predict2, model.predict3):
+        modules.append(head.feature_fuse)
+        for subnet in (head.ModuleWeight, head.ModuleAlpha, head.ModuleBeta, head.ModuleOcclusion):
+            # With late time conditioning, the trunk and head of each subnet are called separately
+            if head.time_conditioning == "late":
+                modules += [head.trunk(subnet), head.head(subnet)]
+            else:
+                modules.append(subnet)
+
+    return modules
+
+
+def shape_bucket(frames, output_frame_times, device):
+    """
+    Name the shape bucket of a forward pass, which the compiled code is specialized for:
+    the batch size and frame size, the number of timesteps, and the device
+    """
+    B, _, H, W = luma(frames[0]).shape
+    num_timesteps = len(output_frame_times) if isinstance(output_frame_times, list) else 1
+    return f"{B}x{H}x{W}_t{num_timesteps}_{device.type}"
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+class CompileTracker:
+    """
+    Keep the compiled code of ArTEMIS on disk for every shape bucket, and time its forward passes.
+
+    Before the first forward pass of a bucket, the compile artifacts saved by a previous run are loaded, so that
+    compilation hits the cache instead of generating code again. After it, the artifacts are saved.
+    The first forward pass of each bucket is cold (it compiles, or loads the cache), and the following ones are warm.
+    """
+    def __init__(self, model, cache_dir=COMPILE_DIR):
+        self.cache_dir = cache_dir
+        # Bucket -> latencies of its forward passes in seconds, and whether its artifacts were found on disk
+        self.latencies = {}
+        self.cached = {}
+        self.bucket = None
+        self.start = None
+        self.hooks = [model.register_forward_pre_hook(self.before), model.register_forward_hook(self.after)]
+
+    def artifact_path(self, bucket):
+        return os.path.join(self.cache_dir, f"{bucket}.bin")
+
+    def before(self, model, inputs):
+        frames, output_frame_times = inputs
+        device = luma(frames[0]).device
+        self.bucket = shape_bucket(frames, output_frame_times, device)
+
+        if self.bucket not in self.latencies:
+            self.latencies[self.bucket] = []
+            self.cached[self.bucket] = self.load(self.bucket)
+
+        synchronize(device)
+        self.start = time.perf_counter()
+
+    def after(self, model, inputs, output):
+        synchronize(luma(inputs[0][0]).device)
+        latencies = self.latencies[self.bucket]
+        latencies.append(time.perf_counter() - self.start)
+
+        if len(latencies) == 1:
+            self.save(self.bucket)
+
+    def load(self, bucket):
+        """
+        Load the compile artifacts of a bucket from disk: returns whether there were any
+        """
+        path = self.artifact_path(bucket)
+        if not os.path.isfile(path) or not hasattr(torch.compiler, "load_cache_artifacts"):
+            return False
+
+        try:
+            with open(path, "rb") as f:
+                torch.compiler.load_cache_artifacts(f.read())
+            return True
+        except Exception as e:
+            print(f"Ignoring the compile cache of {bucket}: {e}")
+            return False
+
+    def save(self, bucket):
+        """
+        Save the compile artifacts of this process to the file of a bucket
+        """
+        if not hasattr(torch.compiler, "save_cache_artifacts"):
+            return
+
+        artifacts = torch.compiler.save_cache_artifacts()
+        if artifacts is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.artifact_path(bucket), "wb") as f:
+                f.write(artifacts[0])
+
+    def report(self):
+        """
+        Print the cold and warm latency of every shape bucket
+        """
+        print(f"{'shape bucket':<28}{'compile cache':>15}{'cold ms':>10}{'warm ms':>10}{'passes':>8}")
+        for bucket, latencies in self.latencies.items():
+            warm = 1e3 * sum(latencies[1:]) / (len(latencies) - 1) if len(latencies) > 1 else float("nan")
+            cache = "hit" if self.cached[bucket] else "miss"
+            print(f"{bucket:<28}{cache:>15}{1e3 * latencies[0]:>10.1f}{warm:>10.1f}{len(latencies):>8}")
+
+    def remove(self):
+        for hook in self.hooks:
+            hook.remove()
+
+
+def compile_artemis(model, mode="default", cache_dir=COMPILE_DIR):
+    """
+    Compile the encoder, the decoder and the ChronoSynth subnets of ArTEMIS with torch.compile, for inference.
+    Anything which fails to compile runs eagerly instead. Returns a CompileTracker, also kept as model.compile_tracker.
+    """
+    # Keep the Inductor caches next to the per bucket artifacts, rather than in a temporary directory
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.join(cache_dir, "inductor"))
+    # Fall back to eager for the graphs which fail to compile, instead of raising
+    torch._dynamo.config.suppress_errors = True
+
+    for module in compiled_modules(model):
+        try:
+            module.forward = torch.compile(module.forward, mode=mode, dynamic=False)
+        except Exception as e:
+            print(f"Running {type(module).__name__} eagerly, since it could not be compiled: {e}")
+
+    model.compile_tracker = CompileTracker(model, cache_dir)
+    return model.compile_tracker
+
+
+def decompile_artemis(model):
+    """
+    Restore the eager modules of a model compiled by compile_artemis
+    """
+    for module in compiled_modules(model):
+        module.__dict__.pop("forward", None)
+
+    if getattr(model, "compile_tracker", None) is not None:
+        model.compile_tracker.remove()
+        model.compile_tracker = None
@@ -19,26 +19,77 @@ data_arg.add_argument("--dataset", type=str, default="vimeo90K_septuplet")
 model_arg = add_argument_group("Model")
 model_choices = ["ArTEMIS"]
 model_arg.add_argument("--model", choices=model_choices, type=str, default="ArTEMIS")
-model_modes = ["train", "test", "interpolate_video", "interpolate_singleton"]
+model_modes = ["train", "test", "interpolate_video", "interpolate_singleton", "interpolate_batch", "export", "serve", "benchmark", "prune"]
 model_arg.add_argument("--mode", choices=model_modes, type=str, default="interpolate_video")
 model_arg.add_argument("--nbr_frame", type=int, default=4)
 model_arg.add_argument("--joinType", choices=["concat", "add", "none"], default="concat")
 model_arg.add_argument("--kernel_size", type=int, default=5)
 model_arg.add_argument("--dilation", type=int, default=1)
+model_arg.add_argument("--time_conditioning", choices=["early", "late"], type=str, default="early", help="Feed the timestep to the ChronoSynth subnets with the features (early), or modulate their output with it (late) so that most of each head is shared across timesteps.")
+model_arg.add_argument("--frame_local_encoder", action="store_true", help="Encode each frame on its own up to the first stage of the encoder, so that this prefix can be cached and reused by consecutive windows of a video.")
+model_arg.add_argument("--factorized_convs", action="store_true", help="Factorize the 3x3x3 convolutions of the encoder, decoder and SmoothNets into spatial 1x3x3 and temporal 3x1x1 convolutions.")
+model_arg.add_argument("--separable_kernels", action="store_true", help="Predict the ChronoSynth kernels as the outer product of a vertical and a horizontal factor, with one vertical offset per kernel row and one horizontal offset per kernel column.")
+model_arg.add_argument("--init_from", type=str, help="Initialize the weights for training from a pre-trained model (a training checkpoint or an exported artifact), factorizing its convolutions if needed.")
 model_arg.add_argument("--num_outputs", type=int, default=3)
 
 # Interpolation parameters
 interpolate_arg = add_argument_group("Interpolation")
 # Video interpolation
-interpolate_arg.add_argument("--model_path", type=str, help="Path to the pretrained model parameters.")
+interpolate_arg.add_argument("--model_path", type=str, help="Path to the pretrained model parameters (a training checkpoint or an exported artifact). Without it, the benchmark mode builds an untrained model.")
 interpolate_arg.add_argument("--input_path", type=str, help="Path to the input video that will be interpolated.")
 interpolate_arg.add_argument("--save_path", type=str, help="Path to save the interpolated output.")
+interpolate_arg.add_argument("--num_procs", type=int, default=1, help="Number of worker processes to split the video between.")
+interpolate_arg.add_argument("--share_weights", action=argparse.BooleanOptionalAction, help="Load the model once into shared memory for all worker processes.")
+interpolate_arg.add_argument("--input_fps", type=float, default=30, help="Frame rate of an input frame directory.")
+interpolate_arg.add_argument("--output_format", choices=["png", "exr", "jpg", "tiff"], type=str, default="png", help="Image format of an output frame directory.")
+interpolate_arg.add_argument("--io_threads", type=int, default=4, help="Number of threads decoding and encoding frames of frame directories.")
+interpolate_arg.add_argument("--cache_dir", type=str, help="Directory of a persistent cache of interpolated frames (disabled if not set).")
+interpolate_arg.add_argument("--yuv", action=argparse.BooleanOptionalAction, help="Keep the frames in YUV 4:2:0, synthesizing the chroma at quarter resolution.")
+interpolate_arg.add_argument("--cache_max_mb", type=float, default=2048, help="Maximum size of the frame cache in megabytes.")
 # Singleton interpolation
 interpolate_arg.add_argument("--frame1_path", type=str, help="Path to the first context frame.")
 interpolate_arg.add_argument("--frame2_path", type=str, help="Path to the second context frame.")
 interpolate_arg.add_argument("--frame3_path", type=str, help="Path to the third context frame.")
 interpolate_arg.add_argument("--frame4_path", type=str, help="Path to the fourth context frame.")
 interpolate_arg.add_argument("--timesteps", type=str, default="0.5", help ="Comma-separated list of timesteps from 0-1 to interpolate (e.g. '0.25, 0.5, 0.75').")
+# Exporting
+interpolate_arg.add_argument("--export_path", type=str, help="Directory to write the exported deployment artifact to.")
+interpolate_arg.add_argument("--export_dtype", choices=["fp16", "fp32"], type=str, default="fp16", help="Precision of the exported weights.")
+
+# Inference speed/quality trade-offs
+inference_arg = add_argument_group("Inference")
+inference_arg.add_argument("--output_scale", choices=["full", "mid", "low", "auto"], type=str, default="full", help="Scale at which to stop the forward pass and upsample, or 'auto' to choose it from the motion between frames.")
+inference_arg.add_argument("--motion_thresholds", type=str, default="0.01, 0.03", help="Mean absolute frame differences below which 'auto' stops at the low and mid scales.")
+inference_arg.add_argument("--proxy_scale", type=float, default=1.0, help="Below 1, run the encoder and kernel prediction on frames downscaled by this factor, and synthesize at full resolution.")
+inference_arg.add_argument("--synth_chunk_rows", type=int, help="Synthesize output frames this many rows and one context frame at a time, to cap the memory of ChronoSynth on large frames.")
+inference_arg.add_argument("--synth_topk", type=int, help="Only apply the k largest elements (by absolute weight) of each ChronoSynth kernel, for faster approximate synthesis.")
+inference_arg.add_argument("--synth_threshold", type=float, help="Only apply the elements of each ChronoSynth kernel whose absolute weight is at least this, for faster approximate synthesis.")
+inference_arg.add_argument("--token_merge_ratios", type=str, default="0", help="Fraction of the tokens of each attention window (at most 0.5) merged with similar tokens in each encoder stage, as 4 comma-separated values or one for every stage.")
+inference_arg.add_argument("--branch_threads", type=int, default=1, help="Number of threads running independent branches of the forward pass concurrently, each with an equal share of the intra-op threads.")
+inference_arg.add_argument("--compile", action=argparse.BooleanOptionalAction, help="Compile the encoder, decoder and ChronoSynth subnets with torch.compile, caching the compiled code on disk for each shape.")
+inference_arg.add_argument("--compile_mode", choices=["default", "reduce-overhead", "max-autotune"], type=str, default="default", help="The torch.compile mode of --compile.")
+inference_arg.add_argument("--synth_backend", choices=["auto", "cupy", "gather", "tiled"], type=str, default="auto", help="Implementation of the ChronoSynth synthesis, or 'auto' for the fastest one on this machine.")
+
+# Benchmarking
+bench_arg = add_argument_group("Benchmark")
+bench_arg.add_argument("--benchmark", choices=["proxy", "timesteps", "token_merging", "factorized", "sparse_synthesis", "branches", "compile"], type=str, default="proxy", help="Which speed/quality comparison to run in benchmark mode.")
+bench_arg.add_argument("--bench_samples", type=int, default=20, help="Number of samples to evaluate each variant on.")
+bench_arg.add_argument("--bench_values", type=str, help="Comma-separated values of the option compared by the benchmark (e.g. proxy scales '1.0, 0.5, 0.25', frame rate factors '4, 8', or token merge ratios '0, 0.25, 0.5').")
+
+# Pruning
+prune_arg = add_argument_group("Pruning")
+prune_arg.add_argument("--prune_heads", type=float, default=0.25, help="Fraction of the heads of every attention layer of the encoder to remove.")
+prune_arg.add_argument("--prune_mlp", type=float, default=0.25, help="Fraction of the hidden channels of every MLP of the encoder to remove.")
+prune_arg.add_argument("--prune_calib_batches", type=int, default=32, help="Number of training batches to score the heads and channels on.")
+prune_arg.add_argument("--prune_finetune_steps", type=int, default=2000, help="Number of training steps to fine-tune the pruned model for.")
+
+# Server parameters
+server_arg = add_argument_group("Server")
+server_arg.add_argument("--host", type=str, default="127.0.0.1", help="Host to serve interpolation requests on.")
+server_arg.add_argument("--port", type=int, default=8080, help="Port to serve interpolation requests on.")
+server_arg.add_argument("--socket_path", type=str, help="Serve on this Unix socket instead of a TCP port.")
+server_arg.add_argument("--max_batch", type=int, default=8, help="Maximum number of requested frames to interpolate in one forward pass.")
+server_arg.add_argument("--max_wait_ms", type=float, default=10, help="Maximum time to wait for a batch to fill up before running it.")
 
 # Training parameters
 learn_arg = add_argument_group("Learning")
@@ -65,6 +116,11 @@ misc_arg.add_argument("--num_gpu", type=int, default=1)
 misc_arg.add_argument("--random_seed", type=int, default=103)
 misc_arg.add_argument("--num_workers", type=int, default=12)
 
+# Profiling
+profile_arg = add_argument_group("Profiling")
+profile_arg.add_argument("--profile", action=argparse.BooleanOptionalAction, help="Record per-module timings, FLOPs and memory of the forward pass.")
+profile_arg.add_argument("--profile_dir", type=str, default=os.path.join(os.getcwd(), "training", "profile"), help="Directory to write the Chrome trace of the profiled modules to.")
+
 
 def get_args():
     """Parses all of the arguments above"""
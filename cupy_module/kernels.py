@@ -0,0 +1,327 @@
+import functools
+import hashlib
+import os
+import re
+from paths import CACHE_DIR
+
+
+# Generated kernel sources are kept on disk, so that other processes skip generating them
+KERNEL_CACHE_DIR = os.path.join(CACHE_DIR, "kernels")
+# Bump whenever generate_kernel changes, to invalidate the cached sources
+KERNEL_FORMAT = 1
+
+kernel_Synth_updateOutput = '''
+    extern "C" __global__ void kernel_Synth_updateOutput(
+            const int n,
+            const float* input,
+            const float* weight,
+            const float* offset_y,
+            const float* offset_x,
+            float* output,
+            const int intRowOffset
+    )
+    {
+        for (int intIndex = (blockIdx.x * blockDim.x) + threadIdx.x; intIndex < n; intIndex += blockDim.x * gridDim.x) {
+            float dblOutput = 0.0;
+
+            const int intSample = ( intIndex / SIZE_3(output) / SIZE_2(output) / SIZE_1(output) ) % SIZE_0(output);
+            const int intDepth  = ( intIndex / SIZE_3(output) / SIZE_2(output)                  ) % SIZE_1(output);
+            const int y         = ( intIndex / SIZE_3(output)                                   ) % SIZE_2(output);
+            const int x         = ( intIndex                                                    ) % SIZE_3(output);
+            // The output may be a band of rows of the full frame, which starts at row intRowOffset of the input
+            const int intInputY = y + intRowOffset;
+
+            for (int row = 0; row < F_SIZE; row += 1) {
+                for (int col = 0; col < F_SIZE; col += 1) {
+                    float w         = VALUE_4(weight, intSample, row*F_SIZE+col, y, x);
+                    float alpha     = VALUE_4(offset_y, intSample, row*F_SIZE+col, y, x);
+                    float beta      = VALUE_4(offset_x, intSample, row*F_SIZE+col, y, x);
+                    int intAlpha    = (int)alpha;
+                    int intBeta     = (int)beta;
+
+                    int bottom = CLAMP(intInputY + row*DILATION + intAlpha, 0, SIZE_2(input) - 1);
+                    int left = CLAMP(x + col*DILATION + intBeta, 0, SIZE_3(input) - 1);
+                    int top = CLAMP(intInputY + row*DILATION + intAlpha + 1, 0, SIZE_2(input) - 1);
+                    int right = CLAMP(x + col*DILATION + intBeta + 1, 0, SIZE_3(input) - 1);
+
+                    float alphaTrunc = alpha - (float)intAlpha;
+                    float betaTrunc = beta - (float)intBeta;
+
+                    dblOutput += w * (
+                        VALUE_4(input, intSample, intDepth, bottom, left)*(1 - alphaTrunc)*(1 - betaTrunc) +
+                        VALUE_4(input, intSample, intDepth, top, left)*alphaTrunc*(1 - betaTrunc) +
+                        VALUE_4(input, intSample, intDepth, bottom, right)*(1 - alphaTrunc)*betaTrunc +
+                        VALUE_4(input, intSample, intDepth, top, right)*alphaTrunc*betaTrunc
+                    );
+                }
+            }
+
+            output[intIndex] = dblOutput;
+        }
+    }
+'''
+
+kernel_Synth_updateGradWeight = '''
+    extern "C" __global__ void kernel_Synth_updateGradWeight(
+        const int n,
+        const float* gradLoss,
+        const float* input,
+        const float* offset_y,
+        const float* offset_x,
+        float* gradWeight
+    )
+    {
+        for (int intIndex = (blockIdx.x * blockDim.x) + threadIdx.x; intIndex < n; intIndex += blockDim.x * gridDim.x) {
+            float floatOutput = 0.0;
+
+            const int intSample  = ( intIndex / SIZE_3(gradWeight) / SIZE_2(gradWeight) / SIZE_1(gradWeight) ) % SIZE_0(gradWeight);
+            const int intDepth   = ( intIndex / SIZE_3(gradWeight) / SIZE_2(gradWeight)                      ) % SIZE_1(gradWeight);
+            const int y          = ( intIndex / SIZE_3(gradWeight)                                           ) % SIZE_2(gradWeight);
+            const int x          = ( intIndex                                                                ) % SIZE_3(gradWeight);
+
+            int row = intDepth / F_SIZE;
+            int col = intDepth % F_SIZE;
+
+            for (int depth = 0; depth < 3; depth++) {
+                float delta     = VALUE_4(gradLoss, intSample, depth, y, x);
+                float alpha     = VALUE_4(offset_y, intSample, row*F_SIZE+col, y, x);
+                float beta      = VALUE_4(offset_x, intSample, row*F_SIZE+col, y, x);
+                int intAlpha    = (int)alpha;
+                int intBeta     = (int)beta;
+
+                int bottom = CLAMP(y + row*DILATION + intAlpha, 0, SIZE_2(input) - 1);
+                int left = CLAMP(x + col*DILATION + intBeta, 0, SIZE_3(input) - 1);
+                int top = CLAMP(y + row*DILATION + intAlpha + 1, 0, SIZE_2(input) - 1);
+                int right = CLAMP(x + col*DILATION + intBeta + 1, 0, SIZE_3(input) - 1);
+
+                float alphaTrunc = alpha - (float)intAlpha;
+                float betaTrunc = beta - (float)intBeta;
+
+                floatOutput += delta * (
+                    VALUE_4(input, intSample, depth, bottom, left)*(1 - alphaTrunc)*(1 - betaTrunc) +
+                    VALUE_4(input, intSample, depth, top, left)*alphaTrunc*(1 - betaTrunc) +
+                    VALUE_4(input, intSample, depth, bottom, right)*(1 - alphaTrunc)*betaTrunc +
+                    VALUE_4(input, intSample, depth, top, right)*alphaTrunc*betaTrunc
+                );
+            }
+
+            gradWeight[intIndex] = floatOutput;
+        }
+    }
+'''
+
+kernel_Synth_updateGradAlpha = '''
+    extern "C" __global__ void kernel_Synth_updateGradAlpha(
+        const int n,
+        const float* gradLoss,
+        const float* input,
+        const float* weight,
+        const float* offset_y,
+        const float* offset_x,
+        float* gradOffset_y
+    )
+    {
+        for (int intIndex = (blockIdx.x * blockDim.x) + threadIdx.x; intIndex < n; intIndex += blockDim.x * gridDim.x) {
+            float floatOutput = 0.0;
+
+            const int intSample  = ( intIndex / SIZE_3(gradOffset_y) / SIZE_2(gradOffset_y) / SIZE_1(gradOffset_y) ) % SIZE_0(gradOffset_y);
+            const int intDepth   = ( intIndex / SIZE_3(gradOffset_y) / SIZE_2(gradOffset_y)                        ) % SIZE_1(gradOffset_y);
+            const int y          = ( intIndex / SIZE_3(gradOffset_y)                                               ) % SIZE_2(gradOffset_y);
+            const int x          = ( intIndex                                                                      ) % SIZE_3(gradOffset_y);
+
+            int row = intDepth / F_SIZE;
+            int col = intDepth % F_SIZE;
+
+            for (int depth = 0; depth < 3; depth++) {
+                float delta     = VALUE_4(gradLoss, intSample, depth, y, x);
+                float w         = VALUE_4(weight, intSample, row*F_SIZE + col, y, x);
+                float alpha     = VALUE_4(offset_y, intSample, row*F_SIZE + col, y, x);
+                float beta      = VALUE_4(offset_x, intSample, row*F_SIZE + col, y, x);
+                int intAlpha    = (int)alpha;
+                int intBeta     = (int)beta;
+
+                int bottom = CLAMP(y + row*DILATION + intAlpha, 0, SIZE_2(input) - 1);
+                int left = CLAMP(x + col*DILATION + intBeta, 0, SIZE_3(input) - 1);
+                int top = CLAMP(y + row*DILATION + intAlpha + 1, 0, SIZE_2(input) - 1);
+                int right = CLAMP(x + col*DILATION + intBeta + 1, 0, SIZE_3(input) - 1);
+
+                float betaTrunc = beta - (float)intBeta;
+
+                floatOutput += delta * w * (
+                    - VALUE_4(input, intSample, depth, bottom, left)*(1 - betaTrunc)
+                    + VALUE_4(input, intSample, depth, top, left)*(1 - betaTrunc)
+                    - VALUE_4(input, intSample, depth, bottom, right)*betaTrunc
+                    + VALUE_4(input, intSample, depth, top, right)*betaTrunc
+                );
+            }
+
+            gradOffset_y[intIndex] = floatOutput;
+        }
+    }
+'''
+
+kernel_Synth_updateGradBeta = '''
+    extern "C" __global__ void kernel_Synth_updateGradBeta(
+        const int n,
+        const float* gradLoss,
+        const float* input,
+        const float* weight,
+        const float* offset_y,
+        const float* offset_x,
+        float* gradOffset_x
+    )
+    {
+        for (int intIndex = (blockIdx.x * blockDim.x) + threadIdx.x; intIndex < n; intIndex += blockDim.x * gridDim.x) {
+            float floatOutput = 0.0;
+
+            const int intSample  = ( intIndex / SIZE_3(gradOffset_x) / SIZE_2(gradOffset_x) / SIZE_1(gradOffset_x) ) % SIZE_0(gradOffset_x);
+            const int intDepth   = ( intIndex / SIZE_3(gradOffset_x) / SIZE_2(gradOffset_x)                        ) % SIZE_1(gradOffset_x);
+            const int y          = ( intIndex / SIZE_3(gradOffset_x)                                               ) % SIZE_2(gradOffset_x);
+            const int x          = ( intIndex                                                                      ) % SIZE_3(gradOffset_x);
+
+            int row = intDepth / F_SIZE;
+            int col = intDepth % F_SIZE;
+
+            for (int depth = 0; depth < 3; depth++) {
+                float delta     = VALUE_4(gradLoss, intSample, depth, y, x);
+                float w         = VALUE_4(weight, intSample, row*F_SIZE + col, y, x);
+                float alpha     = VALUE_4(offset_y, intSample, row*F_SIZE + col, y, x);
+                float beta      = VALUE_4(offset_x, intSample, row*F_SIZE + col, y, x);
+                int intAlpha    = (int)alpha;
+                int intBeta     = (int)beta;
+
+                int bottom = CLAMP(y + row*DILATION + intAlpha, 0, SIZE_2(input) - 1);
+                int left = CLAMP(x + col*DILATION + intBeta, 0, SIZE_3(input) - 1);
+                int top = CLAMP(y + row*DILATION + intAlpha + 1, 0, SIZE_2(input) - 1);
+                int right = CLAMP(x + col*DILATION + intBeta + 1, 0, SIZE_3(input) - 1);
+
+                float alphaTrunc = alpha - (float)intAlpha;
+
+                floatOutput += delta * w * (
+                    - VALUE_4(input, intSample, depth, bottom, left)*(1 - alphaTrunc)
+                    - VALUE_4(input, intSample, depth, top, left)*alphaTrunc
+                    + VALUE_4(input, intSample, depth, bottom, right)*(1 - alphaTrunc)
+                    + VALUE_4(input, intSample, depth, top, right)*alphaTrunc
+                );
+            }
+
+            gradOffset_x[intIndex] = floatOutput;
+        }
+    }
+'''
+
+
+# The parameter list of a kernel
+PARAMETERS = re.compile(r'(extern "C" __global__ void \w+\()([^\)]*)(\))')
+
+
+@functools.lru_cache(maxsize=None)
+def tensor_names(strFunc):
+    """
+    Get the names of the tensor parameters of a kernel, in the order of its parameter list
+    """
+    strParams = PARAMETERS.search(globals()[strFunc]).group(2)
+    return re.findall(r'float\* (\w+)', strParams)
+
+
+def generate_kernel(strFunc, intFilterSize, intDilation):
+    """
+    Generate the source of a kernel for a filter size and dilation.
+
+    The sizes and strides of the tensors are not baked into the source. They are appended to the parameters of the
+    kernel instead (see shape_args), so that the same compiled kernel serves every shape.
+    """
+    strKernel = globals()[strFunc]
+
+    # purpose: passing the size and stride of every tensor axis at runtime
+    strShapeParams = ''.join(f',\n            const int {strTensor}_size_{intArg}, const int {strTensor}_stride_{intArg}'
+                             for strTensor in tensor_names(strFunc) for intArg in range(4))
+    strKernel = PARAMETERS.sub(lambda objMatch: objMatch.group(1) + objMatch.group(2).rstrip() + strShapeParams + '\n    ' + objMatch.group(3), strKernel, count=1)
+
+    # purpose: getting size of tensor axis
+    strKernel = re.sub(r'SIZE_([0-4])\(([^\)]*)\)', lambda objMatch: f'{objMatch.group(2).strip()}_size_{objMatch.group(1)}', strKernel)
+
+    # purpose: getting value at certain index of tensor, ex. tensor[index]
+    while True:
+        objMatch = re.search('(VALUE_)([0-4])(\()([^\)]+)(\))', strKernel)
+
+        if objMatch is None:
+            break
+
+        intArgs = int(objMatch.group(2))
+        strArgs = objMatch.group(4).split(',')
+
+        strTensor = strArgs[0].strip()
+        strIndex = ['((' + strArgs[intArg + 1].replace('{', '(').replace('}', ')').strip() + ')*' + f'{strTensor}_stride_{intArg})' for intArg in range(intArgs)]
+
+        strKernel = strKernel.replace(objMatch.group(0), strTensor + '[' + str.join('+', strIndex) + ']')
+
+    # purpose: integer clamp a given value to the range [0, upperBound]
+    while True: 
+        objMatch = re.search('(CLAMP)(\()([^\)]*)(\))', strKernel)
+
+        if objMatch is None: 
+            break
+
+        strArgs = objMatch.group(3).split(',')
+        
+        assert (len(strArgs) == 3)
+
+        strValue, strLowerBound, strUpperBound = strArgs
+        strReplacement = f"min(max({strValue}, {strLowerBound}), {strUpperBound})"
+
+        strKernel = strKernel.replace(objMatch.group(0), strReplacement)
+
+    # setting macros
+    strKernel = strKernel.replace('F_SIZE', str(intFilterSize))
+    strKernel = strKernel.replace('DILATION', str(intDilation))
+
+    return strKernel
+
+
+@functools.lru_cache(maxsize=None)
+def kernel_source(strFunc, intFilterSize, intDilation, strCacheDir=KERNEL_CACHE_DIR):
+    """
+    Get the source of a kernel for a filter size and dilation, generating it only once per process and machine.
+    Cached sources are named after a hash of the kernel template, so that editing a kernel invalidates them.
+    """
+    strHash = hashlib.sha256(f'{KERNEL_FORMAT}:{globals()[strFunc]}'.encode()).hexdigest()[:16]
+    strPath = os.path.join(strCacheDir, f'{strFunc}_f{intFilterSize}_d{intDilation}_{strHash}.cu')
+
+    try:
+        with open(strPath, 'r') as f:
+            return f.read()
+    except OSError:
+        # Not cached yet, or the cache directory is unusable
+        pass
+
+    strKernel = generate_kernel(strFunc, intFilterSize, intDilation)
+
+    # Write to a temporary file first, so that concurrent readers never see a partial source
+    try:
+        os.makedirs(strCacheDir, exist_ok=True)
+        strTemporaryPath = f'{strPath}.{os.getpid()}.tmp'
+        with open(strTemporaryPath, 'w') as f:
+            f.write(strKernel)
+        os.replace(strTemporaryPath, strPath)
+    except OSError:
+        # A read-only cache only costs regenerating the source in the next process
+        pass
+
+    return strKernel
+
+
+def shape_args(strFunc, objVars):
+    """
+    Get the sizes and strides of the tensors passed to a kernel, in the order of its shape parameters.
+    The kernels take them as int32, so tensors whose sizes or strides do not fit are rejected.
+    """
+    intArgs = []
+    for strTensor in tensor_names(strFunc):
+        objTensor = objVars[strTensor]
+        for intArg in range(4):
+            intArgs += [objTensor.size(intArg), objTensor.stride(intArg)]
+
+    if any(not -2 ** 31 <= intArg < 2 ** 31 for intArg in intArgs):
+        raise ValueError(f"The shapes passed to {strFunc} do not fit in int32: {intArgs}")
+    return intArgs
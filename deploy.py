@@ -0,0 +1,260 @@
+import hashlib
+import json
+import os
+import torch
+from model.artemis import ArTEMIS
+from model.helper_modules import factorize_weights
+from model.branches import BranchPool
+
+
+# Command line arguments which determine the architecture of ArTEMIS
+MODEL_CONFIG_KEYS = ["nbr_frame", "joinType", "kernel_size", "dilation", "time_conditioning", "frame_local_encoder", "pruned_sizes", "factorized_convs", "separable_kernels"]
+# Values of the model config for checkpoints which predate a command line argument
+MODEL_CONFIG_DEFAULTS = {"time_conditioning": "early", "frame_local_encoder": False, "pruned_sizes": None, "factorized_convs": False, "separable_kernels": False}
+MANIFEST_NAME = "manifest.json"
+WEIGHTS_NAME = "weights.pt"
+EXPORT_DTYPES = {"fp16": torch.float16, "fp32": torch.float32}
+
+
+def read_checkpoint(checkpoint_path):
+    """
+    Read the ArTEMIS weights and model config out of a full Lightning training checkpoint,
+    without building the Lightning module, its optimizer or its loss.
+
+    Returns:
+    - state_dict: the weights of the bare ArTEMIS model
+    - model_config: the command line arguments that determine the architecture
+    """
+    # Training checkpoints pickle the command line arguments, so they cannot be loaded with weights_only
+    checkpoint = torch.load(checkpoint_path, map_location="cpu", mmap=True, weights_only=False)
+
+    # The Lightning module stores ArTEMIS under the 'model' attribute
+    prefix = "model."
+    state_dict = {key[len(prefix):]: value for key, value in checkpoint["state_dict"].items() if key.startswith(prefix)}
+
+    cmd_line_args = vars(checkpoint["hyper_parameters"]["cmd_line_args"])
+    model_config = {key: cmd_line_args.get(key, MODEL_CONFIG_DEFAULTS.get(key)) for key in MODEL_CONFIG_KEYS}
+
+    return state_dict, model_config
+
+
+def export_artifact(checkpoint_path, export_dir, dtype="fp16"):
+    """
+    Write a weights-only deployment artifact from a training checkpoint:
+    - weights.pt: the ArTEMIS state dict, with floating point tensors cast to the given dtype
+    - manifest.json: the model config and a description of the weights
+    """
+    state_dict, model_config = read_checkpoint(checkpoint_path)
+    return write_artifact(state_dict, model_config, export_dir, dtype)
+
+
+def write_artifact(state_dict, model_config, export_dir, dtype="fp16"):
+    """
+    Write the weights of an ArTEMIS model and its model config to a deployment artifact
+    """
+    torch_dtype = EXPORT_DTYPES[dtype]
+
+    # Integer buffers (e.g. relative position indices) keep their dtype
+    state_dict = {key: value.to(torch_dtype) if value.is_floating_point() else value for key, value in state_dict.items()}
+
+    os.makedirs(export_dir, exist_ok=True)
+    weights_path = os.path.join(export_dir, WEIGHTS_NAME)
+    torch.save(state_dict, weights_path)
+
+    with open(weights_path, "rb") as f:
+        weights_hash = hashlib.sha256(f.read()).hexdigest()
+
+    manifest = {
+        "model": "ArTEMIS",
+        "config": model_config,
+        "dtype": dtype,
+        "weights": WEIGHTS_NAME,
+        "weights_sha256": weights_hash,
+        "num_parameters": sum(value.numel() for key, value in state_dict.items() if value.is_floating_point()),
+    }
+
+    with open(os.path.join(export_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    print(f"Exported {dtype} weights to: ", export_dir)
+    return manifest
+
+
+def is_artifact(path):
+    """
+    Whether a path points to an exported artifact (its directory or its manifest) rather than a training checkpoint
+    """
+    if os.path.isdir(path):
+        return os.path.isfile(os.path.join(path, MANIFEST_NAME))
+    return os.path.basename(path) == MANIFEST_NAME
+
+
+def read_manifest(path):
+    """
+    Read the manifest of an exported artifact, given its directory or the manifest itself
+    """
+    manifest_path = os.path.join(path, MANIFEST_NAME) if os.path.isdir(path) else path
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    manifest["root"] = os.path.dirname(os.path.abspath(manifest_path))
+    return manifest
+
+
+def artifact_id(path):
+    """
+    Get an ID which identifies the weights of a model: the hash recorded in the manifest of an exported artifact,
+    or the hash of a training checkpoint file
+    """
+    if is_artifact(path):
+        return read_manifest(path)["weights_sha256"]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(2**24), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_artemis(model_config, device="meta"):
+    """
+    Build a bare ArTEMIS model for a model config, with its parameters left unallocated on the meta device,
+    or randomly initialized on another device
+    """
+    with torch.device(device):
+        return ArTEMIS(num_inputs=model_config["nbr_frame"], joinType=model_config["joinType"],
+                       kernel_size=model_config["kernel_size"], dilation=model_config["dilation"],
+                       time_conditioning=model_config.get("time_conditioning", MODEL_CONFIG_DEFAULTS["time_conditioning"]),
+                       frame_local_encoder=model_config.get("frame_local_encoder", MODEL_CONFIG_DEFAULTS["frame_local_encoder"]),
+                       pruned_sizes=model_config.get("pruned_sizes", MODEL_CONFIG_DEFAULTS["pruned_sizes"]),
+                       factorized_convs=model_config.get("factorized_convs", MODEL_CONFIG_DEFAULTS["factorized_convs"]),
+                       separable_kernels=model_config.get("separable_kernels", MODEL_CONFIG_DEFAULTS["separable_kernels"]))
+
+
+def set_token_merge_ratios(model, ratios):
+    """
+    Set the fraction of tokens merged in the attention windows of each encoder stage, given as a list of 4 ratios or 1 for every stage
+    """
+    stages = [model.encoder.stage1, model.encoder.stage2, model.encoder.stage3, model.encoder.stage4]
+    if len(ratios) == 1:
+        ratios = ratios * len(stages)
+
+    for stage, ratio in zip(stages, ratios):
+        for block in stage.upper.blocks:
+            block.merge_ratio = ratio
+
+
+def set_branch_threads(model, num_threads):
+    """
+    Run the independent branches of the forward pass on a pool of this many threads, or one after the other for 1
+    """
+    if model.branch_pool is not None:
+        model.branch_pool.shutdown()
+
+    model.branch_pool = BranchPool(num_threads) if num_threads > 1 else None
+    for head in (model.predict1, model.predict2, model.predict3):
+        head.branch_pool = model.branch_pool
+
+
+def configure_inference(model, args):
+    """
+    Apply the inference options given on the command line to a loaded ArTEMIS model
+    """
+    model.output_scale = args.output_scale
+    model.motion_thresholds = tuple(float(t) for t in "".join(args.motion_thresholds.split()).split(","))
+    model.proxy_scale = args.proxy_scale
+    set_token_merge_ratios(model, [float(r) for r in "".join(args.token_merge_ratios.split()).split(",")])
+    set_branch_threads(model, args.branch_threads)
+    if args.compile:
+        from compilation import compile_artemis
+        compile_artemis(model, args.compile_mode)
+    for head in (model.predict1, model.predict2, model.predict3):
+        head.chunk_rows = args.synth_chunk_rows
+        head.synth_backend = args.synth_backend
+        head.synth_topk = args.synth_topk
+        head.synth_threshold = args.synth_threshold
+    return model
+
+
+def inference_signature(args):
+    """
+    Describe the inference options which change the output of a model, e.g. to tell apart cached frames
+    """
+    return (f"output_scale={args.output_scale},motion_thresholds={args.motion_thresholds},proxy_scale={args.proxy_scale},"
+            f"token_merge_ratios={args.token_merge_ratios},synth_topk={args.synth_topk},synth_threshold={args.synth_threshold}")
+
+
+def read_weights(path):
+    """
+    Read the ArTEMIS weights and model config of either an exported artifact or a training checkpoint
+    """
+    if is_artifact(path):
+        manifest = read_manifest(path)
+        weights_path = os.path.join(manifest["root"], manifest["weights"])
+        state_dict = torch.load(weights_path, map_location="cpu", mmap=True, weights_only=True)
+        return state_dict, manifest["config"]
+
+    return read_checkpoint(path)
+
+
+def load_artemis(path, device, args=None, factorize=False):
+    """
+    Load a bare ArTEMIS model for inference from either an exported artifact or a training checkpoint.
+    If command line arguments are given, their inference options are applied to the model.
+    If factorize, the model is built with (2+1)D convolutions, which are initialized from full 3D convolutions by truncated SVD.
+
+    Artifact weights are memory-mapped and assigned to the model directly, so fp32 weights on the CPU
+    are never copied. fp16 weights are upcast to fp32, since the synthesis kernels only support fp32.
+    """
+    state_dict, model_config = read_weights(path)
+    if factorize:
+        model_config = dict(model_config, factorized_convs=True)
+
+    model = build_artemis(model_config)
+    state_dict = factorize_weights(model, state_dict)
+    model.load_state_dict(state_dict, assign=True)
+    model = model.float().to(device)
+    model.eval()
+
+    if args is not None:
+        configure_inference(model, args)
+
+    return model
+
+
+def init_artemis(device, args):
+    """
+    Build an untrained ArTEMIS model for inference, with the architecture given on the command line and random weights,
+    e.g. to measure the speed of a variant before training it. The inference options of the arguments are applied to it.
+    """
+    model_config = {key: getattr(args, key, MODEL_CONFIG_DEFAULTS.get(key)) for key in MODEL_CONFIG_KEYS}
+    model = build_artemis(model_config, device="cpu").float().to(device)
+    model.eval()
+    return configure_inference(model, args)
+
+
+def share_model(model, frame_size=None):
+    """
+    Move the weights and buffers of a CPU model into shared memory, so that worker processes can attach
+    to them read-only instead of loading their own copy.
+
+    If the size (height, width) of the input frames is known, the attention masks of every encoder stage
+    are also precomputed and moved into shared memory.
+
+    Returns:
+    - model: the shared model
+    - masks: a dictionary of shared attention masks, to be passed to model.sep_sts_layer.install_masks
+    """
+    # A pool of threads or compiled code cannot be sent to the worker processes, which start their own
+    set_branch_threads(model, 1)
+    if getattr(model, "compile_tracker", None) is not None:
+        from compilation import decompile_artemis
+        decompile_artemis(model)
+    model.share_memory()
+
+    masks = {}
+    if frame_size is not None:
+        height, width = frame_size
+        masks = model.encoder.attention_masks(model.num_inputs, height, width, "cpu")
+        masks = {key: mask.share_memory_() for key, mask in masks.items()}
+
+    return model, masks
@@ -0,0 +1,114 @@
+import hashlib
+import os
+import numpy as np
+import torch
+
+
+class FrameCache:
+    """
+    A persistent cache of interpolated frames on disk, keyed by a hash of the context frames, the timestep
+    and the ID of the model that interpolated them.
+
+    Frames are stored compressed as fp16, one file per frame. Whenever the cache grows beyond max_bytes,
+    the least recently used frames are evicted until it is back under 90% of its cap.
+    """
+    def __init__(self, directory, model_id, max_bytes):
+        self.directory = directory
+        self.model_id = model_id
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+        # Scan the cache once, and keep track of its size from then on
+        self.size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self):
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith(".npz"):
+                    yield os.path.join(root, name)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.npz")
+
+    @staticmethod
+    def frame_digest(frame):
+        """
+        Hash the contents of a single context frame, so that each frame only needs to be hashed once
+        """
+        array = frame.detach().cpu().contiguous().numpy()
+        digest = hashlib.sha256(str(array.shape).encode())
+        digest.update(array.tobytes())
+        return digest.hexdigest()
+
+    def key(self, frame_digests, timestep):
+        """
+        Get the cache key of the frame interpolated at a timestep from context frames with the given digests
+        """
+        digest = hashlib.sha256(self.model_id.encode())
+        digest.update(f"{float(timestep):.6f}".encode())
+        for frame_digest in frame_digests:
+            digest.update(frame_digest.encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """
+        Get a cached frame as a tensor of shape (1, 3, H, W), or None on a miss
+        """
+        path = self._path(key)
+        try:
+            with np.load(path) as data:
+                frame = torch.from_numpy(data["frame"].astype(np.float32))
+        except (FileNotFoundError, OSError, ValueError, KeyError):
+            self.misses += 1
+            return None
+
+        # Mark the frame as recently used
+        os.utime(path)
+        self.hits += 1
+        return frame
+
+    def put(self, key, frame):
+        """
+        Store an interpolated frame, evicting the least recently used frames if the cache grows too large
+        """
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        # Write to a temporary file first, so that concurrent readers never see a partial frame
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as f:
+            np.savez_compressed(f, frame=frame.detach().cpu().numpy().astype(np.float16))
+        # The frame may overwrite an entry (e.g. a window interpolated by two workers at once), whose size is no longer used
+        try:
+            replaced_size = os.path.getsize(path)
+        except FileNotFoundError:
+            replaced_size = 0
+        os.replace(temporary_path, path)
+
+        self.size += os.path.getsize(path) - replaced_size
+        if self.size > self.max_bytes:
+            self.evict(int(0.9 * self.max_bytes))
+
+    def evict(self, target_bytes):
+        """
+        Delete the least recently used frames until the cache holds at most target_bytes
+        """
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.size <= target_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self.size -= size
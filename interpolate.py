@@ -0,0 +1,253 @@
+import os
+import torch
+from collections import deque
+from tqdm import tqdm
+from deploy import load_artemis
+from profiler import ModuleProfiler
+from utils import read_image, save_image, read_video, frame_to_tensor, frame_to_yuv, list_image_sequence, read_image_sequence, VideoWriter, ImageSequenceWriter
+
+
+def start_profiling(model, args):
+    """
+    Attach a ModuleProfiler to an ArTEMIS model if profiling was requested
+    """
+    return ModuleProfiler(model) if args.profile else None
+
+
+def finish_profiling(profiler, args, name):
+    """
+    Print the per-module summary and write the Chrome trace of a profiled run
+    """
+    if profiler is None:
+        return
+
+    profiler.print_summary()
+    trace_path = os.path.join(args.profile_dir, f"{name}_trace.json")
+    profiler.export_chrome_trace(trace_path)
+    profiler.remove()
+    print("Saved profiling trace to: ", trace_path)
+
+
+def open_cache(args):
+    """
+    Open the cache of interpolated frames, if one was requested
+    """
+    if not args.cache_dir:
+        return None
+
+    from deploy import artifact_id, inference_signature
+    from frame_cache import FrameCache
+
+    # Frames interpolated with different inference options are cached separately
+    model_id = f"{artifact_id(args.model_path)}:{inference_signature(args)}"
+    return FrameCache(args.cache_dir, model_id, max_bytes=int(args.cache_max_mb * 2**20))
+
+
+def to_device(frame, device):
+    """
+    Move a frame to a device: a tensor, or the planes of a YUV 4:2:0 frame
+    """
+    if isinstance(frame, tuple):
+        return tuple(plane.to(device) for plane in frame)
+    return frame.to(device)
+
+
+def interpolate_window(model, context_frames, device, cache=None, frame_digests=None):
+    """
+    Interpolate a frame in the exact center of a window of 4 frames: returns a tensor of shape (1, 3, H, W),
+    or a YUV 4:2:0 frame for YUV context frames.
+    If a cache is given, the frame is looked up by the digests of the context frames before running the model.
+    """
+    if cache is not None:
+        key = cache.key(frame_digests, 0.5)
+        cached_frame = cache.get(key)
+        if cached_frame is not None:
+            return cached_frame.to(device)
+
+    # Interpolate in the exact center of the 4 frames
+    interpolated_frame_time = torch.tensor([0.5]).to(device)
+    with torch.no_grad():
+        _, _, out_batch = model(context_frames, interpolated_frame_time)
+
+    if isinstance(out_batch, tuple):
+        return tuple(plane[0:1] for plane in out_batch)
+
+    if cache is not None:
+        cache.put(key, out_batch[0:1])
+
+    return out_batch[0:1]
+
+
+def interpolate_windows(model, frames, device, progress=True, cache=None):
+    """
+    Interpolate a frame in the exact center of every window of 4 consecutive frames:
+    returns len(frames) - 3 interpolated frames, each of shape (3, H, W)
+    """
+    interpolated_frames = []
+    frame_digests = [cache.frame_digest(frame) for frame in frames] if cache is not None else None
+
+    # Each frame is moved to the device once, and shared by the windows which contain it
+    # (so that a frame-local encoder can reuse its cached prefix)
+    window = deque((frame.to(device) for frame in frames[:3]), maxlen=4)
+
+    # Iterate through every window of 4 frames
+    with tqdm(range(len(frames) - 3), desc="Interpolating frames", disable=not progress) as pbar:
+        for i in pbar:
+            # Extract the 4 frames and interpolate the frame between them
+            window.append(frames[i+3].to(device))
+            context_frames = list(window)
+            window_digests = frame_digests[i:i+4] if cache is not None else None
+            interpolated_frame = interpolate_window(model, context_frames, device, cache, window_digests)
+
+            # Extract the output frame
+            interpolated_frames.append(interpolated_frame[0])
+
+    return interpolated_frames
+
+
+def interpolate_stream(model, frames, device, cache=None):
+    """
+    Interpolate a frame in the exact center of every pair of consecutive frames of a stream:
+    yields the input frames interleaved with the interpolated frames, each of shape (1, 3, H, W).
+
+    Frames may be given as tensors, as YUV 4:2:0 frames, or as RGB arrays, which are only converted once they enter the window of 4 frames.
+    """
+    window = deque(maxlen=4)
+    window_digests = deque(maxlen=4)
+
+    def interpolate():
+        return interpolate_window(model, list(window), device, cache, list(window_digests))
+
+    for frame in frames:
+        if not isinstance(frame, (torch.Tensor, tuple)):
+            frame = frame_to_tensor(frame)
+        frame = to_device(frame, device)
+        frame_digest = cache.frame_digest(frame) if cache is not None else None
+
+        # Duplicate the first input frame
+        if not window:
+            window.append(frame)
+            window_digests.append(frame_digest)
+        window.append(frame)
+        window_digests.append(frame_digest)
+
+        if len(window) == 4:
+            yield window[1]
+            yield interpolate()
+
+    if len(window) < 3:
+        raise ValueError("At least 2 frames are needed to interpolate a video")
+
+    # Duplicate the last input frame
+    window.append(window[-1])
+    window_digests.append(window_digests[-1])
+    yield window[1]
+    yield interpolate()
+    yield window[2]
+
+
+def open_output(save_path, frame_rate, args):
+    """
+    Open a writer for the output of interpolate_video: an mp4 file, or a frame directory if the save path has no extension
+    """
+    if os.path.splitext(save_path)[1]:
+        return VideoWriter(save_path, frame_rate)
+    return ImageSequenceWriter(save_path, extension=args.output_format, num_threads=args.io_threads)
+
+
+def interpolate_video(args):
+    """
+    Run an interpolation on a video of frames: 
+    By default, generates a frame between each pair of input frames.
+    The input can be a video file or a directory of frames, and so can the output.
+    With --yuv, the frames are kept in YUV 4:2:0 from the input to the output.
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    if args.yuv and (args.num_procs > 1 or args.cache_dir):
+        raise ValueError("--yuv cannot be combined with --num_procs or --cache_dir")
+    # The worker processes run their own copy of the model, which the profiler of this process cannot see
+    if args.profile and args.num_procs > 1:
+        raise ValueError("--profile cannot be combined with --num_procs")
+
+    # Frame directories are decoded ahead of the model by a pool of threads
+    if os.path.isdir(args.input_path):
+        num_input_frames = len(list_image_sequence(args.input_path))
+        input_frames = read_image_sequence(args.input_path, num_threads=args.io_threads)
+        input_frame_rate = args.input_fps
+        if args.yuv:
+            input_frames = map(frame_to_yuv, input_frames)
+    else:
+        input_frames, input_frame_rate = read_video(args.input_path, yuv=args.yuv)
+        num_input_frames = len(input_frames)
+
+    writer = open_output(args.save_path, input_frame_rate * 2, args)
+
+    if args.num_procs > 1:
+        # Split the windows into chunks which are interpolated by a pool of worker processes
+        from parallel import interpolate_windows_parallel
+        input_frames = [frame if isinstance(frame, torch.Tensor) else frame_to_tensor(frame) for frame in input_frames]
+
+        # Duplicate the first and last input frames
+        padded_frames = [input_frames[0]] + input_frames + [input_frames[-1]]
+        interpolated_frames = interpolate_windows_parallel(args, padded_frames, device)
+
+        if args.compile:
+            print("The workers compiled their models, but only a single process reports the cold and warm latency of --compile")
+
+        # Alternate between the input and output frames
+        for i in range(len(interpolated_frames)):
+            writer.write(input_frames[i])
+            writer.write(interpolated_frames[i])
+
+        writer.write(input_frames[-1])
+    else:
+        # Load the pre-trained model, and write each frame as soon as it is ready
+        model = load_artemis(args.model_path, device, args)
+        profiler = start_profiling(model, args)
+        cache = open_cache(args)
+
+        with tqdm(total=2 * num_input_frames - 1, desc="Interpolating frames") as pbar:
+            for frame in interpolate_stream(model, input_frames, device, cache):
+                writer.write(frame)
+                pbar.update(1)
+
+        finish_profiling(profiler, args, "interpolate_video")
+
+        if args.compile:
+            model.compile_tracker.report()
+
+        if cache is not None:
+            print(f"Frame cache: {cache.hits} hits, {cache.misses} misses")
+
+    writer.close()
+    print("Saved video to: ", args.save_path)
+
+
+def interpolate_singleton(args):
+    """
+    Generate interpolated frames between a single set of four context frames.
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    # Load the pre-trained model
+    model = load_artemis(args.model_path, device, args)
+    profiler = start_profiling(model, args)
+
+    # Read in the context frames
+    paths = [args.frame1_path, args.frame2_path, args.frame3_path, args.frame4_path]
+    context_frames = [read_image(path).to(device) for path in paths]
+
+    # Run the forward pass of the model to generate the interpolated frames
+    timesteps = "".join(args.timesteps.split()).split(",")
+    timesteps = [float(t) for t in timesteps]
+
+    # Interpolate every timestep in one forward pass, which shares the encoder (and the bulk of late time conditioning)
+    with torch.no_grad():
+        outputs = model(context_frames, [torch.tensor([t]).to(device) for t in timesteps])
+
+    for timestep, (_, _, out_batch) in zip(timesteps, outputs):
+        # Save the interpolated frame
+        save_image(out_batch[0], f"frame_t={timestep}.png", args.save_path)
+
+    finish_profiling(profiler, args, "interpolate_singleton")
@@ -0,0 +1,99 @@
+import os
+import lightning as L
+from torch.optim import Adamax
+from torch.optim.lr_scheduler import MultiStepLR
+from model.artemis import ArTEMIS
+from loss import Loss
+from metrics import eval_metrics
+from profiler import ModuleProfiler
+from utils import save_images
+
+
+class ArTEMISModel(L.LightningModule):
+    def __init__(self, cmd_line_args):
+        super().__init__()
+        # Call this to save command line arguments to checkpoints
+        self.save_hyperparameters()
+        # Initialize instance variables
+        self.args = cmd_line_args
+        self.model = ArTEMIS(num_inputs=self.args.nbr_frame, joinType=self.args.joinType, kernel_size=self.args.kernel_size, dilation=self.args.dilation,
+                             time_conditioning=self.args.time_conditioning, frame_local_encoder=self.args.frame_local_encoder,
+                             factorized_convs=self.args.factorized_convs, separable_kernels=self.args.separable_kernels)
+        if self.args.init_from:
+            self.init_from(self.args.init_from)
+        self.optimizer = Adamax(self.model.parameters(), lr=self.args.lr, betas=(self.args.beta1, self.args.beta2))
+        self.loss = Loss(self.args)
+        self.validation = eval_metrics
+        # Optionally time each module of the forward pass
+        self.profiler = ModuleProfiler(self.model) if getattr(self.args, "profile", False) else None
+
+    def init_from(self, path):
+        """
+        Initialize the weights of ArTEMIS from a pre-trained model, whose full 3D convolutions are factorized by truncated SVD
+        if this model has (2+1)D convolutions
+        """
+        from deploy import read_weights
+        from model.helper_modules import factorize_weights
+
+        state_dict, _ = read_weights(path)
+        self.model.load_state_dict(factorize_weights(self.model, state_dict))
+
+    def forward(self, images, output_frame_times):
+        """
+        Run a forward pass of the model:
+        images: a list of 4 tensors, each of shape (batch_size, 3, 256, 256)
+        output_frame_times: a batch of time steps: (batch_size, 1)
+        """
+        return self.model(images, output_frame_times)
+
+    def training_step(self, batch, batch_idx):
+        images, gt_image, output_frame_times = batch
+
+        output = self(images, output_frame_times)
+        loss = self.loss(output, gt_image)
+
+        # every collection of batches, save the outputs
+        if batch_idx % self.args.log_iter == 0:
+            save_images(output, gt_image, batch_idx, images, self.args.output_dir, epoch_index = self.current_epoch)
+ 
+        # log metrics for each step
+        learning_rate = self.trainer.lr_scheduler_configs[0].scheduler.optimizer.param_groups[0]["lr"]
+        self.log('train_loss', loss, on_step=True, on_epoch=True, prog_bar=True, logger=True)
+        self.log('lr', learning_rate, on_step=False, on_epoch=True, prog_bar=True, logger=True)
+
+        # every collection of batches, report where the time of the forward pass went
+        if self.profiler is not None and batch_idx % self.args.log_iter == 0:
+            self.profiler.log_to_tensorboard(self.logger, self.global_step)
+            self.profiler.export_chrome_trace(os.path.join(self.args.profile_dir, "train_trace.json"))
+            self.profiler.reset()
+
+        return loss
+
+    def test_step(self, batch, batch_idx):
+        images, gt_image, output_frame_times = batch
+        output = self.model(images, output_frame_times)
+        loss = self.loss(output, gt_image)
+        psnr, ssim = self.validation(output, gt_image)
+
+        # log metrics for each step
+        self.log_dict({'test_loss': loss, 'psnr': psnr, 'ssim': ssim})
+
+        if batch_idx % self.args.log_iter == 0:
+            save_images(output, gt_image, batch_idx, images, self.args.output_dir, testing=True)
+
+            if self.profiler is not None:
+                self.profiler.log_to_tensorboard(self.logger, batch_idx)
+                self.profiler.export_chrome_trace(os.path.join(self.args.profile_dir, "test_trace.json"))
+                self.profiler.reset()
+        
+        # return metrics dictionary
+        return {'loss': loss, 'psnr': psnr, 'ssim': ssim}
+    
+    def configure_optimizers(self):
+        training_schedule = [40, 60, 75, 85, 95, 100] 
+        return {
+            "optimizer": self.optimizer,
+            "lr_scheduler": {
+                "scheduler": MultiStepLR(optimizer = self.optimizer, milestones = training_schedule, gamma = 0.5),
+            }
+        }
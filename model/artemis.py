@@ -2,11 +2,42 @@ import torch
 import torch.nn as nn
 from model.sep_sts_encoder import ResBlock, SepSTSEncoder
 from model.chrono_synth import ChronoSynth
-from model.helper_modules import upSplit, joinTensors, Conv_3d
+from model.helper_modules import upSplit, joinTensors, Conv_3d, chroma_size, yuv_to_rgb
+from model.branches import fork
+
+
+# Output scales at which inference can stop: the scale of predict1, predict2 or predict3
+OUTPUT_SCALES = ["low", "mid", "full"]
+
+
+def luma(frame):
+    """
+    The luma of a YUV 4:2:0 frame given as a (luma, chroma) pair, or an RGB frame itself
+    """
+    return frame[0] if isinstance(frame, tuple) else frame
+
+
+def resize_output(frame, size):
+    """
+    Bilinearly resize an RGB frame, or the planes of a YUV 4:2:0 frame, to the given (luma) size
+    """
+    if isinstance(frame, tuple):
+        return (nn.functional.interpolate(frame[0], size=size, mode='bilinear'),
+                nn.functional.interpolate(frame[1], size=chroma_size(size), mode='bilinear'))
+    return nn.functional.interpolate(frame, size=size, mode='bilinear')
+
+
+def add_outputs(frame, other):
+    """
+    Add two RGB frames, or the planes of two YUV 4:2:0 frames
+    """
+    if isinstance(frame, tuple):
+        return tuple(plane + other_plane for plane, other_plane in zip(frame, other))
+    return frame + other
 
 
 class ArTEMIS(nn.Module):
-    def __init__(self, num_inputs=4, joinType="concat", kernel_size=5, dilation=1): 
+    def __init__(self, num_inputs=4, joinType="concat", kernel_size=5, dilation=1, output_scale="full", motion_thresholds=(0.01, 0.03), proxy_scale=1.0, synth_chunk_rows=None, synth_backend="auto", time_conditioning="early", frame_local_encoder=False, pruned_sizes=None, factorized_convs=False, separable_kernels=False): 
         super().__init__()
         # num_features = [192, 128, 64, 32] # For small model with ~7 million parameters
         num_features = [512, 256, 128, 64] # For large model with ~30 million parameters
@@ -15,24 +46,37 @@ class ArTEMIS(nn.Module):
         num_heads = [2, 4, 8, 16]  # For Multi-Head Attention
         self.joinType = joinType
         self.num_inputs = num_inputs
+        # One of OUTPUT_SCALES, or "auto" to choose the scale from the motion between the frames
+        self.output_scale = output_scale
+        self.motion_thresholds = motion_thresholds
+        # Below 1, the encoder and the ChronoSynth subnets run on frames downscaled by this factor (proxy inference)
+        self.proxy_scale = proxy_scale
+        # For inference, a model.branches.BranchPool which runs the SmoothNets of the scales concurrently with the decoder
+        self.branch_pool = None
 
         growth = 2 if joinType == "concat" else 1
         self.lrelu = nn.LeakyReLU(0.2, inplace=True)
 
+        # With a frame-local encoder, the prefix of the encoder (up to stage1) of each frame is cached at inference,
+        # and reused by the next windows which contain the frame: a list of (frame, version, proxy scale, x0, x1)
+        self.frame_local_encoder = frame_local_encoder
+        self.prefix_cache = []
+
         self.encoder = SepSTSEncoder(
-            num_features, num_inputs, spatial_window_sizes, num_heads)
+            num_features, num_inputs, spatial_window_sizes, num_heads, frame_local=frame_local_encoder, factorized=factorized_convs)
 
+        # With factorized_convs, the 3x3x3 convolutions of the encoder, decoder and SmoothNets are (2+1)D convolutions
         self.decoder = nn.Sequential(
-            upSplit(num_features[0], num_features[1]),
-            upSplit(num_features[1]*growth, num_features[2]),
-            upSplit(num_features[2]*growth, num_features[3]),
+            upSplit(num_features[0], num_features[1], factorized=factorized_convs),
+            upSplit(num_features[1]*growth, num_features[2], factorized=factorized_convs),
+            upSplit(num_features[2]*growth, num_features[3], factorized=factorized_convs),
         )
 
         def SmoothNet(in_channels, out_channels):
             return nn.Sequential(
                 Conv_3d(in_channels, out_channels, kernel_size=3,
-                        stride=1, padding=1, batchnorm=False),
-                ResBlock(out_channels, kernel_size=3),
+                        stride=1, padding=1, batchnorm=False, factorized=factorized_convs),
+                ResBlock(out_channels, kernel_size=3, factorized=factorized_convs),
             )
 
         num_features_out = 64
@@ -41,50 +85,178 @@ class ArTEMIS(nn.Module):
         self.smooth3 = SmoothNet(num_features[3]*growth, num_features_out)
 
         self.predict1 = ChronoSynth(
-            num_inputs, num_features_out, kernel_size, dilation, apply_softmax=True)
+            num_inputs, num_features_out, kernel_size, dilation, apply_softmax=True, chunk_rows=synth_chunk_rows, synth_backend=synth_backend, time_conditioning=time_conditioning, separable=separable_kernels)
         self.predict2 = ChronoSynth(
-            num_inputs, num_features_out, kernel_size, dilation, apply_softmax=False)
+            num_inputs, num_features_out, kernel_size, dilation, apply_softmax=False, chunk_rows=synth_chunk_rows, synth_backend=synth_backend, time_conditioning=time_conditioning, separable=separable_kernels)
         self.predict3 = ChronoSynth(
-            num_inputs, num_features_out, kernel_size, dilation, apply_softmax=False)
-        
+            num_inputs, num_features_out, kernel_size, dilation, apply_softmax=False, chunk_rows=synth_chunk_rows, synth_backend=synth_backend, time_conditioning=time_conditioning, separable=separable_kernels)
+
+        # A pruned model keeps the first heads or hidden channels of some attention and MLP layers of the encoder:
+        # a dictionary of module name -> number of heads or hidden channels
+        for name, size in (pruned_sizes or {}).items():
+            self.get_submodule(name).prune(list(range(size)))
+
+    def select_output_scale(self, frames):
+        """
+        Choose the output scale from the mean absolute difference between the two frames surrounding the output frame:
+        "low" below the first motion threshold, "mid" below the second one and "full" otherwise.
+        Every sample of the batch uses the scale needed by the sample with the most motion.
+        """
+        if self.output_scale != "auto":
+            return self.output_scale
+
+        # The motion of YUV 4:2:0 frames is measured on their luma
+        before, after = luma(frames[self.num_inputs // 2 - 1]), luma(frames[self.num_inputs // 2])
+        motion = (after - before).abs().flatten(1).mean(1).max().item()
+
+        if motion < self.motion_thresholds[0]:
+            return "low"
+        if motion < self.motion_thresholds[1]:
+            return "mid"
+        return "full"
+
+    def downscale(self, frame):
+        """
+        Downscale a frame by the proxy scale, for the encoder. YUV 4:2:0 frames are converted to RGB first.
+        """
+        if isinstance(frame, tuple):
+            frame = yuv_to_rgb(*frame)
+        if self.proxy_scale < 1:
+            return nn.functional.interpolate(frame, scale_factor=self.proxy_scale, mode='bilinear', align_corners=False, antialias=True)
+        return frame
+
+    def encode(self, frames):
+        """
+        Compute the latent representation of the frames: returns x0, x1, x2, x3 and x4
+        """
+        if not self.frame_local_encoder:
+            images = torch.stack([self.downscale(frame) for frame in frames], dim=2)
+
+            # Batch mean normalization works slightly better than global mean normalization (hence the repeated calls to .mean() below)
+            mean_ = images.mean(2, keepdim=True).mean(
+                3, keepdim=True).mean(4, keepdim=True)
+            images = images - mean_
+
+            return self.encoder(images)
+
+        # Cached prefixes have no gradients, so they are only used at inference
+        use_cache = not self.training and not torch.is_grad_enabled()
+        prefixes = list(self.prefix_cache) if use_cache else []
+
+        def lookup(frame):
+            for cached_frame, version, proxy_scale, x0, x1 in prefixes:
+                if cached_frame is frame and version == luma(frame)._version and proxy_scale == self.proxy_scale:
+                    return x0, x1
+            return None
+
+        # The frames which are not cached (each only once, as the first and last frames of a video are repeated)
+        missing = []
+        for frame in frames:
+            if lookup(frame) is None and not any(frame is other for other in missing):
+                missing.append(frame)
+
+        if missing:
+            images = torch.stack([self.downscale(frame) for frame in missing], dim=2)
+            B, C, M, H, W = images.shape
+
+            # Each frame is normalized by its own mean, so that its prefix does not depend on the other frames of the window
+            images = images - images.mean(3, keepdim=True).mean(4, keepdim=True)
+
+            # Encode the missing frames at once, folded into the batch
+            images = images.transpose(1, 2).reshape(B * M, C, 1, H, W)
+            x0, x1 = self.encoder.prefix(images)
+            x0 = x0.view(B, M, *x0.shape[1:])
+            x1 = x1.view(B, M, *x1.shape[1:])
+
+            new_prefixes = [(frame, luma(frame)._version, self.proxy_scale, x0[:, i], x1[:, i]) for i, frame in enumerate(missing)]
+            prefixes += new_prefixes
+            if use_cache:
+                # Keep the most recent frames: a sliding window only needs the frames of the previous window
+                self.prefix_cache = (self.prefix_cache + new_prefixes)[-self.num_inputs:]
+
+        x0, x1 = zip(*[lookup(frame) for frame in frames])
+        return self.encoder.suffix(torch.cat(x0, 2), torch.cat(x1, 2))
+
     def forward(self, frames, output_frame_times):
         '''
         Performs the forward pass for each output frame needed, a number of times equal to num_outputs.
         Returns the interpolated frames as a list of outputs: [interp1, interp2, interp3, ...]
         frames: input frames
-        output_frame_times: batch of arbitrary 't' from 0 to 1
+        output_frame_times: batch of arbitrary 't' from 0 to 1, or a list of such batches.
+        For a list, the outputs are returned for each batch of timesteps, and everything up to the ChronoSynth heads
+        (and with late time conditioning, most of the heads too) is only computed once.
+
+        If the output scale is "low" or "mid", the forward pass stops after predict1 or predict2,
+        and the remaining outputs are bilinearly upsampled from the last one computed.
+
+        If the proxy scale is below 1, the latent representation and the kernels are computed on downscaled frames,
+        and the upsampled kernels are applied to the full resolution frames.
+
+        With a branch pool, independent branches (the SmoothNets, the subnets of each ChronoSynth head and the synthesis
+        of each context frame) run concurrently on its threads.
+
+        With a frame-local encoder, the prefix of the encoder is cached for the most recent frames at inference,
+        so that a sliding window of frames only encodes its new frame up to stage1. Frames are matched by identity:
+        each frame should be passed as the same tensor (on the model's device) to every window which contains it.
+
+        The frames may also be YUV 4:2:0 frames, given as (luma, chroma) pairs of shape (B, 1, H, W) and (B, 2, H/2, W/2):
+        the encoder sees them in RGB, but the ChronoSynth heads synthesize the planes directly, so that the chroma
+        is synthesized at a quarter of the resolution. The outputs are then YUV 4:2:0 frames too.
         '''
-        images = torch.stack(frames, dim=2)
-        # Sanity check that the input frames are in the correct shape
-        B, C, T, H, W = images.shape
+        output_scale = self.select_output_scale(frames)
 
-        # Batch mean normalization works slightly better than global mean normalization (hence the repeated calls to .mean() below)
-        mean_ = images.mean(2, keepdim=True).mean(
-            3, keepdim=True).mean(4, keepdim=True)
-        images = images - mean_
+        # The sizes at which each ChronoSynth head synthesizes frames (the sizes of x2, x1 and x0 at full resolution)
+        synth_sizes = [None, None, None]
+        size = tuple(luma(frames[0]).shape[-2:])
+        for i in reversed(range(3)):
+            synth_sizes[i] = size
+            # Each down convolution of the encoder halves the spatial size (rounding up)
+            size = tuple((s - 1) // 2 + 1 for s in size)
 
         # Only need to generate latent representation once
-        x0, x1, x2, x3, x4 = self.encoder(images)
+        x0, x1, x2, x3, x4 = self.encode(frames)
 
         dx3 = self.lrelu(self.decoder[0](x4, x3.size()))
         dx3 = joinTensors(dx3, x3, type=self.joinType)
 
-        dx2 = self.lrelu(self.decoder[1](dx3, x2.size()))
-        dx2 = joinTensors(dx2, x2, type=self.joinType)
+        # The ChronoSynth heads interpolate every timestep from the same features
+        timesteps = output_frame_times if isinstance(output_frame_times, list) else [output_frame_times]
+
+        def outputs(*scales):
+            results = list(zip(*scales))
+            return results if isinstance(output_frame_times, list) else results[0]
+
+        # The SmoothNets of the scales are independent of each other: with a branch pool,
+        # each one runs while the decoder upsamples the features of the next scale
+        low_scale_features = fork(self.branch_pool, self.smooth1, dx3)
+
+        if output_scale != "low":
+            dx2 = self.lrelu(self.decoder[1](dx3, x2.size()))
+            dx2 = joinTensors(dx2, x2, type=self.joinType)
+            mid_scale_features = fork(self.branch_pool, self.smooth2, dx2)
+
+        if output_scale == "full":
+            dx1 = self.lrelu(self.decoder[2](dx2, x1.size()))
+            dx1 = joinTensors(dx1, x1, type=self.joinType)
+            high_scale_features = fork(self.branch_pool, self.smooth3, dx1)
 
-        dx1 = self.lrelu(self.decoder[2](dx2, x1.size()))
-        dx1 = joinTensors(dx1, x1, type=self.joinType)
+        outs_ll = self.predict1(low_scale_features.result(), frames, x2.size()[-2:], timesteps, synth_sizes[0])
 
-        low_scale_features = self.smooth1(dx3)
-        mid_scale_features = self.smooth2(dx2)
-        high_scale_features = self.smooth3(dx1)
+        if output_scale == "low":
+            outs_l = [resize_output(curr_out_ll, synth_sizes[1]) for curr_out_ll in outs_ll]
+            outs = [resize_output(curr_out_ll, synth_sizes[2]) for curr_out_ll in outs_ll]
+            return outputs(outs_ll, outs_l, outs)
 
-        curr_out_ll = self.predict1(low_scale_features, frames, x2.size()[-2:], output_frame_times)
+        outs_l = self.predict2(mid_scale_features.result(), frames, x1.size()[-2:], timesteps, synth_sizes[1])
+        outs_l = [add_outputs(resize_output(curr_out_ll, luma(curr_out_l).shape[-2:]), curr_out_l)
+                  for curr_out_ll, curr_out_l in zip(outs_ll, outs_l)]
 
-        curr_out_l = self.predict2(mid_scale_features, frames, x1.size()[-2:], output_frame_times)
-        curr_out_l = nn.functional.interpolate(curr_out_ll, size=curr_out_l.size()[-2:], mode='bilinear') + curr_out_l
+        if output_scale == "mid":
+            outs = [resize_output(curr_out_l, synth_sizes[2]) for curr_out_l in outs_l]
+            return outputs(outs_ll, outs_l, outs)
 
-        curr_out = self.predict3(high_scale_features, frames, x0.size()[-2:], output_frame_times)
-        curr_out = nn.functional.interpolate(curr_out_l, size=curr_out.size()[-2:], mode='bilinear') + curr_out
+        outs = self.predict3(high_scale_features.result(), frames, x0.size()[-2:], timesteps, synth_sizes[2])
+        outs = [add_outputs(resize_output(curr_out_l, luma(curr_out).shape[-2:]), curr_out)
+                for curr_out_l, curr_out in zip(outs_l, outs)]
 
-        return curr_out_ll, curr_out_l, curr_out
+        return outputs(outs_ll, outs_l, outs)
@@ -0,0 +1,72 @@
+import contextvars
+import threading
+import torch
+from concurrent.futures import Future, ThreadPoolExecutor
+
+
+class BranchPool:
+    """
+    A pool of threads which runs independent branches of the forward pass concurrently,
+    e.g. the subnets of a ChronoSynth head or the synthesis of each context frame.
+
+    PyTorch operators release the GIL, so on the CPU the small convolutions of a batch of 1, which do not keep
+    every core busy on their own, can overlap. Each thread of the pool gets an equal share of the intra-op threads
+    of the process, so that the branches do not oversubscribe the cores.
+    """
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self.local = threading.local()
+        intra_op_threads = max(1, torch.get_num_threads() // num_threads)
+
+        def initialize():
+            torch.set_num_threads(intra_op_threads)
+            self.local.worker = True
+
+        self.pool = ThreadPoolExecutor(max_workers=num_threads, thread_name_prefix="branch", initializer=initialize)
+
+    def fork(self, fn, *args):
+        """
+        Start running fn(*args) on the pool: returns a future of its result
+        """
+        # Branches forked from a branch run inline, so that they never wait on a thread of their own pool
+        if getattr(self.local, "worker", False):
+            return completed(fn, *args)
+
+        # Gradient mode is local to each thread
+        grad_enabled = torch.is_grad_enabled()
+        # The branch runs in a copy of the context of the caller, e.g. so that a ModuleProfiler charges it to the running modules
+        context = contextvars.copy_context()
+
+        def branch():
+            with torch.set_grad_enabled(grad_enabled):
+                return fn(*args)
+
+        return self.pool.submit(context.run, branch)
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+
+def completed(fn, *args):
+    """
+    Run fn(*args) right away: returns a future of its result
+    """
+    future = Future()
+    future.set_result(fn(*args))
+    return future
+
+
+def fork(pool, fn, *args):
+    """
+    Start running fn(*args) on a BranchPool, or run it right away without one: returns a future of its result
+    """
+    return completed(fn, *args) if pool is None else pool.fork(fn, *args)
+
+
+def run_branches(pool, *branches):
+    """
+    Run independent branches, given as (fn, *args) tuples, on a BranchPool (or one after the other without one),
+    and return their results in order
+    """
+    futures = [fork(pool, *branch) for branch in branches]
+    return [future.result() for future in futures]
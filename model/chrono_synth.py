@@ -1,13 +1,61 @@
 import torch
 import torch.nn as nn
-from model.helper_modules import MySequential, Conv_2d
+from model.helper_modules import MySequential, Conv_2d, chroma_size
+from model.synth_backends import synthesize, synthesize_separable
+from model.branches import run_branches
+
+
+# Each output row of a ChronoSynth subnet depends on the features at most this many rows away (at half its resolution)
+SUBNET_HALO = 4
+# The number of layers of a ChronoSynth subnet up to (and including) its transposed convolution
+SUBNET_TRUNK_LAYERS = 5
+
+
+def subnet_band(subnet, features, output_size, start, end):
+    """
+    Compute rows start:end of subnet(features, output_size) from a band of the features,
+    with enough rows around it that the result is the same as for the whole frame
+    """
+    feature_H = features.size(-2)
+    H, W = output_size
+
+    first = max(0, start // 2 - SUBNET_HALO)
+    last = min(feature_H, (end + 1) // 2 + SUBNET_HALO)
+
+    # The transposed convolution doubles the rows of the band, and the last band keeps the odd row of the frame
+    band_H = H - 2 * first if last == feature_H else 2 * (last - first)
+    output = subnet(features[..., first:last, :], (band_H, W))
+    return output[..., start - 2 * first:end - 2 * first, :]
+
+
+def band_source_rows(in_H, out_H, start, end):
+    """
+    Get the rows of an image of height in_H which are sampled by rows start:end of its bilinear upsampling to out_H,
+    along with the interpolation weight of the second row
+    """
+    # Same source coordinates as nn.functional.interpolate with align_corners=False
+    source = ((torch.arange(start, end, dtype=torch.float32) + 0.5) * (in_H / out_H) - 0.5).clamp(min=0)
+    top = source.floor().long().clamp(max=in_H - 1)
+    bottom = (top + 1).clamp(max=in_H - 1)
+    return top, bottom, source - top
+
+
+def upsample_band(band, first, top, bottom, lambdas, size):
+    """
+    Bilinearly upsample rows of an image to the given width, given the rows sampled by band_source_rows.
+    band holds the rows of the image from the row first onwards.
+    """
+    lambdas = lambdas.to(band.device).view(-1, 1)
+    rows = band[..., top - first, :] * (1 - lambdas) + band[..., bottom - first, :] * lambdas
+    return nn.functional.interpolate(rows, size=size, mode='bilinear', align_corners=False)
 
 
 class ChronoSynth(nn.Module):
-    def __init__(self, num_inputs, num_features, kernel_size, dilation, apply_softmax=True):
+    def __init__(self, num_inputs, num_features, kernel_size, dilation, apply_softmax=True, chunk_rows=None, synth_backend="auto", time_conditioning="early", separable=False):
         super(ChronoSynth, self).__init__()
 
-        num_features_with_time = num_features + 1
+        # With late time conditioning, the time is only fed to the subnets after their heavy convolutions (see forward_late)
+        num_features_with_time = num_features + 1 if time_conditioning == "early" else num_features
         # Subnetwork to learn vertical and horizontal offsets during convolution
         def Subnet_offset(kernel_size):
             return MySequential(
@@ -23,6 +71,12 @@ class ChronoSynth(nn.Module):
                     in_channels=kernel_size, out_channels=kernel_size, kernel_size=3, stride=1, padding=1)
             )
 
+        # Separable kernels are normalized by normalizing their vertical and horizontal factors
+        def Softmax():
+            if separable:
+                return nn.Sequential(nn.Unflatten(1, (2, kernel_size)), nn.Softmax(2), nn.Flatten(1, 2))
+            return nn.Softmax(1)
+
         # Subnetwork to learn weights for each pixel in the kernel
         def Subnet_weight(kernel_size):
             return MySequential(
@@ -36,7 +90,7 @@ class ChronoSynth(nn.Module):
                     kernel_size, kernel_size, kernel_size=3, stride=2, padding=1),
                 nn.Conv2d(
                     in_channels=kernel_size, out_channels=kernel_size, kernel_size=3, stride=1, padding=1),
-                nn.Softmax(1) if apply_softmax else nn.Identity()
+                Softmax() if apply_softmax else nn.Identity()
             )
 
         # Subnetwork to learn occlusion masks
@@ -59,72 +113,331 @@ class ChronoSynth(nn.Module):
         self.kernel_size = kernel_size
         self.kernel_pad = int(((kernel_size - 1) * dilation) / 2.0)
         self.dilation = dilation
+        # For inference, synthesize this many rows of the output frame at a time, one context frame at a time
+        self.chunk_rows = chunk_rows
+        # One of model.synth_backends.SYNTH_BACKENDS, or "auto" for the fastest one on this machine
+        self.synth_backend = synth_backend
+        # For inference, only apply the synth_topk largest elements of each kernel, and/or those above synth_threshold
+        self.synth_topk = None
+        self.synth_threshold = None
+        # Whether the weights of each kernel add up to 1, which sparse synthesis preserves
+        self.normalized = apply_softmax
+        # For inference, a model.branches.BranchPool which runs the subnets, and the synthesis of each context frame, concurrently
+        self.branch_pool = None
 
         self.modulePad = nn.ReplicationPad2d(
             [self.kernel_pad, self.kernel_pad, self.kernel_pad, self.kernel_pad])
 
-        import cupy_module.synth as synth
-        self.moduleSynth = synth.FunctionSynth.apply
+        # With separable kernels, the weights of each kernel are the outer product of a vertical and a horizontal factor,
+        # and its vertical offsets (alphas) only depend on its row and its horizontal offsets (betas) on its column
+        self.separable = separable
+        weight_channels = 2 * kernel_size if separable else kernel_size ** 2
+        offset_channels = kernel_size if separable else kernel_size ** 2
+        self.moduleSynth = synthesize_separable if separable else synthesize
 
-        self.ModuleWeight = Subnet_weight(kernel_size ** 2)
-        self.ModuleAlpha = Subnet_offset(kernel_size ** 2)
-        self.ModuleBeta = Subnet_offset(kernel_size ** 2)
+        self.ModuleWeight = Subnet_weight(weight_channels)
+        self.ModuleAlpha = Subnet_offset(offset_channels)
+        self.ModuleBeta = Subnet_offset(offset_channels)
         self.ModuleOcclusion = Subnet_occlusion()
 
         self.feature_fuse = Conv_2d(
             num_features_with_time * num_inputs, num_features_with_time, kernel_size=1, stride=1, batchnorm=False, bias=True)
         self.lrelu = nn.LeakyReLU(0.2)
 
-    def forward(self, features, frames, output_size, output_frame_times):
+        # "early" feeds the time to every subnet with the features, "late" modulates the output of their trunks (FiLM)
+        self.time_conditioning = time_conditioning
+        if time_conditioning == "late":
+            # Map the time difference of each context frame to a (gamma, beta) for the trunks of its weights, alphas and betas
+            self.film_channels = [weight_channels, weight_channels, offset_channels, offset_channels, offset_channels, offset_channels]
+            self.ModuleKernelFilm = nn.Sequential(
+                nn.Linear(1, num_features), nn.LeakyReLU(0.2), nn.Linear(num_features, sum(self.film_channels)))
+            # Map the time differences of all context frames to a (gamma, beta) for the trunk of the occlusion masks
+            self.ModuleOcclusionFilm = nn.Sequential(
+                nn.Linear(num_inputs, num_features), nn.LeakyReLU(0.2), nn.Linear(num_features, 2 * num_features))
+
+            # Start out without any modulation
+            for film in (self.ModuleKernelFilm, self.ModuleOcclusionFilm):
+                nn.init.zeros_(film[-1].weight)
+                nn.init.zeros_(film[-1].bias)
+
+    def sparsity(self):
         """
-        output_frame_times: batch of arbitrary 't' from 0 to 1
-        We create the time scalar from the dimensions of the input feature 
+        Get the keyword arguments of moduleSynth for sparse synthesis, which only applies at inference and to full kernels
         """
-        H, W = output_size
+        if (self.synth_topk is None and self.synth_threshold is None) or self.separable or torch.is_grad_enabled():
+            return {}
+        return {"topk": self.synth_topk, "threshold": self.synth_threshold, "renormalize": self.normalized}
 
-        B, C, T, cur_H, cur_W = features.shape
+    def resize_kernels(self, weights, alphas, betas, occlusion, synth_size, mode='bilinear'):
+        """
+        Resize kernels to the resolution at which frames are synthesized: upsample kernels predicted at a reduced (proxy) resolution,
+        or downsample them (with mode='area') for the chroma planes of YUV 4:2:0 frames.
+        The offsets are measured in pixels, so they are rescaled along with the resolution.
+        """
+        B, T, _, H, W = weights.shape
+        synth_H, synth_W = synth_size
+        options = {"align_corners": False} if mode == 'bilinear' else {}
 
-        # Create a tensor which will add 1 extra channel representing the time of context frames
-        time_tensor = torch.ones((B, 1, T, cur_H, cur_W)).to(features.device)
+        def resize(x):
+            x = nn.functional.interpolate(x.reshape(B, -1, H, W), size=synth_size, mode=mode, **options)
+            return x.view(B, T, -1, synth_H, synth_W)
+
+        weights = resize(weights)
+        alphas = resize(alphas) * (synth_H / H)
+        betas = resize(betas) * (synth_W / W)
+        occlusion = nn.functional.interpolate(occlusion, size=synth_size, mode=mode, **options)
+        return weights, alphas, betas, occlusion
 
+    def time_differences(self, output_frame_times, B, T):
+        """
+        Get the absolute time differences between each context frame and the output frame, of shape (B, T)
+        """
         # NOTE: For training, since we are using the septuplet dataset, our frame times are -0.25, 0, 1, 1.25
 
         # -------------------------------------------------------------------------------------------
         context_frame_times = [-0.25, 0, 1, 1.25]
         # Example: goes from -1, 0, 1, 2 for T = 4
         start, end = -T//2 + 1, T//2 + 1
-        for i in range(start, end):
-            time_differences = torch.abs(context_frame_times[i] - output_frame_times)
-            time_tensor[:, :, i - start, :, :] *= time_differences.view(B, 1, 1, 1)
+        differences = [torch.abs(context_frame_times[i] - output_frame_times).view(B) for i in range(start, end)]
         # -------------------------------------------------------------------------------------------
 
+        return torch.stack(differences, 1).float()
+
+    def film(self, time_differences):
+        """
+        Get the (gamma, beta) with which late time conditioning modulates each subnet:
+        those of the weights, alphas and betas of shape (B*T, K, 1, 1), and those of the occlusion of shape (B, C, 1, 1)
+        """
+        B, T = time_differences.shape
+        kernel_film = self.ModuleKernelFilm(time_differences.view(B*T, 1)).view(B*T, -1, 1, 1).split(self.film_channels, 1)
+        occlusion_film = self.ModuleOcclusionFilm(time_differences).view(B, 2, -1, 1, 1)
+        return {
+            "weight": kernel_film[0:2],
+            "alpha": kernel_film[2:4],
+            "beta": kernel_film[4:6],
+            "occlusion": (occlusion_film[:, 0], occlusion_film[:, 1]),
+        }
+
+    def split(self, subnet):
+        """
+        Split a subnet into its trunk and its head, once, so that every forward pass reuses the same modules (e.g. once compiled)
+        """
+        # A plain dictionary, so that the parts are not registered as submodules a second time
+        parts = self.__dict__.setdefault("subnet_parts", {})
+        if subnet not in parts:
+            parts[subnet] = (subnet[:SUBNET_TRUNK_LAYERS], subnet[SUBNET_TRUNK_LAYERS:])
+        return parts[subnet]
+
+    def trunk(self, subnet):
+        # The layers of a subnet up to (and including) its transposed convolution
+        return self.split(subnet)[0]
+
+    def head(self, subnet):
+        # The layers of a subnet after its transposed convolution
+        return self.split(subnet)[1]
+
+    def modulated(self, subnet, film):
+        """
+        Get a subnet whose trunk output is scaled and shifted by film = (gamma, beta), for late time conditioning
+        """
+        if film is None:
+            return subnet
+
+        gamma, beta = film
+        trunk, head = self.trunk(subnet), self.head(subnet)
+        return lambda x, output_size: head(trunk(x, output_size) * (1 + gamma) + beta, output_size)
+
+    def forward(self, features, frames, output_size, output_frame_times, synth_size=None):
+        """
+        output_frame_times: batch of arbitrary 't' from 0 to 1, or a list of such batches to get a list of frames
+        synth_size: if given, the kernels predicted at output_size are upsampled to synth_size,
+        and the frames are synthesized at synth_size instead (used for proxy inference)
+        """
+        timesteps = output_frame_times if isinstance(output_frame_times, list) else [output_frame_times]
+
+        if self.time_conditioning == "late":
+            outputs = self.forward_late(features, frames, output_size, timesteps, synth_size)
+        else:
+            outputs = [self.forward_early(features, frames, output_size, times, synth_size) for times in timesteps]
+
+        return outputs if isinstance(output_frame_times, list) else outputs[0]
+
+    def forward_early(self, features, frames, output_size, output_frame_times, synth_size=None):
+        """
+        We create the time scalar from the dimensions of the input feature, and feed it to every subnet
+        """
+        H, W = output_size
+
+        B, C, T, cur_H, cur_W = features.shape
+
+        # Create a tensor which will add 1 extra channel representing the time of context frames
+        time_tensor = self.time_differences(output_frame_times, B, T).view(B, 1, T, 1, 1).expand(B, 1, T, cur_H, cur_W)
+
         # Concatenate the time tensor to the channel dimension of the features
-        features = torch.cat([features, time_tensor], 1)
+        features = torch.cat([features, time_tensor.to(features.device)], 1)
         occ = torch.cat(torch.unbind(features, 1), 1)
         occ = self.lrelu(self.feature_fuse(occ))
 
         # Reshape the features so that the synthesis module can solely utilize CxHxW
         features = features.transpose(1, 2).reshape(B*T, C + 1, cur_H, cur_W)
+
+        if self.chunk_rows is not None and not torch.is_grad_enabled() and not isinstance(frames[0], tuple):
+            return self.forward_chunked(features.view(B, T, C + 1, cur_H, cur_W), occ, frames, output_size, synth_size)
+
+        # The subnets are independent of each other
+        weights, alphas, betas, occlusion = run_branches(
+            self.branch_pool, (self.ModuleWeight, features, (H, W)), (self.ModuleAlpha, features, (H, W)),
+            (self.ModuleBeta, features, (H, W)), (self.ModuleOcclusion, occ, (H, W)))
+
         # Recover the temporal dimension
-        weights = self.ModuleWeight(features, (H, W)).view(B, T, -1, H, W)
-        alphas = self.ModuleAlpha(features, (H, W)).view(B, T, -1, H, W)
-        betas = self.ModuleBeta(features, (H, W)).view(B, T, -1, H, W)
-        occlusion = self.ModuleOcclusion(occ, (H, W)) 
-
-        warp = []
-        for i in range(self.num_inputs):
-            weight = weights[:, i].contiguous()
-            alpha = alphas[:, i].contiguous()
-            beta = betas[:, i].contiguous()
-            occ = occlusion[:, i:i+1] 
-            frame = nn.functional.interpolate(
-                frames[i], size=weight.size()[-2:], mode='bilinear')
-
-            warp.append(
-                occ *
-                self.moduleSynth(self.modulePad(frame),
-                                  weight, alpha, beta, self.dilation)
-            )
+        weights = weights.view(B, T, -1, H, W)
+        alphas = alphas.view(B, T, -1, H, W)
+        betas = betas.view(B, T, -1, H, W)
+
+        return self.synthesize_frame(weights, alphas, betas, occlusion, frames, synth_size)
+
+    def forward_late(self, features, frames, output_size, timesteps, synth_size=None):
+        """
+        The subnets run on the features alone up to their transposed convolutions, once for every timestep.
+        The time differences then only scale and shift the output of each trunk (FiLM) before the last convolution.
+        """
+        H, W = output_size
+
+        B, C, T, cur_H, cur_W = features.shape
+
+        occ = torch.cat(torch.unbind(features, 1), 1)
+        occ = self.lrelu(self.feature_fuse(occ))
+
+        # Reshape the features so that the synthesis module can solely utilize CxHxW
+        features = features.transpose(1, 2).reshape(B*T, C, cur_H, cur_W)
+
+        if self.chunk_rows is not None and not torch.is_grad_enabled() and not isinstance(frames[0], tuple):
+            return [self.forward_chunked(features.view(B, T, C, cur_H, cur_W), occ, frames, output_size, synth_size,
+                                         self.film(self.time_differences(times, B, T).to(features.device)))
+                    for times in timesteps]
+
+        # Everything up to the transposed convolutions is independent of the timestep (and of the other subnets)
+        weight_trunk, alpha_trunk, beta_trunk, occlusion_trunk = run_branches(
+            self.branch_pool, (self.trunk(self.ModuleWeight), features, (H, W)), (self.trunk(self.ModuleAlpha), features, (H, W)),
+            (self.trunk(self.ModuleBeta), features, (H, W)), (self.trunk(self.ModuleOcclusion), occ, (H, W)))
+
+        outputs = []
+        for output_frame_times in timesteps:
+            film = self.film(self.time_differences(output_frame_times, B, T).to(features.device))
+
+            def modulate(subnet, trunk, name):
+                gamma, beta = film[name]
+                return self.head(subnet)(trunk * (1 + gamma) + beta, (H, W))
+
+            weights, alphas, betas, occlusion = run_branches(
+                self.branch_pool, (modulate, self.ModuleWeight, weight_trunk, "weight"), (modulate, self.ModuleAlpha, alpha_trunk, "alpha"),
+                (modulate, self.ModuleBeta, beta_trunk, "beta"), (modulate, self.ModuleOcclusion, occlusion_trunk, "occlusion"))
+
+            # Recover the temporal dimension
+            weights = weights.view(B, T, -1, H, W)
+            alphas = alphas.view(B, T, -1, H, W)
+            betas = betas.view(B, T, -1, H, W)
+
+            outputs.append(self.synthesize_frame(weights, alphas, betas, occlusion, frames, synth_size))
+
+        return outputs
+
+    def synthesize_frame(self, weights, alphas, betas, occlusion, frames, synth_size=None):
+        """
+        Apply the kernels of every context frame to it, and blend the warped frames with the occlusion masks.
 
-        framet = sum(warp)
+        The frames are either RGB tensors, or (luma, chroma) pairs of YUV 4:2:0 frames. The luma is synthesized
+        at the resolution of the kernels, and the chroma at half of it, with kernels downsampled to match.
+        Returns a frame of the same kind.
+        """
+        H, W = weights.shape[-2:]
+        if synth_size is not None and tuple(synth_size) != (H, W):
+            weights, alphas, betas, occlusion = self.resize_kernels(weights, alphas, betas, occlusion, synth_size)
+
+        if not isinstance(frames[0], tuple):
+            return self.synthesize_planes(weights, alphas, betas, occlusion, frames)
+
+        chroma_kernels = self.resize_kernels(weights, alphas, betas, occlusion, chroma_size(weights.shape[-2:]), mode='area')
+        luma, chroma = run_branches(self.branch_pool,
+                                    (self.synthesize_planes, weights, alphas, betas, occlusion, [frame[0] for frame in frames]),
+                                    (self.synthesize_planes, *chroma_kernels, [frame[1] for frame in frames]))
+        return luma, chroma
+
+    def synthesize_planes(self, weights, alphas, betas, occlusion, planes):
+        """
+        Synthesize one plane (of any number of channels) of the output frame at the resolution of the kernels,
+        from the same plane of every context frame
+        """
+        B, T, _, synth_H, synth_W = weights.shape
+
+        def warp(planes, weights, alphas, betas):
+            planes = nn.functional.interpolate(planes, size=(synth_H, synth_W), mode='bilinear')
+            return self.moduleSynth(self.modulePad(planes),
+                                    weights.reshape(-1, weights.shape[-3], synth_H, synth_W).contiguous(),
+                                    alphas.reshape(-1, alphas.shape[-3], synth_H, synth_W).contiguous(),
+                                    betas.reshape(-1, betas.shape[-3], synth_H, synth_W).contiguous(), self.dilation, 0, self.synth_backend,
+                                    **self.sparsity())
+
+        if self.branch_pool is None:
+            # Fold the context frames into the batch, so that every frame is resized, padded and synthesized at once
+            warped = warp(torch.stack(planes, 1).flatten(0, 1), weights, alphas, betas).view(B, T, -1, synth_H, synth_W)
+        else:
+            # Synthesize each context frame in a branch of its own
+            warped = torch.stack(run_branches(self.branch_pool, *[(warp, planes[t], weights[:, t], alphas[:, t], betas[:, t]) for t in range(T)]), 1)
+
+        # Weigh each warped context frame by its occlusion mask, and add them up
+        framet = (occlusion.unsqueeze(2) * warped).sum(1)
         return framet
+
+    def forward_chunked(self, features, occ, frames, output_size, synth_size=None, film=None):
+        """
+        Synthesize the output frame in bands of self.chunk_rows rows, one context frame at a time,
+        accumulating into a single output frame in place.
+
+        Only the kernels of one band of one context frame are held in memory at any time,
+        rather than the kernels of every context frame over the whole frame.
+        The result is the same as for the whole frame at once.
+
+        film: the modulation of each subnet with late time conditioning (see self.film)
+        """
+        B, T = features.shape[:2]
+        H, W = output_size
+        synth_H, synth_W = synth_size if synth_size is not None else output_size
+        upsampled = (synth_H, synth_W) != (H, W)
+
+        def frame_film(name, i):
+            # The FiLM parameters of the kernels are given for every context frame of every sample
+            if film is None:
+                return None
+            return tuple(x.view(B, T, -1, 1, 1)[:, i] for x in film[name])
+
+        # The context frames are small next to their kernels, so prepare them once
+        padded_frames = [self.modulePad(nn.functional.interpolate(frame, size=(synth_H, synth_W), mode='bilinear')).contiguous() for frame in frames]
+        output = features.new_zeros(B, 3, synth_H, synth_W)
+
+        for start in range(0, synth_H, self.chunk_rows):
+            end = min(start + self.chunk_rows, synth_H)
+
+            if upsampled:
+                # Predict the rows of the kernels that are sampled when upsampling them to the band (see resize_kernels)
+                top, bottom, lambdas = band_source_rows(H, synth_H, start, end)
+                first, last = int(top[0]), int(bottom[-1]) + 1
+
+                def predict(subnet, x, scale=1.0):
+                    band = subnet_band(subnet, x, (H, W), first, last)
+                    return upsample_band(band, first, top, bottom, lambdas, (end - start, synth_W)) * scale
+            else:
+                def predict(subnet, x, scale=1.0):
+                    return subnet_band(subnet, x, (H, W), start, end)
+
+            occlusion = predict(self.modulated(self.ModuleOcclusion, film and film["occlusion"]), occ)
+
+            for i in range(self.num_inputs):
+                weight = predict(self.modulated(self.ModuleWeight, frame_film("weight", i)), features[:, i]).contiguous()
+                alpha = predict(self.modulated(self.ModuleAlpha, frame_film("alpha", i)), features[:, i], synth_H / H).contiguous()
+                beta = predict(self.modulated(self.ModuleBeta, frame_film("beta", i)), features[:, i], synth_W / W).contiguous()
+
+                warped = self.moduleSynth(padded_frames[i], weight, alpha, beta, self.dilation, start, self.synth_backend, **self.sparsity())
+                output[:, :, start:end].addcmul_(occlusion[:, i:i+1], warped)
+
+        return output
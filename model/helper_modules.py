@@ -2,11 +2,119 @@ import torch
 import torch.nn as nn
 
 
+def chroma_size(size):
+    """
+    Get the size of the chroma planes of a YUV 4:2:0 frame, given the size (height, width) of its luma plane
+    """
+    return tuple((s + 1) // 2 for s in size)
+
+
+def yuv_to_rgb(luma, chroma):
+    """
+    Convert a YUV 4:2:0 frame (as decoded by OpenCV: BT.601 with limited range) to RGB at the resolution of its luma:
+    luma of shape (B, 1, H, W) and chroma (U and V) of shape (B, 2, H/2, W/2), all in the range 0-1
+    """
+    chroma = nn.functional.interpolate(chroma, size=luma.shape[-2:], mode='bilinear', align_corners=False) - 128 / 255
+    y = 1.164 * (luma - 16 / 255)
+    u, v = chroma[:, 0:1], chroma[:, 1:2]
+    return torch.cat([y + 1.596 * v, y - 0.391 * u - 0.813 * v, y + 2.018 * u], 1)
+
+
+def factorize_kernel(kernel, rank):
+    """
+    Approximate a kernel of shape (out, in, 3, 3, 3) as a sum of rank products of a temporal kernel of shape (out, rank, 3)
+    and a spatial kernel of shape (rank, in, 3, 3), by truncated SVD: returns (temporal, spatial)
+    """
+    out_channels, in_channels = kernel.shape[:2]
+    # Rows are (output channel, time), columns are (input channel, height, width)
+    matrix = kernel.detach().float().permute(0, 2, 1, 3, 4).reshape(out_channels * 3, in_channels * 9)
+    U, S, Vh = torch.linalg.svd(matrix, full_matrices=False)
+
+    # Ranks beyond the rank of the matrix are left at zero
+    k = min(rank, S.numel())
+    temporal = matrix.new_zeros(out_channels * 3, rank)
+    spatial = matrix.new_zeros(rank, in_channels * 9)
+    temporal[:, :k] = U[:, :k] * S[:k].sqrt()
+    spatial[:k] = S[:k].sqrt().unsqueeze(1) * Vh[:k]
+
+    return temporal.view(out_channels, 3, rank).transpose(1, 2), spatial.view(rank, in_channels, 3, 3)
+
+
+class Conv2Plus1d(nn.Module):
+    """
+    A (2+1)D factorization of a 3x3x3 Conv3d with a padding of 1: a spatial 1x3x3 convolution followed by a temporal 3x1x1 one.
+    With as many intermediate channels as output channels, this is 27 / (9 + 3 x out / in) times cheaper.
+    """
+    def __init__(self, in_channels, out_channels, stride=1, bias=True, mid_channels=None):
+        super().__init__()
+        mid_channels = mid_channels or out_channels
+        spatial_stride = (1, stride[1], stride[2]) if isinstance(stride, tuple) else (1, stride, stride)
+        self.spatial = nn.Conv3d(in_channels, mid_channels, kernel_size=(1, 3, 3), stride=spatial_stride, padding=(0, 1, 1), bias=False)
+        self.temporal = nn.Conv3d(mid_channels, out_channels, kernel_size=(3, 1, 1), padding=(1, 0, 0), bias=bias)
+
+    def forward(self, x):
+        return self.temporal(self.spatial(x))
+
+    def factorize(self, weight, bias=None):
+        """
+        Get the weights of this module which best approximate a Conv3d with the given weight (out, in, 3, 3, 3) and bias
+        """
+        temporal, spatial = factorize_kernel(weight, self.spatial.out_channels)
+        weights = {"spatial.weight": spatial.unsqueeze(2), "temporal.weight": temporal.reshape(*temporal.shape, 1, 1)}
+        if bias is not None:
+            weights["temporal.bias"] = bias
+        return weights
+
+
+class ConvTranspose2Plus1d(nn.Module):
+    """
+    A (2+1)D factorization of a 3x3x3 ConvTranspose3d with a stride of (1, 2, 2) and a padding of 1:
+    a spatial 1x3x3 transposed convolution followed by a temporal 3x1x1 convolution
+    """
+    def __init__(self, in_channels, out_channels, bias=True, mid_channels=None):
+        super().__init__()
+        mid_channels = mid_channels or out_channels
+        self.spatial = nn.ConvTranspose3d(in_channels, mid_channels, kernel_size=(1, 3, 3), stride=(1, 2, 2), padding=(0, 1, 1), bias=False)
+        self.temporal = nn.Conv3d(mid_channels, out_channels, kernel_size=(3, 1, 1), padding=(1, 0, 0), bias=bias)
+
+    def forward(self, x, output_size=None):
+        return self.temporal(self.spatial(x, output_size=output_size))
+
+    def factorize(self, weight, bias=None):
+        """
+        Get the weights of this module which best approximate a ConvTranspose3d with the given weight (in, out, 3, 3, 3) and bias
+        """
+        # Along time, a transposed convolution with a stride of 1 is a convolution with the flipped kernel
+        temporal, spatial = factorize_kernel(weight.transpose(0, 1).flip(2), self.spatial.out_channels)
+        weights = {"spatial.weight": spatial.transpose(0, 1).unsqueeze(2), "temporal.weight": temporal.reshape(*temporal.shape, 1, 1)}
+        if bias is not None:
+            weights["temporal.bias"] = bias
+        return weights
+
+
+def factorize_weights(model, state_dict):
+    """
+    Convert the weights of a model with full 3x3x3 convolutions (e.g. a pre-trained checkpoint) to a model
+    where some of them are factorized: the weights of each factorized convolution are initialized by truncated SVD
+    """
+    state_dict = dict(state_dict)
+    for name, module in model.named_modules():
+        if isinstance(module, (Conv2Plus1d, ConvTranspose2Plus1d)) and f"{name}.weight" in state_dict:
+            weight = state_dict.pop(f"{name}.weight")
+            bias = state_dict.pop(f"{name}.bias", None)
+            weights = module.factorize(weight, bias)
+            state_dict.update({f"{name}.{key}": value.to(weight.dtype) for key, value in weights.items()})
+    return state_dict
+
+
 class upSplit(nn.Module):
-    def __init__(self, in_channels, out_channels):
+    def __init__(self, in_channels, out_channels, factorized=False):
         super().__init__()
-        self.upconv = nn.ConvTranspose3d(
-            in_channels, out_channels, kernel_size=(3, 3, 3), stride=(1, 2, 2), padding=1)
+        if factorized:
+            self.upconv = ConvTranspose2Plus1d(in_channels, out_channels)
+        else:
+            self.upconv = nn.ConvTranspose3d(
+                in_channels, out_channels, kernel_size=(3, 3, 3), stride=(1, 2, 2), padding=1)
 
     def forward(self, x, output_size):
         x = self.upconv(x, output_size=output_size)
@@ -37,10 +145,14 @@ class Conv_2d(nn.Module):
 
 
 class Conv_3d(nn.Module):
-    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, bias=True, batchnorm=False):
+    def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=0, bias=True, batchnorm=False, factorized=False):
         super().__init__()
-        self.conv = [nn.Conv3d(in_channels, out_channels, kernel_size=kernel_size,
-                               stride=stride, padding=padding, bias=bias)]
+        if factorized:
+            # Only 3x3x3 convolutions with a padding of 1 are factorized
+            self.conv = [Conv2Plus1d(in_channels, out_channels, stride=stride, bias=bias)]
+        else:
+            self.conv = [nn.Conv3d(in_channels, out_channels, kernel_size=kernel_size,
+                                   stride=stride, padding=padding, bias=bias)]
 
         if batchnorm:
             self.conv += [nn.BatchNorm3d(out_channels)]
@@ -1,5 +1,6 @@
 import torch.nn as nn
-from model.sep_sts_layer import SepSTSBasicLayer
+from model.helper_modules import Conv2Plus1d
+from model.sep_sts_layer import SepSTSBasicLayer, compute_mask
 
 
 class SepSTSLayer(nn.Module):
@@ -14,10 +15,17 @@ class SepSTSLayer(nn.Module):
 
 
 class ResBlock(nn.Module):
-    def __init__(self, channel, kernel_size):
+    def __init__(self, channel, kernel_size, factorized=False):
         super(ResBlock, self).__init__()
-        self.conv1 = nn.Conv3d(channel, channel, kernel_size=kernel_size, stride=1, padding=(kernel_size-1)//2)
-        self.conv2 = nn.Conv3d(channel, channel, kernel_size=kernel_size, stride=1, padding=(kernel_size-1)//2)
+        if factorized:
+            # (2+1)D factorization of 3x3x3 convolutions
+            self.conv1 = Conv2Plus1d(channel, channel)
+            self.conv2 = Conv2Plus1d(channel, channel)
+        else:
+            # The kernel size is either the same along every axis, or (depth, height, width)
+            padding = tuple((k-1)//2 for k in kernel_size) if isinstance(kernel_size, tuple) else (kernel_size-1)//2
+            self.conv1 = nn.Conv3d(channel, channel, kernel_size=kernel_size, stride=1, padding=padding)
+            self.conv2 = nn.Conv3d(channel, channel, kernel_size=kernel_size, stride=1, padding=padding)
 
         self.relu = nn.ReLU()
 
@@ -31,30 +39,80 @@ class ResBlock(nn.Module):
 
 
 class SepSTSEncoder(nn.Module):
-    def __init__(self, nf, NF, window_size, nh):
+    def __init__(self, nf, NF, window_size, nh, frame_local=False, factorized=False):
         super(SepSTSEncoder, self).__init__()
-        self.stem = nn.Sequential(
-            nn.Conv3d(in_channels=3, out_channels=nf[-1]//2, kernel_size=3, stride=1, padding=1),
-            nn.LeakyReLU(negative_slope=0.2),
-            ResBlock(nf[-1]//2, kernel_size=3),
-        )
-
-        self.stage1 = SepSTSLayer(nf[-1], depth=2, num_frames=NF, num_heads=nh[0], window_size=window_size[0])
+        # If frame_local, the prefix of the encoder (the stem, down0 and stage1) processes every frame on its own,
+        # so that its features can be reused by every window which contains the frame
+        self.frame_local = frame_local
+
+        if frame_local:
+            self.stem = nn.Sequential(
+                nn.Conv3d(in_channels=3, out_channels=nf[-1]//2, kernel_size=(1,3,3), stride=1, padding=(0,1,1)),
+                nn.LeakyReLU(negative_slope=0.2),
+                ResBlock(nf[-1]//2, kernel_size=(1,3,3)),
+            )
+        else:
+            self.stem = nn.Sequential(
+                nn.Conv3d(in_channels=3, out_channels=nf[-1]//2, kernel_size=3, stride=1, padding=1),
+                nn.LeakyReLU(negative_slope=0.2),
+                ResBlock(nf[-1]//2, kernel_size=3, factorized=factorized),
+            )
+
+        # With a point attention window of a single frame, stage1 does not mix frames either
+        self.stage1 = SepSTSLayer(nf[-1], depth=2, num_frames=1 if frame_local else NF, num_heads=nh[0], window_size=window_size[0])
         self.stage2 = SepSTSLayer(nf[-2], depth=2, num_frames=NF, num_heads=nh[1], window_size=window_size[1])
         self.stage3 = SepSTSLayer(nf[-3], depth=6, num_frames=NF, num_heads=nh[2], window_size=window_size[2])
         self.stage4 = SepSTSLayer(nf[-4], depth=2, num_frames=NF, num_heads=nh[3], window_size=window_size[3])
 
-        self.down0 = nn.Conv3d(in_channels=nf[-1]//2, out_channels=nf[-1], kernel_size=(3,3,3), stride=(1,2,2), padding=1)
-        self.down1 = nn.Conv3d(in_channels=nf[-1], out_channels=nf[-2], kernel_size=(3,3,3), stride=(1,2,2), padding=1)
-        self.down2 = nn.Conv3d(in_channels=nf[-2], out_channels=nf[-3], kernel_size=(3,3,3), stride=(1,2,2), padding=1)
-        self.down3 = nn.Conv3d(in_channels=nf[-3], out_channels=nf[-4], kernel_size=(3,3,3), stride=(1,2,2), padding=1)
+        # If factorized, the 3x3x3 convolutions are factorized into (2+1)D ones
+        # (except for the first one, whose 3 input channels would make the factorization more expensive)
+        def Down(in_channels, out_channels):
+            if factorized:
+                return Conv2Plus1d(in_channels, out_channels, stride=(1,2,2))
+            return nn.Conv3d(in_channels=in_channels, out_channels=out_channels, kernel_size=(3,3,3), stride=(1,2,2), padding=1)
+
+        if frame_local:
+            self.down0 = nn.Conv3d(in_channels=nf[-1]//2, out_channels=nf[-1], kernel_size=(1,3,3), stride=(1,2,2), padding=(0,1,1))
+        else:
+            self.down0 = Down(nf[-1]//2, nf[-1])
+        self.down1 = Down(nf[-1], nf[-2])
+        self.down2 = Down(nf[-2], nf[-3])
+        self.down3 = Down(nf[-3], nf[-4])
+
+    def attention_masks(self, num_frames, height, width, device):
+        """
+        Compute the attention masks of every stage for input frames of the given size,
+        returned as a dictionary of mask cache key -> mask
+        """
+        masks = {}
+        for stage in [self.stage1, self.stage2, self.stage3, self.stage4]:
+            # Each down convolution halves the spatial size (rounding up)
+            height, width = (height - 1) // 2 + 1, (width - 1) // 2 + 1
+            # A frame-local stage1 sees one frame at a time
+            depth = 1 if self.frame_local and stage is self.stage1 else num_frames
+            key = stage.upper.mask_key(depth, height, width, device)
+            masks[key] = compute_mask(*key)
+        return masks
 
     def forward(self, x):
+        x0, x1 = self.prefix(x)
+        return self.suffix(x0, x1)
+
+    def prefix(self, x):
+        """
+        Run the stem, down0 and stage1: returns x0 and x1
+        """
         x0 = self.stem(x)
 
         x1 = self.down0(x0)
         x1 = self.stage1(x1)
 
+        return x0, x1
+
+    def suffix(self, x0, x1):
+        """
+        Run the stages after stage1 on the output of the prefix: returns x0, x1, x2, x3 and x4
+        """
         x2 = self.down1(x1)
         x2 = self.stage2(x2)
 
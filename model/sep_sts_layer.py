@@ -1,8 +1,8 @@
 import torch
 import torch.nn as nn
 import numpy as np
-from timm.models.layers import trunc_normal_
-from functools import reduce, lru_cache
+from collections import OrderedDict
+from functools import lru_cache, reduce
 from operator import mul
 from einops import rearrange
 
@@ -23,6 +23,27 @@ class Mlp(nn.Module):
         x = self.linear2(x)
         return x
 
+    def prune(self, channels):
+        """ Keep only the given hidden channels (a list of indices)."""
+        self.linear1 = slice_linear(self.linear1, outputs=channels)
+        self.linear2 = slice_linear(self.linear2, inputs=channels)
+
+
+def slice_linear(linear, outputs=None, inputs=None):
+    """ Build a linear layer from the given output and input features (lists of indices) of another one."""
+    weight, bias = linear.weight, linear.bias
+    if outputs is not None:
+        weight = weight[outputs]
+        bias = bias[outputs] if bias is not None else None
+    if inputs is not None:
+        weight = weight[:, inputs]
+
+    sliced = nn.Linear(weight.shape[1], weight.shape[0], bias=bias is not None, device=weight.device, dtype=weight.dtype)
+    sliced.weight = nn.Parameter(weight.detach().clone())
+    if bias is not None:
+        sliced.bias = nn.Parameter(bias.detach().clone())
+    return sliced
+
 
 def window_partition(x, window_size):
     """
@@ -105,6 +126,73 @@ def get_window_size(x_size, window_size, shift_size=None):
         return tuple(corrected_window_size), tuple(corrected_shift_size)
 
 
+def bipartite_matching(x, num_merged, mask=None, valid=None):
+    """
+    Choose which tokens of each window to merge by bipartite soft matching (as in Token Merging, Bolya et al.):
+    the tokens are split into two alternating sets, and the num_merged tokens of the first set which are the most similar
+    to a token of the second set are merged into it.
+
+    Args:
+        x: (num_windows*B, N, C)
+        num_merged (int): Number of tokens to merge away in each window, at most N // 2
+        mask: (0/-100) attention mask with shape of (num_windows, N, N) or None. Tokens which cannot attend to each other are not merged.
+        valid: (num_windows, N) mask of the tokens which are not padding, or None. Padding is never merged, nor merged into.
+            num_merged must leave out the tokens of the first set which have no valid match (see compute_padding).
+    Returns:
+        destination: (num_windows*B, N) index of the merged token of each token
+        positions: (num_windows*B, N - num_merged) index of the token whose position each merged token takes
+        sizes: (num_windows*B, N - num_merged) number of tokens in each merged token
+    """
+    B_, N, _ = x.shape
+    # Padding tokens are zero, so the norm is clamped
+    x = x / x.norm(dim=-1, keepdim=True).clamp_min(1e-6)
+    a, b = x[:, ::2], x[:, 1::2]
+    num_a, num_b = a.shape[1], b.shape[1]
+    num_kept = num_a - num_merged
+
+    # Cosine similarity between the tokens of the two sets
+    scores = a @ b.transpose(-2, -1)  # (B_, Na, Nb)
+    if mask is not None:
+        nW = mask.shape[0]
+        scores = scores.view(B_ // nW, nW, num_a, num_b).masked_fill(mask[:, ::2, 1::2] != 0, -float("inf")).view(B_, num_a, num_b)
+    if valid is not None:
+        # Pairs involving padding can never match, so padding tokens of the first set end up last in the order below,
+        # among the kept tokens, and padding tokens of the second set are never the best match of any token
+        nW = valid.shape[0]
+        pairs = valid[:, ::2].unsqueeze(-1) & valid[:, 1::2].unsqueeze(-2)
+        scores = scores.view(B_ // nW, nW, num_a, num_b).masked_fill(~pairs, -float("inf")).view(B_, num_a, num_b)
+
+    # Merge the tokens of the first set with the best matches
+    best_scores, best_matches = scores.max(-1)
+    order = best_scores.argsort(-1, descending=True)
+    merged, kept = order[:, :num_merged], order[:, num_merged:]
+
+    # The kept tokens of the first set come first, followed by every token of the second set
+    destination_a = torch.empty_like(best_matches)
+    destination_a.scatter_(1, kept, torch.arange(num_kept, device=x.device).expand(B_, num_kept))
+    destination_a.scatter_(1, merged, num_kept + best_matches.gather(1, merged))
+    destination = torch.empty(B_, N, dtype=torch.long, device=x.device)
+    destination[:, ::2] = destination_a
+    destination[:, 1::2] = num_kept + torch.arange(num_b, device=x.device)
+
+    positions = torch.cat([2 * kept, (2 * torch.arange(num_b, device=x.device) + 1).expand(B_, num_b)], 1)
+    sizes = torch.zeros(B_, N - num_merged, dtype=x.dtype, device=x.device).scatter_add_(1, destination, torch.ones_like(x[..., 0]))
+
+    return destination, positions, sizes
+
+
+def merge_tokens(x, destination, sizes):
+    """ Average the tokens x (num_windows*B, N, C) which share a destination: returns (num_windows*B, N', C)."""
+    merged = torch.zeros(x.shape[0], sizes.shape[1], x.shape[2], dtype=x.dtype, device=x.device)
+    merged.scatter_add_(1, destination.unsqueeze(-1).expand_as(x), x)
+    return merged / sizes.unsqueeze(-1)
+
+
+def unmerge_tokens(x, destination):
+    """ Copy each merged token of x (num_windows*B, N', C) back to the tokens it was merged from: returns (num_windows*B, N, C)."""
+    return x.gather(1, destination.unsqueeze(-1).expand(-1, -1, x.shape[-1]))
+
+
 class WindowAttention3D(nn.Module):
     """ Window based multi-head self attention (W-MSA) module with relative position bias.
     It supports both of shifted and non-shifted window.
@@ -120,8 +208,8 @@ class WindowAttention3D(nn.Module):
         self.dim = dim
         self.window_size = window_size  # (Wd, Wh, Ww)
         self.num_heads = num_heads  # nH
-        head_dim = dim // num_heads  # C//nH
-        self.scale = qk_scale or head_dim ** -0.5
+        self.head_dim = dim // num_heads  # C//nH, which stays the same when heads are pruned
+        self.scale = qk_scale or self.head_dim ** -0.5
 
         # Define a parameter table of biases which we can index into
         self.relative_position_bias_table = nn.Parameter(
@@ -173,23 +261,25 @@ class WindowAttention3D(nn.Module):
         self.project = nn.Linear(dim, dim)
 
         # Initialize the relative position bias table with a truncated normal distribution
-        trunc_normal_(self.relative_position_bias_table, std=.02)
+        nn.init.trunc_normal_(self.relative_position_bias_table, std=.02)
 
         # Softmax function to normalize the attention scores
         self.softmax = nn.Softmax(dim=-1)
 
-    def forward(self, x, mask=None):
+    def forward(self, x, mask=None, positions=None, sizes=None):
         """ Forward function.
         Args:
             x: input features with shape of (num_windows*B, N, C), where N is the number of elements in each window.
             mask: (0/-inf) mask with shape of (num_windows, N, N) or None
+            positions: for merged tokens, the index (num_windows*B, N') in the window of the token whose position each one takes, or None
+            sizes: for merged tokens, the number of tokens (num_windows*B, N') in each one, or None
         """
         # Total number of windows, number of elements in each window, and number of channels
         B_, N, C = x.shape
         # Generate the query, key, and value matrices
         qkv = self.qkv(x) # (B_, N, 3 * C)
         # Separate the query, key, and value matrices from each other and distribute them across the attention heads
-        qkv = qkv.reshape(B_, N, 3, self.num_heads, C // self.num_heads) # (B_, N, 3, nH, C//nH)
+        qkv = qkv.reshape(B_, N, 3, self.num_heads, self.head_dim) # (B_, N, 3, nH, C//nH)
         # Permute the tensor to make the query, key, and value matrices individually contiguous in memory
         qkv = qkv.permute(2, 0, 3, 1, 4) # (3, B_, nH, N, C//nH)
         # Extract the query, key, and value matrices
@@ -200,24 +290,45 @@ class WindowAttention3D(nn.Module):
         # Calculate the attention scores
         attn = queries @ keys.transpose(-2, -1)
 
-        # Look up the relative position bias table for each pair of tokens
-        indices = self.relative_position_indices[:N, :N].reshape(-1)
-        relative_position_bias = self.relative_position_bias_table[indices].reshape(N, N, -1)  # (Wd*Wh*Ww, Wd*Wh*Ww, nH)
-        relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # (nH, Wd*Wh*Ww, Wd*Wh*Ww)
-        attn = attn + relative_position_bias.unsqueeze(0)  # (B_, nH, N, N)
-
-        if mask is not None:
-            nW = mask.shape[0]
-            attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
-            attn = attn.view(-1, self.num_heads, N, N)
-            attn = self.softmax(attn)
+        if positions is None:
+            # Look up the relative position bias table for each pair of tokens
+            indices = self.relative_position_indices[:N, :N].reshape(-1)
+            relative_position_bias = self.relative_position_bias_table[indices].reshape(N, N, -1)  # (Wd*Wh*Ww, Wd*Wh*Ww, nH)
+            relative_position_bias = relative_position_bias.permute(2, 0, 1).contiguous()  # (nH, Wd*Wh*Ww, Wd*Wh*Ww)
+            attn = attn + relative_position_bias.unsqueeze(0)  # (B_, nH, N, N)
+
+            if mask is not None:
+                nW = mask.shape[0]
+                attn = attn.view(B_ // nW, nW, self.num_heads, N, N) + mask.unsqueeze(1).unsqueeze(0)
+                attn = attn.view(-1, self.num_heads, N, N)
         else:
-            attn = self.softmax(attn)
+            # Merged tokens take the position bias and the mask of the token they were merged into,
+            # and each one counts as many keys as the tokens it holds (proportional attention)
+            indices = self.relative_position_indices[positions.unsqueeze(2), positions.unsqueeze(1)]  # (B_, N, N)
+            relative_position_bias = self.relative_position_bias_table[indices].permute(0, 3, 1, 2)  # (B_, nH, N, N)
+            attn = attn + relative_position_bias + sizes.log().view(B_, 1, 1, N)
+
+            if mask is not None:
+                nW = mask.shape[0]
+                windows = torch.arange(B_, device=x.device) % nW
+                attn = attn + mask[windows.view(B_, 1, 1), positions.unsqueeze(2), positions.unsqueeze(1)].unsqueeze(1)
 
-        x = (attn @ values).transpose(1, 2).reshape(B_, N, C)
+        attn = self.softmax(attn)
+
+        x = (attn @ values).transpose(1, 2).reshape(B_, N, self.num_heads * self.head_dim)
         x = self.project(x)
         return x
 
+    def prune(self, heads):
+        """ Keep only the given attention heads (a list of indices)."""
+        channels = [head * self.head_dim + i for head in heads for i in range(self.head_dim)]
+        # The query, key and value channels are laid out one after the other
+        attention_dim = self.num_heads * self.head_dim
+        self.qkv = slice_linear(self.qkv, outputs=[j * attention_dim + c for j in range(3) for c in channels])
+        self.project = slice_linear(self.project, inputs=channels)
+        self.relative_position_bias_table = nn.Parameter(self.relative_position_bias_table[:, heads].detach().clone())
+        self.num_heads = len(heads)
+
 
 class SepSTSBlock(nn.Module):
     """ A basic Sep-STS Block.
@@ -232,10 +343,12 @@ class SepSTSBlock(nn.Module):
         qk_scale (float | None, optional): Override default qk scale of head_dim ** -0.5 if set.
         activation (nn.Module, optional): Activation layer. Default: nn.GELU
         norm_layer (nn.Module, optional): Normalization layer.  Default: nn.LayerNorm
+        merge_ratio (float): At inference, the fraction of the tokens of each spatial window (at most half) which are merged
+            with similar tokens for the spatial attention and the MLP. Default: 0
     """
     def __init__(self, dim, num_heads, depth_window_size=(1, 8, 8), shift_size=(0, 0, 0),
                  point_window_size=(4, 1, 1), mlp_ratio=4., qkv_bias=True, qk_scale=None,
-                 activation=nn.GELU, norm_layer=nn.LayerNorm):
+                 activation=nn.GELU, norm_layer=nn.LayerNorm, merge_ratio=0.):
         super().__init__()
         self.dim = dim
         self.num_heads = num_heads
@@ -243,6 +356,7 @@ class SepSTSBlock(nn.Module):
         self.point_window_size = point_window_size
         self.shift_size = shift_size
         self.mlp_ratio = mlp_ratio
+        self.merge_ratio = merge_ratio
 
         assert 0 <= self.shift_size[0] < self.depth_window_size[0], "shift_size must in 0-window_size"
         assert 0 <= self.shift_size[1] < self.depth_window_size[1], "shift_size must in 0-window_size"
@@ -259,40 +373,61 @@ class SepSTSBlock(nn.Module):
         mlp_hidden_dim = int(dim * mlp_ratio)
         self.mlp = Mlp(in_features=dim, hidden_features=mlp_hidden_dim, activation=activation)
 
-    def forward_part1(self, x, mask_matrix):
+    def partition(self, x, window_size, shift_size):
+        """ Pad x (B, D, H, W, C) to multiples of the window size, shift it cyclically and partition it into windows."""
         B, D, H, W, C = x.shape
-        window_size, shift_size = get_window_size((D, H, W), self.depth_window_size, self.shift_size)
-
-        x = self.norm1(x)
         # pad feature maps to multiples of window size
         pad_l = pad_t = pad_d0 = 0
         pad_d1 = (window_size[0] - D % window_size[0]) % window_size[0]
         pad_b = (window_size[1] - H % window_size[1]) % window_size[1]
         pad_r = (window_size[2] - W % window_size[2]) % window_size[2]
         x = torch.nn.functional.pad(x, (0, 0, pad_l, pad_r, pad_t, pad_b, pad_d0, pad_d1))
-        _, Dp, Hp, Wp, _ = x.shape
         # cyclic shift
         if any(i > 0 for i in shift_size):
-            shifted_x = torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
-            attn_mask = mask_matrix
-        else:
-            shifted_x = x
-            attn_mask = None
+            x = torch.roll(x, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
         # partition windows
-        x_windows = window_partition(shifted_x, window_size)  # B*nW, Wd*Wh*Ww, C
-        # W-MSA/SW-MSA
-        attn_windows = self.depth_attn(x_windows, mask=attn_mask)  # B*nW, Wd*Wh*Ww, C
+        return window_partition(x, window_size)  # B*nW, Wd*Wh*Ww, C
+
+    def undo_partition(self, windows, window_size, shift_size, B, D, H, W):
+        """ Undo partition for the windows of an input of depth D, height H and width W."""
+        Dp, Hp, Wp = (-(-size // window) * window for size, window in zip((D, H, W), window_size))
         # merge windows
-        attn_windows = attn_windows.view(-1, *(window_size + (C,)))
-        shifted_x = undo_window_partition(attn_windows, window_size, B, Dp, Hp, Wp)  # B D' H' W' C
+        windows = windows.view(-1, *(window_size + (windows.shape[-1],)))
+        x = undo_window_partition(windows, window_size, B, Dp, Hp, Wp)  # B D' H' W' C
         # reverse cyclic shift
         if any(i > 0 for i in shift_size):
-            x = torch.roll(shifted_x, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
-        else:
-            x = shifted_x
+            x = torch.roll(x, shifts=(shift_size[0], shift_size[1], shift_size[2]), dims=(1, 2, 3))
 
-        if pad_d1 > 0 or pad_r > 0 or pad_b > 0:
+        if Dp > D or Hp > H or Wp > W:
             x = x[:, :D, :H, :W, :].contiguous()
+        return x
+
+    def forward_part1(self, x, mask_matrix):
+        """ The spatial and temporal attention: returns the output and the merged tokens of each window (or None)."""
+        B, D, H, W, C = x.shape
+        window_size, shift_size = get_window_size((D, H, W), self.depth_window_size, self.shift_size)
+        attn_mask = mask_matrix if any(i > 0 for i in shift_size) else None
+
+        x_windows = self.partition(self.norm1(x), window_size, shift_size)  # B*nW, Wd*Wh*Ww, C
+
+        # At inference, similar tokens of each window can be merged, and unmerged after the attention
+        num_merged = min(int(self.merge_ratio * x_windows.shape[1]), x_windows.shape[1] // 2) if not self.training else 0
+        if num_merged > 0:
+            # Only as many tokens as the window with the most padding can merge
+            valid, num_mergeable = compute_padding(D, H, W, window_size, shift_size, x.device)
+            num_merged = min(num_merged, num_mergeable)
+        if num_merged > 0:
+            merge = bipartite_matching(x_windows, num_merged, attn_mask, valid)
+            destination, positions, sizes = merge
+            # W-MSA/SW-MSA
+            attn_windows = self.depth_attn(merge_tokens(x_windows, destination, sizes), mask=attn_mask, positions=positions, sizes=sizes)
+            attn_windows = unmerge_tokens(attn_windows, destination)  # B*nW, Wd*Wh*Ww, C
+        else:
+            merge = None
+            # W-MSA/SW-MSA
+            attn_windows = self.depth_attn(x_windows, mask=attn_mask)  # B*nW, Wd*Wh*Ww, C
+
+        x = self.undo_partition(attn_windows, window_size, shift_size, B, D, H, W)
         ######################point attn###########################
         window_size = get_window_size((D, H, W), self.point_window_size)
         x_windows = window_partition(x, window_size)
@@ -300,10 +435,19 @@ class SepSTSBlock(nn.Module):
         attn_windows = attn_windows.view(-1, *(window_size + (C,)))
         x = undo_window_partition(attn_windows, window_size, B, D, H, W)
 
-        return x
+        return x, merge
 
-    def forward_part2(self, x):
-        return self.mlp(self.norm2(x))
+    def forward_part2(self, x, merge=None):
+        if merge is None:
+            return self.mlp(self.norm2(x))
+
+        # Run the MLP on the tokens merged for the spatial attention
+        B, D, H, W, C = x.shape
+        window_size, shift_size = get_window_size((D, H, W), self.depth_window_size, self.shift_size)
+        destination, _, sizes = merge
+        x_windows = merge_tokens(self.partition(self.norm2(x), window_size, shift_size), destination, sizes)
+        x_windows = unmerge_tokens(self.mlp(x_windows), destination)
+        return self.undo_partition(x_windows, window_size, shift_size, B, D, H, W)
 
     def forward(self, x, mask_matrix):
         """ Forward function.
@@ -313,16 +457,68 @@ class SepSTSBlock(nn.Module):
         """
 
         shortcut = x
-        x = self.forward_part1(x, mask_matrix)
+        x, merge = self.forward_part1(x, mask_matrix)
         x = shortcut + x
-        x = x + self.forward_part2(x)
+        x = x + self.forward_part2(x, merge)
 
         return x
 
 
-# cache each stage results
-@lru_cache()
+# cache each stage results: the most recently used masks (as many as lru_cache kept), and the masks installed by install_masks,
+# which are shared with other processes and never evicted
+MASK_CACHE_SIZE = 128
+mask_cache = OrderedDict()
+installed_masks = {}
+
+
 def compute_mask(D, H, W, window_size, shift_size, device):
+    key = (D, H, W, window_size, shift_size, torch.device(device))
+    if key in installed_masks:
+        return installed_masks[key]
+
+    if key in mask_cache:
+        mask_cache.move_to_end(key)
+    else:
+        mask_cache[key] = build_mask(D, H, W, window_size, shift_size, device)
+        if len(mask_cache) > MASK_CACHE_SIZE:
+            mask_cache.popitem(last=False)
+    return mask_cache[key]
+
+
+def install_masks(masks):
+    """
+    Add precomputed attention masks (e.g. shared by a parent process) to the mask cache
+    """
+    installed_masks.update(masks)
+
+
+@lru_cache(maxsize=MASK_CACHE_SIZE)
+def compute_padding(D, H, W, window_size, shift_size, device):
+    """
+    Find the padding tokens in the windows of an input of depth D, height H and width W, as SepSTSBlock.partition pads it.
+
+    Returns:
+        valid: (num_windows, N) mask of the tokens which are not padding, or None if there is no padding
+        num_mergeable: the number of tokens of the first set of bipartite_matching which can be merged in every window:
+            those which are not padding and have a match which is not padding either
+    """
+    Dp, Hp, Wp = (-(-size // window) * window for size, window in zip((D, H, W), window_size))
+    N = reduce(mul, window_size)
+    if (Dp, Hp, Wp) == (D, H, W):
+        return None, N // 2
+
+    # Built on the CPU, so that counting the mergeable tokens does not wait for the device
+    img_mask = torch.zeros((1, Dp, Hp, Wp, 1), dtype=torch.bool)
+    img_mask[:, :D, :H, :W, :] = True
+    if any(i > 0 for i in shift_size):
+        img_mask = torch.roll(img_mask, shifts=(-shift_size[0], -shift_size[1], -shift_size[2]), dims=(1, 2, 3))
+    valid = window_partition(img_mask, window_size).squeeze(-1)  # nW, ws[0]*ws[1]*ws[2]
+
+    mergeable = valid[:, ::2] & valid[:, 1::2].any(-1, keepdim=True)
+    return valid.to(device), int(mergeable.sum(-1).min())
+
+
+def build_mask(D, H, W, window_size, shift_size, device):
     img_mask = torch.zeros((1, D, H, W, 1), device=device)  # 1 Dp Hp Wp 1
     cnt = 0
     for d in slice(-window_size[0]), slice(-window_size[0], -shift_size[0]), slice(-shift_size[0], None):
@@ -380,6 +576,14 @@ class SepSTSBasicLayer(nn.Module):
             )
             for i in range(depth)])
 
+    def mask_key(self, D, H, W, device):
+        """ Get the arguments of compute_mask for an input of depth D, height H and width W."""
+        window_size, shift_size = get_window_size((D, H, W), self.depth_window_size, self.shift_size)
+        Dp = int(np.ceil(D / window_size[0])) * window_size[0]
+        Hp = int(np.ceil(H / window_size[1])) * window_size[1]
+        Wp = int(np.ceil(W / window_size[2])) * window_size[2]
+        return Dp, Hp, Wp, window_size, shift_size, torch.device(device)
+
     def forward(self, x):
         """ Forward function.
         Args:
@@ -387,12 +591,8 @@ class SepSTSBasicLayer(nn.Module):
         """
         # calculate attention mask for SW-MSA
         B, C, D, H, W = x.shape
-        window_size, shift_size = get_window_size((D, H, W), self.depth_window_size, self.shift_size)
         x = rearrange(x, 'b c d h w -> b d h w c')
-        Dp = int(np.ceil(D / window_size[0])) * window_size[0]
-        Hp = int(np.ceil(H / window_size[1])) * window_size[1]
-        Wp = int(np.ceil(W / window_size[2])) * window_size[2]
-        attn_mask = compute_mask(Dp, Hp, Wp, window_size, shift_size, x.device)
+        attn_mask = compute_mask(*self.mask_key(D, H, W, x.device))
         for _, blk in enumerate(self.blocks):
             x = blk(x, attn_mask)
         x = x.view(B, D, H, W, -1)
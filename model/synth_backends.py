@@ -0,0 +1,382 @@
+import importlib.util
+import json
+import math
+import os
+import platform
+import time
+import torch
+from paths import CACHE_DIR
+
+
+# Where the autotuned synthesis backends are kept across runs
+AUTOTUNE_PATH = os.path.join(CACHE_DIR, "synth_backends.json")
+
+# The number of elements of each bilinear tap which the tiled backend gathers at a time
+TILE_ELEMENTS = 2**22
+
+# Implementations of adaptive collaboration of flows, by name
+SYNTH_BACKENDS = {}
+
+# The backends ranked from fastest to slowest for each problem, as autotuned by this process
+rankings = {}
+
+
+def register_backend(name, devices=("cpu", "cuda"), dtypes=None, max_elements=None):
+    """
+    Register a synthesis backend with the signature of synthesize(input, weight, offset_y, offset_x, dilation, row_offset).
+
+    devices: the device types it runs on
+    dtypes: the dtypes it supports, or None for any
+    max_elements: the largest problem it can take (batch size x channels x kernel elements x pixels), or None for any
+    """
+    def register(synthesize):
+        SYNTH_BACKENDS[name] = {"synthesize": synthesize, "devices": devices, "dtypes": dtypes, "max_elements": max_elements}
+        return synthesize
+    return register
+
+
+@register_backend("cupy", devices=("cuda",), dtypes=(torch.float32,))
+def synthesize_cupy(input, weight, offset_y, offset_x, dilation, row_offset=0):
+    # cupy is imported on first use, so that ArTEMIS can be imported and built without it
+    import cupy_module.synth as synth
+    return synth.FunctionSynth.apply(input, weight, offset_y, offset_x, dilation, row_offset)
+
+
+def bilinear_taps(input, ys, xs, offset_y, offset_x):
+    """
+    Sample the input (B, C, in_H, in_W) bilinearly at rows ys + offset_y and columns xs + offset_x, like the cupy kernel:
+    offsets are truncated towards zero, and each tap is clamped to the frame.
+    ys and xs are the positions of the kernel elements before their offsets, broadcastable to the offsets (B, K, H, W).
+    Returns the samples of shape (B, C, K, H, W)
+    """
+    B, C, in_H, in_W = input.shape
+    _, K, H, W = offset_y.shape
+
+    int_alpha = offset_y.detach().trunc()
+    int_beta = offset_x.detach().trunc()
+    alpha = (offset_y - int_alpha).unsqueeze(1)
+    beta = (offset_x - int_beta).unsqueeze(1)
+
+    bottom = (ys + int_alpha.long()).clamp(0, in_H - 1)
+    top = (ys + int_alpha.long() + 1).clamp(0, in_H - 1)
+    left = (xs + int_beta.long()).clamp(0, in_W - 1)
+    right = (xs + int_beta.long() + 1).clamp(0, in_W - 1)
+
+    pixels = input.flatten(2)
+
+    def tap(rows, cols):
+        index = (rows * in_W + cols).view(B, 1, K * H * W).expand(B, C, K * H * W)
+        return pixels.gather(2, index).view(B, C, K, H, W)
+
+    return (tap(bottom, left) * (1 - alpha) * (1 - beta) + tap(top, left) * alpha * (1 - beta) +
+            tap(bottom, right) * (1 - alpha) * beta + tap(top, right) * alpha * beta)
+
+
+@register_backend("gather", max_elements=2**27)
+def synthesize_gather(input, weight, offset_y, offset_x, dilation, row_offset=0):
+    """
+    Synthesize with plain tensor operations, by gathering the 4 bilinear taps of every kernel element at once.
+
+    This follows the cupy kernel exactly: offsets are truncated towards zero, and each tap is clamped to the frame.
+    Gradients flow to the same inputs as in FunctionSynth.
+    """
+    _, K, H, W = weight.shape
+    F = int(math.sqrt(K))
+
+    # The position of every kernel element, before its offset
+    kernel_index = torch.arange(K, device=input.device)
+    ys = (torch.arange(H, device=input.device) + row_offset).view(1, 1, H, 1) + (kernel_index // F * dilation).view(1, K, 1, 1)
+    xs = torch.arange(W, device=input.device).view(1, 1, 1, W) + (kernel_index % F * dilation).view(1, K, 1, 1)
+
+    samples = bilinear_taps(input, ys, xs, offset_y, offset_x)
+    return (weight.unsqueeze(1) * samples).sum(2)
+
+
+@register_backend("tiled")
+def synthesize_tiled(input, weight, offset_y, offset_x, dilation, row_offset=0):
+    """
+    Synthesize bands of rows with the gather backend, so that the taps of each band stay small enough to fit in cache
+    """
+    B, C = input.shape[:2]
+    _, K, H, W = weight.shape
+    tile_rows = max(1, TILE_ELEMENTS // (B * C * K * W))
+
+    outputs = []
+    for start in range(0, H, tile_rows):
+        end = min(start + tile_rows, H)
+        outputs.append(synthesize_gather(input, weight[:, :, start:end], offset_y[:, :, start:end], offset_x[:, :, start:end],
+                                         dilation, row_offset + start))
+    return torch.cat(outputs, 2)
+
+
+def synthesize_reference(input, weight, offset_y, offset_x, dilation, row_offset=0):
+    """
+    A naive transcription of the cupy kernel, one kernel element at a time with plain indexing, which shares no code
+    with the gather and tiled backends: the reference which autotune checks the backends against when cupy is unavailable
+    """
+    B, C, in_H, in_W = input.shape
+    _, K, H, W = weight.shape
+    F = int(math.sqrt(K))
+
+    batch = torch.arange(B, device=input.device).view(B, 1, 1)
+    y = (torch.arange(H, device=input.device) + row_offset).view(1, H, 1)
+    x = torch.arange(W, device=input.device).view(1, 1, W)
+
+    def value(rows, cols):
+        # (B, H, W, C) -> (B, C, H, W)
+        return input[batch, :, rows, cols].permute(0, 3, 1, 2)
+
+    output = input.new_zeros(B, C, H, W)
+    for row in range(F):
+        for col in range(F):
+            k = row * F + col
+            int_alpha = offset_y[:, k].trunc().long()
+            int_beta = offset_x[:, k].trunc().long()
+            alpha = (offset_y[:, k] - int_alpha).unsqueeze(1)
+            beta = (offset_x[:, k] - int_beta).unsqueeze(1)
+
+            bottom = (y + row * dilation + int_alpha).clamp(0, in_H - 1)
+            top = (y + row * dilation + int_alpha + 1).clamp(0, in_H - 1)
+            left = (x + col * dilation + int_beta).clamp(0, in_W - 1)
+            right = (x + col * dilation + int_beta + 1).clamp(0, in_W - 1)
+
+            output += weight[:, k].unsqueeze(1) * (value(bottom, left) * (1 - alpha) * (1 - beta) + value(top, left) * alpha * (1 - beta) +
+                                                   value(bottom, right) * (1 - alpha) * beta + value(top, right) * alpha * beta)
+    return output
+
+
+def synthesize_sparse(input, weight, offset_y, offset_x, dilation, row_offset=0, topk=None, threshold=None, renormalize=False):
+    """
+    Approximate the synthesis with only the largest elements of every kernel: the topk elements with the largest absolute weights,
+    and/or those whose absolute weight is at least threshold (always keeping the largest one).
+    Only the taps of the kept elements are gathered, so with a threshold, as many elements are gathered at every pixel
+    as there are above the threshold at the pixel which has the most.
+
+    If renormalize, the kept weights of each kernel are rescaled to add up to the sum of all of its weights (e.g. for softmaxed kernels).
+    The output frame is synthesized in bands of rows, like with the tiled backend.
+    """
+    B, C = input.shape[:2]
+    _, K, H, W = weight.shape
+    F = int(math.sqrt(K))
+
+    def synthesize_band(start, end):
+        band_weight = weight[:, :, start:end]
+        magnitude = band_weight.abs()
+
+        # Choose the number of elements to keep
+        num_kept = K if topk is None else min(topk, K)
+        if threshold is not None:
+            num_kept = min(num_kept, max(1, int((magnitude >= threshold).sum(1).max())))
+
+        magnitudes, index = magnitude.topk(num_kept, dim=1)
+        kept = band_weight.gather(1, index)
+        if threshold is not None:
+            above = magnitudes >= threshold
+            above[:, 0] = True
+            kept = kept * above
+
+        if renormalize:
+            kept = kept * (band_weight.sum(1, keepdim=True) / kept.sum(1, keepdim=True))
+
+        # The position of every kept kernel element, before its offset
+        ys = (torch.arange(start, end, device=input.device) + row_offset).view(1, 1, -1, 1) + index // F * dilation
+        xs = torch.arange(W, device=input.device).view(1, 1, 1, W) + index % F * dilation
+
+        samples = bilinear_taps(input, ys, xs, offset_y[:, :, start:end].gather(1, index), offset_x[:, :, start:end].gather(1, index))
+        return (kept.unsqueeze(1) * samples).sum(2)
+
+    tile_rows = max(1, TILE_ELEMENTS // (B * C * (topk or K) * W))
+    return torch.cat([synthesize_band(start, min(start + tile_rows, H)) for start in range(0, H, tile_rows)], 2)
+
+
+def expand_separable(weight, offset_y, offset_x):
+    """
+    Expand separable kernels (see synthesize_separable) to the full kernels of the other backends
+    """
+    B, F, H, W = offset_y.shape
+    vertical, horizontal = weight[:, :F], weight[:, F:]
+    weight = (vertical.unsqueeze(2) * horizontal.unsqueeze(1)).reshape(B, F * F, H, W)
+    offset_y = offset_y.unsqueeze(2).expand(B, F, F, H, W).reshape(B, F * F, H, W)
+    offset_x = offset_x.unsqueeze(1).expand(B, F, F, H, W).reshape(B, F * F, H, W)
+    return weight, offset_y, offset_x
+
+
+# The synthesis is never traced by torch.compile: the cupy kernel and the autotuning run eagerly, between compiled graphs
+@torch.compiler.disable
+def synthesize_separable(input, weight, offset_y, offset_x, dilation, row_offset=0, backend="auto"):
+    """
+    Synthesize with separable kernels of size F x F: weight (B, 2F, H, W) holds F vertical factors followed by F horizontal ones,
+    and the element (i, j) of each kernel has the weight vertical[i] x horizontal[j], and samples the input offset_y[i] rows
+    and offset_x[j] columns away, with offset_y and offset_x of shape (B, F, H, W).
+
+    This is the same as synthesize() with the expanded kernels, but runs in two passes without ever expanding them:
+    for each kernel row, the horizontal pass blends the taps of its two source rows along the kernel columns,
+    and the vertical pass blends the kernel rows. With the cupy backend, the kernels are expanded for the CUDA kernel instead.
+    """
+    if backend == "cupy" or (backend == "auto" and "cupy" in available_backends(input.device, input.dtype)):
+        return synthesize(input, *expand_separable(weight, offset_y, offset_x), dilation, row_offset, "cupy")
+
+    B, C, in_H, in_W = input.shape
+    _, F, H, W = offset_y.shape
+    vertical, horizontal = weight[:, :F], weight[:, F:]
+
+    # The position of every kernel row and column, before its offset
+    kernel_index = torch.arange(F, device=input.device)
+    ys = (torch.arange(H, device=input.device) + row_offset).view(1, 1, H, 1) + (kernel_index * dilation).view(1, F, 1, 1)
+    xs = torch.arange(W, device=input.device).view(1, 1, 1, W) + (kernel_index * dilation).view(1, F, 1, 1)
+
+    # Offsets are truncated towards zero, like in the cupy kernel
+    int_alpha = offset_y.detach().trunc()
+    int_beta = offset_x.detach().trunc()
+    alpha = offset_y - int_alpha
+    beta = offset_x - int_beta
+
+    bottom = (ys + int_alpha.long()).clamp(0, in_H - 1)
+    top = (ys + int_alpha.long() + 1).clamp(0, in_H - 1)
+    left = (xs + int_beta.long()).clamp(0, in_W - 1)
+    right = (xs + int_beta.long() + 1).clamp(0, in_W - 1)
+
+    # The horizontal weights of the left and right taps of every kernel column
+    left_weight = (horizontal * (1 - beta)).unsqueeze(1)
+    right_weight = (horizontal * beta).unsqueeze(1)
+
+    pixels = input.flatten(2)
+
+    def horizontal_pass(rows):
+        # Blend the taps of every kernel column on the given source rows (B, H, W): returns (B, C, H, W)
+        def tap(cols):
+            index = (rows.unsqueeze(1) * in_W + cols).view(B, 1, F * H * W).expand(B, C, F * H * W)
+            return pixels.gather(2, index).view(B, C, F, H, W)
+        return (tap(left) * left_weight + tap(right) * right_weight).sum(2)
+
+    output = 0
+    for i in range(F):
+        a = alpha[:, i:i+1]
+        output = output + vertical[:, i:i+1] * (horizontal_pass(bottom[:, i]) * (1 - a) + horizontal_pass(top[:, i]) * a)
+    return output
+
+
+def available_backends(device, dtype, num_elements=0):
+    """
+    List the registered backends which can synthesize a problem of the given size on a device
+    """
+    names = []
+    for name, backend in SYNTH_BACKENDS.items():
+        if device.type not in backend["devices"]:
+            continue
+        if backend["dtypes"] is not None and dtype not in backend["dtypes"]:
+            continue
+        if backend["max_elements"] is not None and num_elements > backend["max_elements"]:
+            continue
+        if name == "cupy" and importlib.util.find_spec("cupy") is None:
+            continue
+        names.append(name)
+    return names
+
+
+def problem_key(batch_size, kernel_size, dilation, height, width, dtype, device):
+    device_name = torch.cuda.get_device_name(device) if device.type == "cuda" else platform.processor() or "cpu"
+    return f"{device_name}|{dtype}|kernel_size={kernel_size}|dilation={dilation}|{batch_size}x{height}x{width}"
+
+
+def read_autotune_cache(path=AUTOTUNE_PATH):
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_autotune_cache(key, ranking, path=AUTOTUNE_PATH):
+    # Merge with rankings written by other processes in the meantime
+    cache = read_autotune_cache(path)
+    cache[key] = ranking
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "w") as f:
+        json.dump(cache, f, indent=4)
+    os.replace(temporary_path, path)
+
+
+def autotune(batch_size, kernel_size, dilation, height, width, dtype, device, repeats=3, path=AUTOTUNE_PATH):
+    """
+    Rank the available backends from fastest to slowest at synthesizing a batch of frames of the given size, on the given device.
+
+    Each backend is checked on random kernels against the cupy kernel if it is available, or else against synthesize_reference,
+    and dropped if its output differs. The ranking is cached on disk, so that each problem is only benchmarked once per machine.
+    """
+    key = problem_key(batch_size, kernel_size, dilation, height, width, dtype, device)
+    if key in rankings:
+        return rankings[key]
+
+    ranking = read_autotune_cache(path).get(key)
+    if ranking is not None:
+        rankings[key] = ranking
+        return ranking
+
+    # A random problem of the given size, with offsets of a few pixels in either direction
+    K = kernel_size ** 2
+    span = (kernel_size - 1) * dilation
+    input = torch.rand(batch_size, 3, height + span, width + span, dtype=dtype, device=device)
+    weight = torch.rand(batch_size, K, height, width, dtype=dtype, device=device).softmax(1)
+    offset_y = 4 * torch.randn(batch_size, K, height, width, dtype=dtype, device=device)
+    offset_x = 4 * torch.randn(batch_size, K, height, width, dtype=dtype, device=device)
+    args = (input, weight, offset_y, offset_x, dilation)
+
+    def synchronize():
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+
+    timings = {}
+    backends = available_backends(device, dtype, 3 * weight.numel())
+    with torch.no_grad():
+        reference = SYNTH_BACKENDS["cupy"]["synthesize"](*args) if "cupy" in backends else synthesize_reference(*args)
+
+        for name in backends:
+            synthesize = SYNTH_BACKENDS[name]["synthesize"]
+            try:
+                # The first call also warms up the backend (e.g. compiles its kernel)
+                if not torch.allclose(synthesize(*args), reference, rtol=1e-4, atol=1e-4):
+                    print(f"Synthesis backend {name} disagrees with the reference, skipping it")
+                    continue
+
+                synchronize()
+                start = time.perf_counter()
+                for _ in range(repeats):
+                    synthesize(*args)
+                synchronize()
+                timings[name] = (time.perf_counter() - start) / repeats
+            except Exception as error:
+                print(f"Synthesis backend {name} failed, skipping it: {error}")
+
+    ranking = sorted(timings, key=timings.get)
+    rankings[key] = ranking
+    write_autotune_cache(key, ranking, path)
+    print(f"Autotuned synthesis for {height}x{width} frames: " + ", ".join(f"{name} {1e3 * timings[name]:.2f} ms" for name in ranking))
+    return ranking
+
+
+@torch.compiler.disable
+def synthesize(input, weight, offset_y, offset_x, dilation, row_offset=0, backend="auto", topk=None, threshold=None, renormalize=False):
+    """
+    Apply the kernels (weight, offset_y, offset_x) to the padded input frames with the given backend,
+    or with the fastest backend for the problem on this machine if backend is "auto".
+    If topk or threshold is given, only the largest elements of each kernel are applied (see synthesize_sparse).
+    """
+    if topk is not None or threshold is not None:
+        return synthesize_sparse(input, weight, offset_y, offset_x, dilation, row_offset, topk, threshold, renormalize)
+
+    if backend == "auto" and torch.is_grad_enabled():
+        # Rankings are timed without gradients, and the gather backends keep every tap for the backward pass:
+        # training sticks to the cupy kernel whenever it is available
+        fits = available_backends(input.device, input.dtype, input.size(1) * weight.numel())
+        backend = "cupy" if "cupy" in fits else "tiled"
+    elif backend == "auto":
+        kernel_size = int(math.sqrt(weight.size(1)))
+        ranking = autotune(weight.size(0), kernel_size, dilation, weight.size(2), weight.size(3), input.dtype, input.device)
+        num_elements = input.size(1) * weight.numel()
+        fits = available_backends(input.device, input.dtype, num_elements)
+        backend = next((name for name in ranking if name in fits), "tiled")
+
+    return SYNTH_BACKENDS[backend]["synthesize"](input, weight, offset_y, offset_x, dilation, row_offset)
@@ -0,0 +1,120 @@
+import os
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from tqdm import tqdm
+from deploy import load_artemis, share_model, set_branch_threads
+from interpolate import interpolate_windows, open_cache
+from model.sep_sts_layer import install_masks
+
+
+# Number of chunks handed to each worker, so that workers which finish early can pick up more work
+CHUNKS_PER_PROC = 4
+
+# State of each worker process, set up once by init_worker
+worker_state = {}
+
+
+def split_windows(num_windows, num_chunks):
+    """
+    Split the windows 0, ..., num_windows - 1 into contiguous chunks of near-equal size:
+    returns a list of (start, end) ranges
+    """
+    num_chunks = max(1, min(num_chunks, num_windows))
+    bounds = [round(i * num_windows / num_chunks) for i in range(num_chunks + 1)]
+    return [(bounds[i], bounds[i + 1]) for i in range(num_chunks)]
+
+
+def get_worker_cores(worker_index, num_procs):
+    """
+    Get the CPU cores a worker is pinned to: an equal share of the cores available to the parent process
+    """
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count()))
+
+    cores_per_proc = max(1, len(cores) // num_procs)
+    start = (worker_index * cores_per_proc) % len(cores)
+    return cores[start:start + cores_per_proc]
+
+
+def init_worker(args, model_source, device, num_procs, counter, cache=None, masks=None):
+    """
+    Pin a new worker process to its share of the cores, and load the pre-trained model.
+    model_source is either the path to the model, or a model whose weights are in shared memory.
+    """
+    with counter.get_lock():
+        worker_index = counter.value
+        counter.value += 1
+
+    cores = get_worker_cores(worker_index, num_procs)
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cores)
+    torch.set_num_threads(len(cores))
+
+    worker_state["device"] = device
+    worker_state["cache"] = cache
+
+    if isinstance(model_source, str):
+        worker_state["model"] = load_artemis(model_source, device, args)
+    else:
+        # Moving a shared model to the CPU is a no-op, so the weights are never copied
+        worker_state["model"] = model_source.to(device)
+        set_branch_threads(worker_state["model"], args.branch_threads)
+        if args.compile:
+            from compilation import compile_artemis
+            compile_artemis(worker_state["model"], args.compile_mode)
+        if masks and device.type == "cpu":
+            install_masks(masks)
+
+
+def interpolate_chunk(start, frames):
+    """
+    Interpolate all windows of a chunk of frames inside of a worker process
+    """
+    interpolated_frames = interpolate_windows(worker_state["model"], frames, worker_state["device"], progress=False, cache=worker_state["cache"])
+    return start, [frame.cpu() for frame in interpolated_frames]
+
+
+def interpolate_windows_parallel(args, frames, device):
+    """
+    Interpolate a frame in the exact center of every window of 4 consecutive frames, using a pool of args.num_procs processes.
+
+    The windows are split into contiguous chunks; the frames of neighboring chunks overlap by the 3 frames
+    each window needs beyond its first one. The outputs are stitched back together in order.
+    """
+    num_windows = len(frames) - 3
+    chunks = split_windows(num_windows, args.num_procs * CHUNKS_PER_PROC)
+
+    context = mp.get_context("spawn")
+    counter = context.Value("i", 0)
+    results = {}
+
+    # The cache identifies the model by hashing its weights, which only needs to happen once
+    cache = open_cache(args)
+
+    if args.share_weights:
+        # Load the model once, and let every worker attach to its weights in shared memory
+        model = load_artemis(args.model_path, torch.device("cpu"), args)
+        model, masks = share_model(model, frame_size=frames[0].shape[-2:])
+        initargs = (args, model, device, args.num_procs, counter, cache, masks)
+    else:
+        initargs = (args, args.model_path, device, args.num_procs, counter, cache)
+
+    with ProcessPoolExecutor(max_workers=args.num_procs, mp_context=context, initializer=init_worker, initargs=initargs) as pool:
+        futures = [pool.submit(interpolate_chunk, start, frames[start:end + 3]) for start, end in chunks]
+
+        with tqdm(total=num_windows, desc="Interpolating frames") as pbar:
+            for future in as_completed(futures):
+                start, interpolated_frames = future.result()
+                results[start] = interpolated_frames
+                pbar.update(len(interpolated_frames))
+
+    # Stitch the chunks back together in order
+    stitched_frames = []
+    for start, end in chunks:
+        assert len(results[start]) == end - start, f"Chunk starting at window {start} is incomplete"
+        stitched_frames.extend(results[start])
+
+    return stitched_frames
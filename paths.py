@@ -0,0 +1,5 @@
+import os
+
+
+# Everything ArTEMIS keeps on disk across runs: autotuning results, generated kernels and compiled code
+CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "artemis")
@@ -0,0 +1,240 @@
+import contextvars
+import json
+import math
+import os
+import threading
+import time
+import torch
+import torch.nn as nn
+from collections import defaultdict
+from torch.profiler import record_function
+
+
+# Modules of ArTEMIS that are timed by default (names as returned by model.named_modules())
+DEFAULT_MODULES = [
+    "encoder.stem",
+    "encoder.down0", "encoder.stage1",
+    "encoder.down1", "encoder.stage2",
+    "encoder.down2", "encoder.stage3",
+    "encoder.down3", "encoder.stage4",
+    "decoder.0", "decoder.1", "decoder.2",
+    "smooth1", "smooth2", "smooth3",
+    "predict1", "predict2", "predict3",
+]
+
+
+def estimate_flops(module, inputs, output):
+    """
+    Estimate the floating point operations of a single call to a leaf layer.
+    Only convolutions and linear layers are counted, since they dominate the cost of ArTEMIS.
+    """
+    if isinstance(module, (nn.ConvTranspose2d, nn.ConvTranspose3d)):
+        # Every input element is scattered through the full kernel into each output channel
+        kernel_elements = math.prod(module.kernel_size)
+        return 2 * inputs[0].numel() * (module.out_channels // module.groups) * kernel_elements
+
+    if isinstance(module, (nn.Conv2d, nn.Conv3d)):
+        # Every output element is a dot product over the kernel window of each input channel
+        kernel_elements = math.prod(module.kernel_size)
+        return 2 * output.numel() * (module.in_channels // module.groups) * kernel_elements
+
+    if isinstance(module, nn.Linear):
+        return 2 * output.numel() * module.in_features
+
+    return 0
+
+
+class ModuleProfiler:
+    """
+    Opt-in instrumentation of an ArTEMIS model.
+
+    Forward hooks are attached to the encoder stages, the decoder, the SmoothNets and the ChronoSynth heads,
+    and the FunctionSynth call of each head is wrapped. For each call, the wall time, an estimate of the FLOPs
+    and the bytes allocated are recorded. Each call is also wrapped in a record_function range, so it shows up
+    by name when a torch.profiler session is active.
+
+    The calls which are running are kept per thread, so that the branches of the forward pass run on a BranchPool
+    (see --branch_threads) are timed on their own thread. They start from the calls of the thread which forked them,
+    and their FLOPs are also counted towards those calls.
+    """
+    def __init__(self, model, module_names=None):
+        self.model = model
+        self.module_names = module_names or DEFAULT_MODULES
+        self.handles = []
+        self.wrapped_synths = []
+        # The calls running on the current thread, outermost first, as a tuple of frames
+        self.stack = contextvars.ContextVar(f"profiler_stack_{id(self)}", default=())
+        # Frames are shared with the branches forked while they run, which count their FLOPs concurrently
+        self.lock = threading.Lock()
+        self.events = []
+        self.origin = time.perf_counter()
+
+        modules = dict(model.named_modules())
+        missing = [name for name in self.module_names if name not in modules]
+        if missing:
+            raise ValueError(f"Cannot profile unknown modules: {missing}")
+
+        # Time the selected modules
+        for name in self.module_names:
+            module = modules[name]
+            self.handles.append(module.register_forward_pre_hook(self._make_pre_hook(name)))
+            self.handles.append(module.register_forward_hook(self._make_post_hook(name)))
+
+            # FunctionSynth is an autograd function rather than a module, so wrap the function itself
+            if hasattr(module, "moduleSynth"):
+                self.wrapped_synths.append((module, module.moduleSynth))
+                module.moduleSynth = self._wrap_synth(f"{name}.FunctionSynth", module.moduleSynth)
+
+        # Count the FLOPs of every leaf layer towards all the profiled modules that are currently running
+        for module in model.modules():
+            if isinstance(module, (nn.Conv2d, nn.Conv3d, nn.ConvTranspose2d, nn.ConvTranspose3d, nn.Linear)):
+                self.handles.append(module.register_forward_hook(self._count_flops))
+
+    def _synchronize(self):
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            torch.cuda.synchronize()
+
+    def _start(self, name):
+        self._synchronize()
+        scope = record_function(name)
+        scope.__enter__()
+
+        if torch.cuda.is_available() and torch.cuda.is_initialized():
+            memory = torch.cuda.memory_allocated()
+            # Nested calls (e.g. FunctionSynth inside a ChronoSynth head) share the peak of the outermost call
+            if not self.stack.get():
+                torch.cuda.reset_peak_memory_stats()
+        else:
+            memory = None
+
+        frame = {"name": name, "scope": scope, "memory": memory, "flops": 0, "thread": threading.get_ident(), "start": time.perf_counter()}
+        self.stack.set(self.stack.get() + (frame,))
+
+    def _stop(self, output):
+        self._synchronize()
+        end = time.perf_counter()
+        stack = self.stack.get()
+        frame = stack[-1]
+        self.stack.set(stack[:-1])
+        frame["scope"].__exit__(None, None, None)
+
+        # On the GPU, report the peak additional memory allocated during the call,
+        # otherwise fall back to the size of the tensors the call produced
+        if frame["memory"] is not None:
+            allocated = torch.cuda.max_memory_allocated() - frame["memory"]
+        else:
+            outputs = output if isinstance(output, (tuple, list)) else [output]
+            allocated = sum(t.numel() * t.element_size() for t in outputs if isinstance(t, torch.Tensor))
+
+        self.events.append({
+            "name": frame["name"],
+            "thread": frame["thread"],
+            "start": frame["start"] - self.origin,
+            "duration": end - frame["start"],
+            "flops": frame["flops"],
+            "bytes": allocated,
+        })
+
+    def _make_pre_hook(self, name):
+        def hook(module, inputs):
+            self._start(name)
+        return hook
+
+    def _make_post_hook(self, name):
+        def hook(module, inputs, output):
+            self._stop(output)
+        return hook
+
+    def _wrap_synth(self, name, synth):
+        def wrapped(input, weight, offset_y, offset_x, dilation, *args, **kwargs):
+            self._start(name)
+            output = synth(input, weight, offset_y, offset_x, dilation, *args, **kwargs)
+            # Every output element accumulates k^2 bilinearly sampled taps (4 multiply-adds each), or only the top k of them
+            taps = min(kwargs.get("topk") or weight.size(1), weight.size(1))
+            flops = 2 * 4 * output.numel() * taps
+            self._add_flops(flops)
+            self._stop(output)
+            return output
+        return wrapped
+
+    def _count_flops(self, module, inputs, output):
+        self._add_flops(estimate_flops(module, inputs, output))
+
+    def _add_flops(self, flops):
+        with self.lock:
+            for frame in self.stack.get():
+                frame["flops"] += flops
+
+    def reset(self):
+        """
+        Discard all recorded events
+        """
+        self.events = []
+        self.origin = time.perf_counter()
+
+    def remove(self):
+        """
+        Detach all hooks and restore the original synthesis functions
+        """
+        for handle in self.handles:
+            handle.remove()
+        for module, synth in self.wrapped_synths:
+            module.moduleSynth = synth
+        self.handles = []
+        self.wrapped_synths = []
+
+    def summary(self):
+        """
+        Aggregate the recorded events per module:
+        returns a dictionary of name -> {calls, total_ms, mean_ms, gflops, mbytes}
+        """
+        totals = defaultdict(lambda: {"calls": 0, "total_ms": 0.0, "gflops": 0.0, "mbytes": 0.0})
+        for event in self.events:
+            total = totals[event["name"]]
+            total["calls"] += 1
+            total["total_ms"] += event["duration"] * 1e3
+            total["gflops"] += event["flops"] / 1e9
+            total["mbytes"] += event["bytes"] / 2**20
+
+        for total in totals.values():
+            total["mean_ms"] = total["total_ms"] / total["calls"]
+
+        return dict(totals)
+
+    def print_summary(self):
+        summary = self.summary()
+        # FunctionSynth calls are nested inside their ChronoSynth heads, so leave them out of the total
+        grand_total = sum(total["total_ms"] for name, total in summary.items() if not name.endswith("FunctionSynth")) or 1.0
+
+        print(f"{'module':<28}{'calls':>8}{'total ms':>12}{'mean ms':>10}{'share':>8}{'GFLOPs':>10}{'MB':>10}")
+        for name, total in sorted(summary.items(), key=lambda item: -item[1]["total_ms"]):
+            share = 100 * total["total_ms"] / grand_total
+            print(f"{name:<28}{total['calls']:>8}{total['total_ms']:>12.2f}{total['mean_ms']:>10.2f}{share:>7.1f}%{total['gflops']:>10.2f}{total['mbytes']:>10.1f}")
+
+    def export_chrome_trace(self, path):
+        """
+        Write the recorded events to a JSON file which can be opened in chrome://tracing or Perfetto
+        """
+        trace = [{
+            "name": event["name"],
+            "ph": "X",
+            "pid": os.getpid(),
+            "tid": event["thread"],
+            "ts": event["start"] * 1e6,
+            "dur": event["duration"] * 1e6,
+            "args": {"flops": event["flops"], "bytes": event["bytes"]},
+        } for event in self.events]
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+    def log_to_tensorboard(self, logger, step):
+        """
+        Log the per-module summary through a TensorBoardLogger
+        """
+        writer = logger.experiment
+        for name, total in self.summary().items():
+            writer.add_scalar(f"profile/{name}/mean_ms", total["mean_ms"], step)
+            writer.add_scalar(f"profile/{name}/gflops_per_call", total["gflops"] / total["calls"], step)
+            writer.add_scalar(f"profile/{name}/mbytes_per_call", total["mbytes"] / total["calls"], step)
@@ -0,0 +1,137 @@
+import itertools
+import torch
+from torch.optim import Adamax
+from tqdm import tqdm
+from deploy import load_artemis, read_weights, write_artifact
+from loss import Loss
+from model.sep_sts_layer import WindowAttention3D, Mlp
+
+
+def prunable_modules(model):
+    """
+    List the attention and MLP layers of the encoder, whose heads and hidden channels can be pruned, as (name, module)
+    """
+    return [(name, module) for name, module in model.named_modules() if isinstance(module, (WindowAttention3D, Mlp))]
+
+
+def group_count(module):
+    """
+    The number of heads of an attention layer, or of hidden channels of an MLP
+    """
+    return module.num_heads if isinstance(module, WindowAttention3D) else module.linear1.out_features
+
+
+def to_device(batch, device):
+    images, ground_truth, output_frame_times = batch
+    return [image.to(device) for image in images], ground_truth.to(device), output_frame_times.to(device)
+
+
+def score_importance(model, batches, device, loss):
+    """
+    Score every attention head and MLP hidden channel of the encoder on calibration batches,
+    by the first-order Taylor estimate of the change of the loss if it were removed: |activation x gradient|,
+    summed over the channels of the head and the tokens of each batch.
+    Returns a dictionary of module name -> scores
+    """
+    modules = prunable_modules(model)
+    scores = {name: torch.zeros(group_count(module), device=device) for name, module in modules}
+
+    def accumulate(name, num_heads, activation, gradient):
+        contribution = (activation * gradient).flatten(0, -2)
+        # The outputs of the heads are concatenated before the projection
+        if num_heads is not None:
+            contribution = contribution.view(contribution.shape[0], num_heads, -1).sum(2)
+        scores[name] += contribution.sum(0).abs().detach()
+
+    def score_hook(name, num_heads=None):
+        def hook(layer, inputs):
+            activation = inputs[0]
+            if activation.requires_grad:
+                activation.register_hook(lambda gradient: accumulate(name, num_heads, activation, gradient))
+        return hook
+
+    # The heads are scored on the input of the output projection, and the hidden channels on the input of the second layer
+    hooks = []
+    for name, module in modules:
+        if isinstance(module, WindowAttention3D):
+            hooks.append(module.project.register_forward_pre_hook(score_hook(name, module.num_heads)))
+        else:
+            hooks.append(module.linear2.register_forward_pre_hook(score_hook(name)))
+
+    model.train()
+    for batch in tqdm(batches, desc="Scoring heads and channels"):
+        images, ground_truth, output_frame_times = to_device(batch, device)
+        model.zero_grad()
+        loss(model(images, output_frame_times), ground_truth).backward()
+    model.zero_grad()
+
+    for hook in hooks:
+        hook.remove()
+
+    return scores
+
+
+def prune_model(model, scores, head_ratio, mlp_ratio):
+    """
+    Remove the given fraction of the lowest scoring heads of every attention layer, and hidden channels of every MLP.
+    Returns the number of heads or hidden channels left in each of them, by module name
+    """
+    sizes = {}
+    for name, module in prunable_modules(model):
+        ratio = head_ratio if isinstance(module, WindowAttention3D) else mlp_ratio
+        num_kept = max(1, round((1 - ratio) * group_count(module)))
+
+        # Keep the remaining heads or channels in their original order
+        kept = scores[name].topk(num_kept).indices.sort().values.tolist()
+        module.prune(kept)
+        sizes[name] = num_kept
+    return sizes
+
+
+def finetune(model, loader, device, loss, args):
+    """
+    Fine-tune a pruned model for a few steps
+    """
+    optimizer = Adamax(model.parameters(), lr=args.lr, betas=(args.beta1, args.beta2))
+    model.train()
+
+    with tqdm(total=args.prune_finetune_steps, desc="Fine-tuning") as pbar:
+        while pbar.n < args.prune_finetune_steps:
+            for batch in loader:
+                images, ground_truth, output_frame_times = to_device(batch, device)
+                optimizer.zero_grad()
+                batch_loss = loss(model(images, output_frame_times), ground_truth)
+                batch_loss.backward()
+                optimizer.step()
+
+                pbar.set_postfix(loss=batch_loss.item())
+                pbar.update(1)
+                if pbar.n == args.prune_finetune_steps:
+                    break
+
+
+def prune_artemis(args):
+    """
+    Prune the attention heads and MLP hidden channels of the encoder of a pre-trained model, fine-tune it briefly
+    on the Vimeo-90K Septuplet training set, and export it to a smaller deployment artifact
+    """
+    from data.preprocessing.vimeo90k_septuplet_process import get_loader
+
+    device = torch.device('cuda' if args.cuda else 'cpu')
+    _, model_config = read_weights(args.model_path)
+    model = load_artemis(args.model_path, device)
+    loss = Loss(args)
+    loader = get_loader("train", args.data_dir, batch_size=args.batch_size, num_workers=args.num_workers)
+
+    num_parameters = sum(parameter.numel() for parameter in model.parameters())
+
+    scores = score_importance(model, list(itertools.islice(loader, args.prune_calib_batches)), device, loss)
+    sizes = prune_model(model, scores, args.prune_heads, args.prune_mlp)
+
+    num_pruned_parameters = sum(parameter.numel() for parameter in model.parameters())
+    print(f"Pruned {num_parameters - num_pruned_parameters} of {num_parameters} parameters")
+
+    finetune(model, loader, device, loss, args)
+
+    model_config = dict(model_config, pruned_sizes=sizes)
+    return write_artifact(model.state_dict(), model_config, args.export_path, args.export_dtype)
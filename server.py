@@ -0,0 +1,212 @@
+import base64
+import json
+import os
+import queue
+import socketserver
+import threading
+import time
+import torch
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from deploy import load_artemis
+from utils import decode_image, encode_image
+
+
+class InterpolationJob:
+    """
+    A single interpolated frame requested from the server: 4 context frames and 1 timestep
+    """
+    def __init__(self, frames, timestep):
+        self.frames = frames
+        self.timestep = timestep
+        self.shape = tuple(frames[0].shape)
+        self.submitted = time.perf_counter()
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DynamicBatcher:
+    """
+    Coalesce concurrent interpolation jobs of the same frame size into one batched forward pass.
+
+    A batch is run as soon as it holds max_batch jobs, or max_wait_ms after its first job arrived.
+    Jobs whose frame size differs from the current batch wait for a later batch.
+    """
+    def __init__(self, model, device, max_batch=8, max_wait_ms=10):
+        self.model = model
+        self.device = device
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.deferred = deque()
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.num_jobs = 0
+        self.total_latency = 0.0
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, frames, timesteps):
+        """
+        Queue one job per timestep for a window of context frames, and wait for all of their results
+        """
+        jobs = [InterpolationJob(frames, timestep) for timestep in timesteps]
+        for job in jobs:
+            self.queue.put(job)
+        return [job.wait() for job in jobs]
+
+    def _next_job(self, timeout):
+        if self.deferred:
+            return self.deferred.popleft()
+        return self.queue.get(timeout=timeout)
+
+    def _collect(self):
+        # Block until there is at least one job to run
+        first = self._next_job(timeout=None)
+        batch = [first]
+        deadline = time.perf_counter() + self.max_wait
+        skipped = []
+
+        # Fill the batch with jobs of the same shape until it is full or the deadline passes
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.perf_counter()
+            if remaining <= 0 and not self.deferred:
+                break
+            try:
+                job = self._next_job(timeout=max(remaining, 0))
+            except queue.Empty:
+                break
+
+            if job.shape == first.shape:
+                batch.append(job)
+            else:
+                skipped.append(job)
+
+        # Incompatible jobs go first in line for the next batch
+        self.deferred.extendleft(reversed(skipped))
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            try:
+                # Stack the context frames of every job into a single batch
+                frames = [torch.cat([job.frames[i] for job in batch]).to(self.device) for i in range(len(batch[0].frames))]
+                timesteps = torch.tensor([job.timestep for job in batch], dtype=torch.float32).to(self.device)
+
+                with torch.no_grad():
+                    _, _, out_batch = self.model(frames, timesteps)
+
+                for job, output in zip(batch, out_batch.cpu()):
+                    job.result = output
+            except Exception as error:
+                for job in batch:
+                    job.error = error
+
+            finished = time.perf_counter()
+            with self.lock:
+                self.batch_sizes[len(batch)] += 1
+                self.num_jobs += len(batch)
+                self.total_latency += sum(finished - job.submitted for job in batch)
+
+            for job in batch:
+                job.done.set()
+
+    def stats(self):
+        """
+        Report the queue depth, the histogram of batch sizes and the mean latency of served jobs
+        """
+        with self.lock:
+            return {
+                "queue_depth": self.queue.qsize() + len(self.deferred),
+                "batch_size_histogram": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+                "jobs_served": self.num_jobs,
+                "mean_latency_ms": 1e3 * self.total_latency / self.num_jobs if self.num_jobs else 0.0,
+            }
+
+
+class InterpolationHandler(BaseHTTPRequestHandler):
+    """
+    POST /interpolate with a JSON body {"frames": [4 base64-encoded images], "timesteps": [0.25, 0.5, ...]}
+    returns {"frames": [1 base64-encoded PNG per timestep]}.
+    GET /stats returns the statistics of the batcher.
+    """
+    batcher = None
+
+    def _send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        if self.path == "/stats":
+            self._send_json(200, self.batcher.stats())
+        else:
+            self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self.path != "/interpolate":
+            return self._send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        try:
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            frames = [decode_image(base64.b64decode(frame)) for frame in request["frames"]]
+            timesteps = [float(t) for t in request.get("timesteps", [0.5])]
+        except (KeyError, TypeError, ValueError) as error:
+            return self._send_json(400, {"error": str(error)})
+
+        if len(frames) != 4 or any(frame.shape != frames[0].shape for frame in frames):
+            return self._send_json(400, {"error": "Expected 4 context frames of the same size"})
+
+        try:
+            outputs = self.batcher.submit(frames, timesteps)
+        except Exception as error:
+            return self._send_json(500, {"error": str(error)})
+
+        self._send_json(200, {"frames": [base64.b64encode(encode_image(output)).decode() for output in outputs]})
+
+    def address_string(self):
+        # Unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "unix"
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(args):
+    """
+    Keep ArTEMIS loaded and serve interpolation requests over HTTP (or a Unix socket) until interrupted
+    """
+    device = torch.device('cuda' if args.cuda else 'cpu')
+
+    # Load the pre-trained model once for all requests
+    model = load_artemis(args.model_path, device, args)
+    InterpolationHandler.batcher = DynamicBatcher(model, device, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms)
+
+    if args.socket_path:
+        # Remove a stale socket left behind by a previous server
+        if os.path.exists(args.socket_path):
+            os.remove(args.socket_path)
+        server = ThreadingUnixHTTPServer(args.socket_path, InterpolationHandler)
+        print("Serving ArTEMIS on unix socket: ", args.socket_path)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), InterpolationHandler)
+        print(f"Serving ArTEMIS on http://{args.host}:{args.port}")
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,95 @@
+import re
+import pytest
+import cupy_module.kernels as kernels
+from cupy_module.kernels import generate_kernel, kernel_source, shape_args, tensor_names
+
+
+KERNELS = ["kernel_Synth_updateOutput", "kernel_Synth_updateGradWeight", "kernel_Synth_updateGradAlpha", "kernel_Synth_updateGradBeta"]
+
+
+@pytest.fixture(autouse=True)
+def clear_sources():
+    # kernel_source memoizes per process, which would hide the on-disk cache
+    kernel_source.cache_clear()
+    yield
+    kernel_source.cache_clear()
+
+
+@pytest.mark.parametrize("strFunc", KERNELS)
+@pytest.mark.parametrize("intFilterSize, intDilation", [(1, 1), (3, 1), (5, 2), (7, 3)])
+def test_generated_source(tmp_path, strFunc, intFilterSize, intDilation):
+    strKernel = kernel_source(strFunc, intFilterSize, intDilation, str(tmp_path))
+
+    # Every macro is expanded, and the filter size and dilation are baked in
+    for strMacro in ("SIZE_", "VALUE_", "CLAMP", "F_SIZE", "DILATION"):
+        assert strMacro not in strKernel
+    assert f"row < {intFilterSize};" in strKernel or f"intDepth / {intFilterSize};" in strKernel
+    assert f"*{intDilation} +" in strKernel
+
+    # The shapes are parameters rather than constants: one size and one stride per axis of every tensor
+    strParams = re.search(rf"void {strFunc}\(([^\)]*)\)", strKernel).group(1)
+    for strTensor in tensor_names(strFunc):
+        for intArg in range(4):
+            assert f"const int {strTensor}_size_{intArg}, const int {strTensor}_stride_{intArg}" in strParams
+    assert strParams.count("const int") == 1 + (strFunc == "kernel_Synth_updateOutput") + 8 * len(tensor_names(strFunc))
+
+
+def test_sources_differ_by_filter_size_and_dilation(tmp_path):
+    strSources = {kernel_source(KERNELS[0], intFilterSize, intDilation, str(tmp_path)) for intFilterSize in (3, 5) for intDilation in (1, 2)}
+    assert len(strSources) == 4
+    assert len(list(tmp_path.iterdir())) == 4
+
+
+def test_on_disk_cache_hit(tmp_path, monkeypatch):
+    strKernel = kernel_source(KERNELS[0], 5, 2, str(tmp_path))
+    strPaths = list(tmp_path.iterdir())
+    assert len(strPaths) == 1 and strPaths[0].read_text() == strKernel
+
+    # A new process (emulated by clearing the memoized sources) reads the source back instead of generating it
+    kernel_source.cache_clear()
+    monkeypatch.setattr(kernels, "generate_kernel", lambda *args: pytest.fail("the cached source was not used"))
+    assert kernel_source(KERNELS[0], 5, 2, str(tmp_path)) == strKernel
+
+
+def test_edited_template_invalidates_cache(tmp_path, monkeypatch):
+    kernel_source(KERNELS[0], 3, 1, str(tmp_path))
+
+    kernel_source.cache_clear()
+    monkeypatch.setattr(kernels, KERNELS[0], getattr(kernels, KERNELS[0]) + "\n")
+    kernel_source(KERNELS[0], 3, 1, str(tmp_path))
+    assert len(list(tmp_path.iterdir())) == 2
+
+
+def test_read_only_cache(tmp_path):
+    # A cache directory which cannot be created only costs regenerating the source
+    strFile = tmp_path / "file"
+    strFile.write_text("")
+    assert kernel_source(KERNELS[0], 3, 1, str(strFile / "kernels")) == generate_kernel(KERNELS[0], 3, 1)
+
+
+@pytest.mark.parametrize("strFunc", KERNELS)
+def test_shape_args(strFunc):
+    torch = pytest.importorskip("torch")
+
+    objVars = {strTensor: torch.zeros(2, 3 + intTensor, 5, 7)[:, :, 1:, ::2] for intTensor, strTensor in enumerate(tensor_names(strFunc))}
+    intArgs = shape_args(strFunc, objVars)
+
+    # One size and one stride per axis of every tensor, in the order of the parameters of the kernel
+    intExpected = []
+    for strTensor in tensor_names(strFunc):
+        objTensor = objVars[strTensor]
+        for intArg in range(4):
+            intExpected += [objTensor.size(intArg), objTensor.stride(intArg)]
+    assert intArgs == intExpected
+
+    # They are passed to the kernel as int32
+    assert all(type(intArg) is int and -2 ** 31 <= intArg < 2 ** 31 for intArg in intArgs)
+
+
+def test_shape_args_overflow():
+    torch = pytest.importorskip("torch")
+
+    objVars = {strTensor: torch.zeros(1, 1, 1, 1) for strTensor in tensor_names(KERNELS[0])}
+    objVars["input"] = torch.zeros(1).as_strided((1, 1, 1, 1), (2 ** 31, 1, 1, 1))
+    with pytest.raises(ValueError):
+        shape_args(KERNELS[0], objVars)
@@ -1,11 +1,27 @@
 import os
 import cv2
 import numpy as np
+import torch
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from PIL import Image
 from torchvision import transforms
 
 
+# The signatures of the formats accepted by decode_image: PNG and JPEG
+IMAGE_SIGNATURES = (b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff")
+
+
+def enable_exr():
+    """
+    Let OpenCV read and write EXR files, which it disables by default for security reasons.
+    Only frame directories call this, before their first EXR file: OpenCV reads the setting once, the first time it
+    meets an EXR file, and keeps it for the rest of the process.
+    """
+    os.environ.setdefault("OPENCV_IO_ENABLE_OPENEXR", "1")
+
+
 def read_image(path):
     """
     Read an image from disk and return it as a tensor
@@ -16,6 +32,37 @@ def read_image(path):
     return image
 
 
+def decode_image(data):
+    """
+    Decode an encoded PNG or JPEG image and return it as a tensor of shape (1, 3, H, W).
+    Other formats are rejected before they reach a decoder, since the bytes may come from untrusted requests.
+    """
+    if not data.startswith(IMAGE_SIGNATURES):
+        raise ValueError("Only PNG and JPEG images are accepted")
+
+    image = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+
+    if image is None:
+        raise ValueError("Error decoding image")
+
+    image = cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+    return torch.from_numpy(image).permute(2, 0, 1).unsqueeze(0).float() / 255.0
+
+
+def encode_image(image, extension=".png"):
+    """
+    Encode an image tensor of shape (3, H, W) and return the bytes of the encoded file
+    """
+    image = (image.permute(1, 2, 0).cpu().clamp(0.0, 1.0).detach().numpy() * 255.0).astype(np.uint8)
+    image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR)
+    success, data = cv2.imencode(extension, image)
+
+    if not success:
+        raise ValueError("Error encoding image")
+
+    return data.tobytes()
+
+
 def save_image(image, name, path):
     """
     Save an image to disk
@@ -74,12 +121,12 @@ def save_images(output, gt_image, batch_index, context_frames, output_dir, epoch
             save_image(context, context_image_name, context_write_path)
 
 
-def read_video(video_path):
+def read_video(video_path, yuv=False):
     """
     Read a video file and return a numpy array of individual frames
     
     Returns:
-    - video_frames: a list of tensors, each of shape (1, 3, 256, 256)
+    - video_frames: a list of tensors, each of shape (1, 3, 256, 256), or YUV 4:2:0 frames if yuv (see frame_to_yuv)
     - frame_rate: the frame rate of the video
     """
     # Load the video file
@@ -100,12 +147,12 @@ def read_video(video_path):
             if not ret:
                 break
 
-            # Convert the frame to RGB, normalize its values, and add it to the list
-            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
-            frame = Image.fromarray(frame).convert('RGB')
-            transform = transforms.Compose([transforms.ToTensor()])
-            frame = transform(frame).unsqueeze(0)
-            video_frames.append(frame)
+            # Convert the frame to RGB (or YUV 4:2:0), normalize its values, and add it to the list
+            if yuv:
+                video_frames.append(frame_to_yuv(frame, cv2.COLOR_BGR2YUV_I420))
+            else:
+                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+                video_frames.append(frame_to_tensor(frame))
             pbar.update(1)
 
     # Release the video capture object
@@ -117,19 +164,197 @@ def save_video(frames, output_path, frame_rate):
     """
     Save a list of frames to a video file
     """
-    # Define the codec and create a VideoWriter object
-    fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
-    size = (frames[0].shape[3], frames[0].shape[2])
-    out = cv2.VideoWriter(output_path, fourcc, frame_rate, size)
+    writer = VideoWriter(output_path, frame_rate)
 
     # Convert each frame to a numpy array and write it to the video file
     with tqdm(total=len(frames), desc="Saving video") as pbar:
         for frame in frames:
-            frame = frame.squeeze().permute(1, 2, 0).cpu().numpy() * 255.0
-            frame = frame.astype(np.uint8)
-            frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-            out.write(frame)
+            writer.write(frame)
             pbar.update(1)
 
-    # Release the VideoWriter object
-    out.release()
\ No newline at end of file
+    writer.close()
+
+
+IMAGE_EXTENSIONS = (".png", ".exr", ".jpg", ".jpeg", ".tif", ".tiff", ".bmp")
+
+
+def frame_to_tensor(frame):
+    """
+    Convert an RGB frame of shape (H, W, 3) to a tensor of shape (1, 3, H, W):
+    8-bit and 16-bit frames are normalized to 0-1, floating point frames (e.g. from EXR files) are kept as they are
+    """
+    if frame.dtype == np.uint16:
+        # torch has no uint16 tensors, so 16-bit frames are converted on the numpy side
+        return torch.from_numpy(frame.astype(np.float32) / 65535.0).permute(2, 0, 1).unsqueeze(0)
+
+    tensor = torch.from_numpy(np.ascontiguousarray(frame)).permute(2, 0, 1).unsqueeze(0)
+
+    if frame.dtype == np.uint8:
+        return tensor.float() / 255.0
+    if not np.issubdtype(frame.dtype, np.floating):
+        raise ValueError(f"Unsupported frame dtype: {frame.dtype}")
+    return tensor.float()
+
+
+def frame_to_yuv(frame, code=cv2.COLOR_RGB2YUV_I420):
+    """
+    Convert an 8-bit RGB frame of shape (H, W, 3) (or BGR, with code=cv2.COLOR_BGR2YUV_I420) to a YUV 4:2:0 frame:
+    a (luma, chroma) pair of tensors of shape (1, 1, H, W) and (1, 2, H/2, W/2), normalized to 0-1
+    """
+    height, width = frame.shape[:2]
+    if frame.dtype != np.uint8 or height % 2 or width % 2:
+        raise ValueError("YUV 4:2:0 frames must be 8-bit, with an even width and height")
+
+    # OpenCV packs the Y, U and V planes one after the other (I420)
+    planes = torch.from_numpy(cv2.cvtColor(frame, code).reshape(-1)).float() / 255.0
+    luma, u, v = planes.split([height * width, height * width // 4, height * width // 4])
+    luma = luma.view(1, 1, height, width)
+    chroma = torch.stack([u, v]).view(1, 2, height // 2, width // 2)
+    return luma, chroma
+
+
+def yuv_to_frame(luma, chroma):
+    """
+    Convert a YUV 4:2:0 frame (see frame_to_yuv) to an 8-bit BGR frame of shape (H, W, 3) for OpenCV
+    """
+    planes = torch.cat([luma.detach().flatten(), chroma.detach().flatten()]).cpu().float().numpy()
+    planes = (np.clip(planes, 0.0, 1.0) * 255.0).astype(np.uint8)
+    height, width = luma.shape[-2:]
+    return cv2.cvtColor(planes.reshape(height * 3 // 2, width), cv2.COLOR_YUV2BGR_I420)
+
+
+def tensor_to_frame(tensor, dtype=np.uint8):
+    """
+    Convert a tensor of shape (3, H, W) or (1, 3, H, W), or a YUV 4:2:0 frame, to a BGR frame of shape (H, W, 3) for OpenCV
+    """
+    if isinstance(tensor, tuple):
+        frame = yuv_to_frame(*tensor)
+        return frame if dtype == np.uint8 else frame.astype(dtype) / 255.0
+
+    frame = tensor.detach().squeeze(0).permute(1, 2, 0).cpu().float().numpy()
+
+    if dtype == np.uint8:
+        frame = (np.clip(frame, 0.0, 1.0) * 255.0).astype(np.uint8)
+    else:
+        frame = frame.astype(dtype)
+
+    return cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
+
+
+def list_image_sequence(directory):
+    """
+    List the image files of a frame directory, in order
+    """
+    names = sorted(name for name in os.listdir(directory) if name.lower().endswith(IMAGE_EXTENSIONS))
+
+    if not names:
+        raise Exception(f"No image files found in: {directory}")
+
+    return [os.path.join(directory, name) for name in names]
+
+
+def read_frame(path):
+    """
+    Read a single frame from disk as an RGB array of shape (H, W, 3), keeping its original dtype
+    """
+    if path.lower().endswith(".exr"):
+        enable_exr()
+
+    frame = cv2.imread(path, cv2.IMREAD_ANYCOLOR | cv2.IMREAD_ANYDEPTH)
+
+    if frame is None:
+        raise Exception(f"Error reading frame: {path}")
+
+    if frame.ndim == 2:
+        return cv2.cvtColor(frame, cv2.COLOR_GRAY2RGB)
+    return cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+
+
+def read_image_sequence(directory, num_threads=4):
+    """
+    Read the frames of a frame directory in order, decoding them ahead of time with a pool of threads.
+    Frames are yielded as RGB arrays of shape (H, W, 3) in their original dtype (uint8 for 8-bit images, uint16 for 16-bit ones).
+    """
+    paths = list_image_sequence(directory)
+    prefetch = 2 * num_threads
+
+    with ThreadPoolExecutor(max_workers=num_threads) as pool:
+        pending = deque()
+        for path in paths:
+            pending.append(pool.submit(read_frame, path))
+
+            # Keep a bounded number of frames decoding ahead of the consumer
+            if len(pending) >= prefetch:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+class VideoWriter:
+    """
+    Write frames to an mp4 video file, one at a time
+    """
+    def __init__(self, output_path, frame_rate):
+        self.output_path = output_path
+        self.frame_rate = frame_rate
+        self.out = None
+
+    def write(self, frame):
+        frame = tensor_to_frame(frame)
+
+        # Create the VideoWriter object once the frame size is known
+        if self.out is None:
+            fourcc = cv2.VideoWriter_fourcc('m', 'p', '4', 'v')
+            self.out = cv2.VideoWriter(self.output_path, fourcc, self.frame_rate, (frame.shape[1], frame.shape[0]))
+
+        self.out.write(frame)
+
+    def close(self):
+        if self.out is not None:
+            self.out.release()
+
+
+class ImageSequenceWriter:
+    """
+    Write frames to numbered image files in a directory (frame_000000.png, ...), encoding them behind the caller
+    with a pool of threads
+    """
+    def __init__(self, directory, extension="png", num_threads=4):
+        self.directory = directory
+        self.extension = extension
+        self.index = 0
+        self.max_pending = 2 * num_threads
+        self.pending = deque()
+        self.pool = ThreadPoolExecutor(max_workers=num_threads)
+        os.makedirs(directory, exist_ok=True)
+
+        if extension == "exr":
+            enable_exr()
+
+    def write(self, frame):
+        # Copy the frame off of the GPU on the calling thread, and leave the encoding to the pool
+        frame = tensor_to_frame(frame, dtype=np.float32 if self.extension == "exr" else np.uint8)
+        path = os.path.join(self.directory, f"frame_{self.index:06d}.{self.extension}")
+        self.pending.append((path, self.pool.submit(cv2.imwrite, path, frame)))
+        self.index += 1
+
+        # Bound the number of frames waiting to be written
+        while len(self.pending) > self.max_pending:
+            self.wait()
+
+    def wait(self):
+        """
+        Wait for the oldest pending frame to be written, and raise if OpenCV could not write it
+        (e.g. an unsupported extension, a full disk or an unwritable directory), rather than leaving a gap in the sequence
+        """
+        path, future = self.pending.popleft()
+        if not future.result():
+            raise Exception(f"Error writing frame: {path}")
+
+    def close(self):
+        try:
+            while self.pending:
+                self.wait()
+        finally:
+            self.pool.shutdown()